@@ -35,6 +35,7 @@ from streamlit_idealista.config import (
     INTERSECT_COLOR,
     CONTROL_SALE
 )
+from streamlit_idealista.cities import get_city, get_city_resource, select_city
 favicon = PROJ_ROOT / "streamlit_idealista/assets/favicon.png"
 im = Image.open(favicon)
 
@@ -80,109 +81,102 @@ This tool is designed to aid in decision-making and provide insights into the re
 """)
 
 # load data
-@st.cache_data
-def load_dtypes(_dtypes_path: UPath) -> dict:
-    with _dtypes_path.open("rb") as f:
-        return json.load(f)
-dtypes_coupled_dict = load_dtypes(INPUT_DTYPES_COUPLED_JSON_PATH)
-
-@st.cache_data
-def load_main_data(_main_data_path: UPath) -> pd.DataFrame:
-    with _main_data_path.open("rb") as f:
-        df = pd.read_csv(f, sep = ';', dtype=dtypes_coupled_dict, encoding="unicode_escape")
-    return df
-df = load_main_data(INPUT_DATA_PATH)
-
-@st.cache_data
-def load_censustract_geojson(_censustract_geojson_path: UPath) -> gpd.GeoDataFrame:
-    with _censustract_geojson_path.open("rb") as f:
-        gdf_ine = gpd.read_file(f)
-    gdf_ine['CENSUSTRACT'] = gdf_ine['CENSUSTRACT'].astype(int).astype(str)
-    return gdf_ine
-gdf_ine = load_censustract_geojson(INPUT_INE_CENSUSTRACT_GEOJSON)
-
-@st.cache_data
-def load_operation_types(_operation_types_path: UPath) -> pd.DataFrame:
-    with _operation_types_path.open("rb") as f:
-        return pd.read_csv(f, sep=";", dtype=dtypes_coupled_dict, encoding="unicode_escape")
-operation_types_df = load_operation_types(INPUT_OPERATION_TYPES_PATH)
-
-@st.cache_data
-def load_typology_types(_typology_types_path: UPath) -> pd.DataFrame:
-    with _typology_types_path.open("rb") as f:
-        return pd.read_csv(f, sep=";", dtype=dtypes_coupled_dict)
-typology_types_df = load_typology_types(INPUT_TYPOLOGY_TYPES_PATH)
-
-@st.cache_data
-def load_interventions(_interventions_path: UPath) -> gpd.GeoDataFrame:
-    with _interventions_path.open("rb") as f:
-        return gpd.read_file(f)
-interventions_gdf =  load_interventions(INPUT_SUPERILLES_INTERVENTIONS_GEOJSON)
-
-@st.cache_data
-def process_df(df: pd.DataFrame) -> pd.DataFrame:
-    copy_df = df.copy(deep=True)
-    return (
-        copy_df
-        .astype({'ADOPERATIONID': 'int',
-                'ADTYPOLOGYID': 'int'
-                })
-        .join(operation_types_df.set_index('ID'), on='ADOPERATIONID', how="left", validate="m:1")
-        .rename(columns={
-            'SHORTNAME': 'ADOPERATION',
-                        }
-                )
-        .astype({'ADOPERATION': 'category',
-                'ADOPERATIONID': 'category'
-                })
-        .drop(columns=("DESCRIPTION"))
-        .join(typology_types_df.set_index('ID'), on='ADTYPOLOGYID', how="left", validate="m:1")
-        .rename(columns={
-            'SHORTNAME': 'ADTYPOLOGY',
-                        }
-                )
-        .astype({'ADTYPOLOGY': 'category',
-                'ADTYPOLOGYID': 'category'
-                })
-        .drop(columns=("DESCRIPTION"))
-    )
-processed_df = process_df(df)
+city = select_city()
+city_data = get_city(city)
+city_config = city_data["config"]
+processed_df = city_data["processed_df"]
+gdf_ine = city_data["gdf_ine"]
+grid_index = get_city_resource(city, "grid_index")
+intervention_index = get_city_resource(city, "intervention_index")
 print(gdf_ine)
 #st.write(df)
 # Streamlit App Logic
 st.title("Map Drawing and Geometry Capture")
 
+area_weighted = st.toggle(
+    "Area-weighted averages",
+    help="Weight each census tract by the fraction of its area covered by the selection instead of counting any touching census tract in full."
+)
+
+metric_columns = fc.get_metric_columns(processed_df)
+metric = st.selectbox(
+    "Metric",
+    options=metric_columns,
+    index=metric_columns.index("UNITPRICE_ASKING") if "UNITPRICE_ASKING" in metric_columns else 0,
+    help="All metrics are aggregated together, so switching metric does not recompute the series."
+)
+
+typology_options = list(processed_df["ADTYPOLOGY"].cat.categories)
+typologies = st.multiselect(
+    "Typology",
+    options=typology_options,
+    help="Only include these typologies. Leave empty to include all of them."
+)
+typology_breakdown = st.toggle("Per-typology curves", help="Add one curve per typology for the selected census tracts.")
+confidence_bands = st.toggle(
+    "Confidence bands",
+    help="Shade the bootstrap confidence band of each average curve, resampling its census tracts."
+)
+
+period_index = get_city_resource(city, "period_index")
+period_range = st.select_slider(
+    "Period",
+    options=list(period_index),
+    value=(period_index[0], period_index[-1]),
+    format_func=str,
+    help="Only aggregate, fit and plot the quarters in this range."
+)
+# The full span is the default view, whose series and trends are shared with the other pages
+if period_range == (period_index[0], period_index[-1]):
+    period_range = None
+
+approximate_lookup = st.toggle(
+    "Instant approximate lookup",
+    help="Find the census tracts of the drawn shapes with a precomputed grid, then refine them with the exact geometry in the background."
+)
+
+@st.fragment(run_every=1)
+def wait_for_refinement(refine_future):
+    if refine_future.done():
+        st.rerun()
+    st.caption("Showing approximate census tracts, refining with the exact geometry...")
+
 left, right = st.columns([1,1])  # You can adjust these numbers to your preference
 
 with left:
     # First container for the Folium map
     st.subheader("Map")
 
-    # Create and display the map
-    m = folium.Map(location=[41.40463, 2.17924], zoom_start=13, tiles='cartodbpositron')
-    Draw().add_to(m)
-
-    folium.plugins.Fullscreen(
-        position="bottomleft",
-        title="Expand me",
-        title_cancel="Exit me",
-        force_separate_button=True,
-    ).add_to(m)
+    # Create and display the map; it is the same on every rerun, so the browser keeps it
+    m = fc.build_base_map(city_config)
 
-    output = st_folium(m, width=600,height = 500)  # Adjust the width if necessary
+    output = st_folium(m, width=600,height = 500, key="dataset_map")  # Adjust the width if necessary
 
     # Process and display the drawn geometries
     geometry_collection = None  # Define a default value
     if output and output["all_drawings"]:
-        drawn_geometries = [fc.transform_geometry(geo_json['geometry']) for geo_json in output["all_drawings"]]
+        drawn_geometries = [fc.transform_geometry(geo_json['geometry'], city_config["crs"]) for geo_json in output["all_drawings"]]
         geometry_collection = fc.GeometryCollection(drawn_geometries)
-        st.write("Captured Geometries in UTM (EPSG:25831):")
+        st.write(f"Captured Geometries in {city_config['crs']}:")
         st.write(geometry_collection)
     else:
         st.write("No geometries drawn yet.")
 
     # Handle census tracts based on drawn geometries
-    if geometry_collection:
+    lookup_weights = None
+    if geometry_collection and approximate_lookup:
+        # Answer from the grid pre-index until the exact refinement is done
+        refine_key = (city, geometry_collection.wkb_hex)
+        if st.session_state.get("refine_key") != refine_key:
+            st.session_state["refine_key"] = refine_key
+            st.session_state["refine_future"] = fc.refine_censustracts_in_background(geometry_collection, gdf_ine)
+
+        if st.session_state["refine_future"].done():
+            lookup_weights = st.session_state["refine_future"].result()
+        else:
+            lookup_weights = fc.query_grid_index(grid_index, geometry_collection, gdf_ine.crs)
+        my_censustracts = lookup_weights.index.tolist()
+    elif geometry_collection:
         my_censustracts = fc.get_impacted_censustracts(geometry_collection, gdf_ine)
     else:
         st.warning("No geometry has been drawn, so no census tracts can be impacted.")
@@ -195,47 +189,34 @@ with right:
     st.subheader("Time Series")
 
 
-    # Ensure 'CENSUSTRACT' in processed_df is a string
-    processed_df['CENSUSTRACT'] = processed_df['CENSUSTRACT'].astype(str).str.zfill(10)
-
-
-    # Ensure 'CENSUSTRACT' in gdf_ine is a string and properly zero-padded
-    gdf_ine['CENSUSTRACT'] = gdf_ine['CENSUSTRACT'].astype(str).str.zfill(10)
-
-    # Ensure my_censustracts is a list of zero-padded strings
-    my_censustracts = [str(ct).zfill(10) for ct in my_censustracts]
-
-    # Filter the processed_df based on the modified my_censustracts
-    filtered_df = processed_df[
-        processed_df['CENSUSTRACT'].str.zfill(10).isin(my_censustracts)
-    ]
-
-    # Perform the join to include the geometry column from gdf_ine
-    filtered_gdf = filtered_df.merge(
-        gdf_ine[['CENSUSTRACT', 'geometry']],  # Select only necessary columns from gdf_ine
-        on='CENSUSTRACT',                     # Join on 'CENSUSTRACT'
-        how='inner'                           # Inner join to include only matching rows
-    )
-
-    # Ensure the result is a GeoDataFrame
-
-    filtered_gdf = gpd.GeoDataFrame(filtered_gdf, geometry='geometry')
-
+    # Covered fraction of each census tract, for area-weighted averages
+    impacted_weights = None
+    if area_weighted and lookup_weights is not None:
+        impacted_weights = lookup_weights
+    elif area_weighted and geometry_collection:
+        impacted_weights = fc.get_censustract_overlap_weights(geometry_collection, gdf_ine)
 
     # Price type filter
     price_type = 'Both'
     print(my_censustracts)
-    print(filtered_gdf)
     try:
     # Create and display the chart
         chart = fc.plot_timeseries(
             processed_df,
-            interventions_gdf,
-            filtered_gdf,
+            intervention_index,
+            None,
             gdf_ine,
             price_type=price_type.lower(),
             district = False,
             control_polygon = False,
+            area_weighted = area_weighted,
+            impacted_weights = impacted_weights,
+            metric = metric,
+            typologies = typologies,
+            typology_breakdown = typology_breakdown,
+            confidence_bands = confidence_bands,
+            period_range = period_range,
+            impacted_censustracts = my_censustracts,
             SALE_COLOR = SALE_COLOR,
             RENT_COLOR = RENT_COLOR, 
             CONTROL_SALE = CONTROL_SALE,
@@ -246,6 +227,32 @@ with right:
         if chart is not None:
             st.plotly_chart(chart, use_container_width=True, height=600)
 
+        if lookup_weights is not None and not st.session_state["refine_future"].done():
+            wait_for_refinement(st.session_state["refine_future"])
+
     except Exception as e:
     
         pass
+
+    # Downloads are written chunk by chunk when clicked, from the selected census tracts
+    st.subheader("Download")
+    export_format = st.radio("Format", options=list(fc.EXPORT_FORMATS), format_func=str.upper, horizontal=True)
+    listings_column, series_column = st.columns([1, 1])
+    listings_column.download_button(
+        "Listings",
+        data=lambda: fc.export_listings(processed_df, my_censustracts, export_format, period_range),
+        file_name=f"listings.{export_format}",
+        mime=fc.EXPORT_FORMATS[export_format],
+        on_click="ignore",
+        disabled=not my_censustracts,
+        help="The listings of the selected census tracts and period.",
+    )
+    series_column.download_button(
+        "Time series",
+        data=lambda: fc.export_timeseries(processed_df, my_censustracts, export_format, impacted_weights, period_range),
+        file_name=f"timeseries.{export_format}",
+        mime=fc.EXPORT_FORMATS[export_format],
+        on_click="ignore",
+        disabled=not my_censustracts,
+        help="The mean time series of every metric of the selected census tracts.",
+    )
@@ -0,0 +1,359 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+import io
+import json
+import time
+from typing import Dict, List, Optional, Tuple, Union
+
+import geopandas as gpd
+from loguru import logger
+import numpy as np
+import pandas as pd
+import pyarrow.dataset as ds
+from shapely.geometry import GeometryCollection, shape
+import typer
+
+from streamlit_idealista import functions as fc
+from streamlit_idealista.cities import get_city
+from streamlit_idealista.config import (
+    API_HOST,
+    API_PORT,
+    API_WORKERS,
+    CITIES,
+    DEFAULT_CITY,
+    INPUT_PARTITIONED_DATA_PATH,
+    WARM_UP_METRIC,
+    WARM_UP_TRENDS,
+)
+from streamlit_idealista.dataset import (
+    get_geometry_path,
+    load_censustract_geojson,
+    load_interventions,
+    open_partitioned_listings,
+)
+from streamlit_idealista.warmup import get_default_selections, warm_up_series
+
+app = typer.Typer()
+
+ARROW_CONTENT_TYPE = "application/vnd.apache.arrow.stream"
+
+
+class QueryError(Exception):
+    """Invalid request, reported to the client as 400 Bad Request."""
+
+
+class QueryService:
+    """
+    Answers impacted census tract and time series queries over the datasets
+    loaded in this process.
+
+    Aggregations and Prophet fits run in a thread pool, so the event loop keeps
+    accepting requests, and they go through the same aggregate and trend caches
+    as the dashboard pages. Identical trend fits requested concurrently are
+    only computed once.
+
+    The service reports healthy once warm_up has run.
+
+    Args:
+      processed_df (Union[pd.DataFrame, ds.Dataset]): The processed listings,
+        or the partitioned listings, read per request.
+      gdf_ine (gpd.GeoDataFrame): The censustracts and their polygons.
+      workers (int): Size of the thread pool.
+      interventions_gdf (Optional[gpd.GeoDataFrame]): The interventions whose
+        series are warmed up; None if the city has no intervention layer.
+    """
+
+    def __init__(
+        self,
+        processed_df: Union[pd.DataFrame, ds.Dataset],
+        gdf_ine: gpd.GeoDataFrame,
+        workers: int = API_WORKERS,
+        interventions_gdf: Optional[gpd.GeoDataFrame] = None,
+    ):
+        # The listings are shared with the dashboard as loaded, so they hit the
+        # same cache entries; requests are converted to their census tract format
+        self.processed_df = processed_df
+        self.gdf_ine = gdf_ine
+        self.interventions_gdf = interventions_gdf
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="api")
+        self._inflight_trends: Dict[str, asyncio.Future] = {}
+        self.warm = False
+        self.warm_up_error: Optional[str] = None
+
+    def format_censustracts(self, censustracts: List) -> List[str]:
+        """Convert census tracts to the format of the listings: zero-padded to 10
+        digits in the partitioned listings, unpadded (as in gdf_ine) otherwise."""
+        censustracts = [str(int(ct)) for ct in censustracts]
+        if isinstance(self.processed_df, ds.Dataset):
+            return [ct.zfill(10) for ct in censustracts]
+        return censustracts
+
+    async def run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    def warm_up(self, metric: str = WARM_UP_METRIC, trends: bool = WARM_UP_TRENDS):
+        """Compute the aggregate cube of the metric and the series (and trends)
+        of the default views (see warmup.warm_up_series), then report healthy."""
+        try:
+            start = time.perf_counter()
+            if isinstance(self.processed_df, pd.DataFrame):
+                fc.get_cached_cube(self.processed_df, metric)
+            selections = {
+                name: self.format_censustracts(censustracts)
+                for name, censustracts in get_default_selections(self.gdf_ine, self.interventions_gdf).items()
+            }
+            n_series = warm_up_series(self.processed_df, selections, metric, trends)
+            logger.success(f"Warm-up done in {time.perf_counter() - start:.1f}s ({n_series} series)")
+        except Exception as e:
+            logger.exception("Warm-up failed")
+            self.warm_up_error = str(e)
+        else:
+            self.warm = True
+
+    def parse_geometry(self, payload: dict):
+        """Read a GeoJSON geometry, Feature or FeatureCollection in the CRS given by
+        payload["crs"] (EPSG:4326 by default) and reproject it to the censustracts CRS."""
+        geojson = payload.get("geometry")
+        if geojson is None:
+            return None
+        try:
+            if geojson.get("type") == "FeatureCollection":
+                geometry = GeometryCollection([shape(feature["geometry"]) for feature in geojson["features"]])
+            elif geojson.get("type") == "Feature":
+                geometry = shape(geojson["geometry"])
+            else:
+                geometry = shape(geojson)
+        except (AttributeError, KeyError, TypeError, ValueError) as e:
+            raise QueryError(f"Invalid GeoJSON geometry: {e}") from e
+
+        crs = payload.get("crs", "EPSG:4326")
+        return gpd.GeoSeries([geometry], crs=crs).to_crs(self.gdf_ine.crs).iloc[0]
+
+    async def resolve_censustracts(self, payload: dict) -> Tuple[List[str], Optional[pd.Series]]:
+        """Get the census tracts (and weights, if area_weighted) of a request,
+        either given as a list or as a GeoJSON geometry, in the format of the listings."""
+        if payload.get("censustracts") is not None:
+            return self.format_censustracts(payload["censustracts"]), None
+
+        geometry = self.parse_geometry(payload)
+        if geometry is None:
+            raise QueryError("Either 'censustracts' or 'geometry' must be given")
+
+        if payload.get("area_weighted", False):
+            weights = await self.run(fc.get_censustract_overlap_weights, geometry, self.gdf_ine)
+            weights.index = self.format_censustracts(weights.index)
+            return weights.index.tolist(), weights
+        censustracts = await self.run(fc.get_impacted_censustracts, geometry, self.gdf_ine)
+        return self.format_censustracts(censustracts), None
+
+    def parse_period_range(self, payload: dict) -> Optional[fc.PeriodRange]:
+        """Read the "start" and "end" quarters (e.g. "2016Q1") of a request; None if neither is given."""
+        start, end = payload.get("start"), payload.get("end")
+        if start is None and end is None:
+            return None
+        try:
+            period_range = tuple(
+                pd.Period(value, freq="Q") if value is not None else None for value in (start, end)
+            )
+        except (TypeError, ValueError) as e:
+            raise QueryError(f"Invalid period: {e}") from e
+        # An open end covers every quarter before or after the other one
+        period_range = (
+            period_range[0] or pd.Period(ordinal=np.iinfo(np.int16).min + 1, freq="Q"),
+            period_range[1] or pd.Period(ordinal=np.iinfo(np.int16).max, freq="Q"),
+        )
+        if period_range[0] > period_range[1]:
+            raise QueryError("'start' must not be after 'end'")
+        return period_range
+
+    async def trend(self, series: pd.Series) -> pd.Series:
+        key = fc.selection_fingerprint(str(series.name), series.round(6).items())
+        if key not in self._inflight_trends:
+            self._inflight_trends[key] = asyncio.ensure_future(self.run(fc.get_cached_trend, series))
+        try:
+            return await asyncio.shield(self._inflight_trends[key])
+        finally:
+            if self._inflight_trends.get(key) is not None and self._inflight_trends[key].done():
+                self._inflight_trends.pop(key, None)
+
+    async def impacted(self, payload: dict) -> dict:
+        censustracts, weights = await self.resolve_censustracts(payload)
+        # Census tracts are answered as 10 digit zero-padded strings
+        response = {"censustracts": [ct.zfill(10) for ct in censustracts]}
+        if weights is not None:
+            response["weights"] = weights.rename(lambda ct: ct.zfill(10)).to_dict()
+        return response
+
+    async def timeseries(self, payload: dict) -> pd.DataFrame:
+        operation = payload.get("operation", "mean")
+        if operation not in ["mean", "median"]:
+            raise QueryError("Operation must be 'mean' or 'median'")
+
+        censustracts, weights = await self.resolve_censustracts(payload)
+        metric = payload.get("metric", "UNITPRICE_ASKING")
+        if metric not in fc.get_metric_columns(self.processed_df):
+            raise QueryError(f"Unknown metric: {metric}")
+
+        period_range = self.parse_period_range(payload)
+        typologies = payload.get("typologies")
+        if typologies:
+            if operation != "mean":
+                raise QueryError("Typology filters only support the 'mean' operation")
+            if isinstance(self.processed_df, ds.Dataset):
+                raise QueryError("Typology filters are not supported on partitioned listings")
+            cube = await self.run(fc.get_cached_cube, self.processed_df, metric)
+            timeseries = await self.run(
+                fc.get_cube_timeseries, cube, censustracts, typologies, weights, False, period_range
+            )
+        else:
+            timeseries = await self.run(
+                fc.get_cached_timeseries, self.processed_df, censustracts, operation, weights, metric, period_range
+            )
+        timeseries = timeseries.rename(columns=str)
+
+        if payload.get("trends", False):
+            columns = list(timeseries.columns)
+            trends = await asyncio.gather(*(self.trend(timeseries[column].dropna()) for column in columns))
+            for column, trend in zip(columns, trends):
+                timeseries[f"trend_{column}"] = trend.reindex(pd.to_datetime(timeseries.index)).values
+
+        return timeseries
+
+    async def handle(self, method: str, path: str, payload: dict) -> Tuple[HTTPStatus, str, bytes]:
+        if method == "GET" and path == "/health":
+            if self.warm_up_error is not None:
+                return json_response({"status": "error", "error": self.warm_up_error}, HTTPStatus.SERVICE_UNAVAILABLE)
+            if not self.warm:
+                return json_response({"status": "warming up"}, HTTPStatus.SERVICE_UNAVAILABLE)
+            return json_response({"status": "ok"})
+        if method == "GET" and path == "/censustracts":
+            return json_response({"censustracts": self.gdf_ine["CENSUSTRACT"].astype(str).str.zfill(10).tolist()})
+        if method == "POST" and path == "/impacted":
+            return json_response(await self.impacted(payload))
+        if method == "POST" and path == "/timeseries":
+            timeseries = await self.timeseries(payload)
+            if payload.get("format", "json") == "arrow":
+                return arrow_response(timeseries)
+            return json_response(json.loads(timeseries.reset_index().to_json(orient="split", index=False)))
+        return json_response({"error": f"Not found: {method} {path}"}, HTTPStatus.NOT_FOUND)
+
+
+def json_response(body: dict, status: HTTPStatus = HTTPStatus.OK) -> Tuple[HTTPStatus, str, bytes]:
+    return status, "application/json", json.dumps(body).encode("utf-8")
+
+
+def arrow_response(df: pd.DataFrame) -> Tuple[HTTPStatus, str, bytes]:
+    import pyarrow as pa
+
+    table = pa.Table.from_pandas(df.reset_index(), preserve_index=False)
+    sink = io.BytesIO()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return HTTPStatus.OK, ARROW_CONTENT_TYPE, sink.getvalue()
+
+
+async def read_request(reader: asyncio.StreamReader) -> Tuple[str, str, dict]:
+    request_line = (await reader.readline()).decode("latin-1").strip()
+    if not request_line:
+        raise ConnectionResetError
+    method, target, _ = request_line.split(" ", 2)
+
+    headers = {}
+    while (line := (await reader.readline()).decode("latin-1").strip()):
+        name, _, value = line.partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+    body = await reader.readexactly(int(headers.get("content-length", 0)))
+    try:
+        payload = json.loads(body) if body else {}
+    except json.JSONDecodeError as e:
+        raise QueryError(f"Invalid JSON body: {e}") from e
+    return method.upper(), target.split("?", 1)[0], payload
+
+
+async def write_response(writer: asyncio.StreamWriter, status: HTTPStatus, content_type: str, body: bytes):
+    head = (
+        f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+        f"Content-Type: {content_type}\r\n"
+        f"Content-Length: {len(body)}\r\n"
+        "Connection: close\r\n\r\n"
+    )
+    writer.write(head.encode("latin-1") + body)
+    await writer.drain()
+
+
+def make_connection_handler(service: QueryService):
+    async def handle_connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            method, path, payload = await read_request(reader)
+            response = await service.handle(method, path, payload)
+        except ConnectionResetError:
+            writer.close()
+            return
+        except (QueryError, ValueError) as e:
+            response = json_response({"error": str(e)}, HTTPStatus.BAD_REQUEST)
+        except Exception as e:
+            logger.exception("Query failed")
+            response = json_response({"error": str(e)}, HTTPStatus.INTERNAL_SERVER_ERROR)
+
+        try:
+            await write_response(writer, *response)
+        finally:
+            writer.close()
+
+    return handle_connection
+
+
+def load_service(workers: int = API_WORKERS, partitioned: bool = False, city: str = DEFAULT_CITY) -> QueryService:
+    if partitioned:
+        city_config = CITIES[city]
+        gdf_ine = load_censustract_geojson(get_geometry_path(city_config["censustract_geojson"]))
+        interventions_path = city_config.get("interventions_geojson")
+        interventions_gdf = load_interventions(get_geometry_path(interventions_path)) if interventions_path else None
+        return QueryService(open_partitioned_listings(INPUT_PARTITIONED_DATA_PATH), gdf_ine, workers, interventions_gdf)
+
+    city_data = get_city(city)
+    return QueryService(city_data["processed_df"], city_data["gdf_ine"], workers, city_data["interventions_gdf"])
+
+
+async def serve(service: QueryService, host: str, port: int, warm_up: bool = True, trends: bool = WARM_UP_TRENDS):
+    server = await asyncio.start_server(make_connection_handler(service), host, port)
+    logger.success(f"Query API listening on http://{host}:{port}")
+    # Requests are served while warming up, but /health only reports ok once it is done
+    if warm_up:
+        asyncio.get_running_loop().run_in_executor(service.executor, service.warm_up, WARM_UP_METRIC, trends)
+    else:
+        service.warm = True
+    async with server:
+        await server.serve_forever()
+
+
+@app.command()
+def main(
+    host: str = API_HOST,
+    port: int = API_PORT,
+    workers: int = API_WORKERS,
+    partitioned: bool = False,
+    city: str = DEFAULT_CITY,
+    warm_up: bool = True,
+    trends: bool = WARM_UP_TRENDS,
+):
+    """
+    Serve the impacted census tracts and time series of a city (see
+    config.CITIES) as a local HTTP API.
+
+    With --partitioned, the listings are read per request from the partitioned
+    Parquet dataset instead of being loaded in memory.
+
+    Once listening, the series (and, with --trends, the trends) of the default
+    views are precomputed; GET /health returns 503 until then. With
+    --no-warm-up, it reports healthy right away.
+    """
+    logger.info(f"Loading datasets of {city}...")
+    service = load_service(workers, partitioned, city)
+    asyncio.run(serve(service, host, port, warm_up, trends))
+
+
+if __name__ == "__main__":
+    app()
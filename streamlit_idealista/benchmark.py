@@ -0,0 +1,279 @@
+from concurrent.futures import ThreadPoolExecutor
+import gc
+import gzip
+import io
+import json
+import time
+import tracemalloc
+from typing import List
+import urllib.request
+
+import geopandas as gpd
+from loguru import logger
+import numpy as np
+import pandas as pd
+import typer
+
+from streamlit_idealista.config import (
+    API_HOST,
+    API_PORT,
+    CITIES,
+    DEFAULT_CITY,
+    INPUT_DATA_PATH,
+    INPUT_DTYPES_COUPLED_JSON_PATH,
+    INPUT_OPERATION_TYPES_PATH,
+    INPUT_TYPOLOGY_TYPES_PATH,
+)
+from streamlit_idealista.dataset import (
+    load_dtypes,
+    load_main_data,
+    load_operation_types,
+    load_typology_types,
+    process_df,
+    read_main_data,
+)
+from streamlit_idealista.functions import (
+    AGGREGATION_STATISTICS,
+    get_layer_topojson,
+    get_metric_columns,
+    get_multi_metric_timeseries,
+    get_polars_listings,
+)
+
+app = typer.Typer()
+
+# Relative tolerance of the comparison of the pandas and Polars backends
+BACKEND_RTOL = 1e-12
+
+
+def summarize_latencies(name: str, latencies: np.ndarray, elapsed: float):
+    p50, p95, p99 = np.percentile(latencies * 1000, [50, 95, 99])
+    logger.info(
+        f"{name}: {len(latencies)} requests in {elapsed:.2f}s "
+        f"({len(latencies) / elapsed:.1f} req/s), "
+        f"latency p50={p50:.1f}ms p95={p95:.1f}ms p99={p99:.1f}ms"
+    )
+
+
+@app.command()
+def api_load(
+    url: str = f"http://{API_HOST}:{API_PORT}",
+    requests: int = 200,
+    concurrency: int = 16,
+    tracts_per_request: int = 20,
+    distinct_selections: int = 10,
+    trends: bool = False,
+    seed: int = 0,
+):
+    """
+    Load test a running query API (python -m streamlit_idealista.api).
+
+    Requests are spread over a fixed number of distinct random tract selections,
+    so the run measures both cold aggregations and cache hits.
+    """
+    with urllib.request.urlopen(f"{url}/censustracts") as response:
+        censustracts = json.load(response)["censustracts"]
+
+    rng = np.random.default_rng(seed)
+    selections = [
+        rng.choice(censustracts, size=min(tracts_per_request, len(censustracts)), replace=False).tolist()
+        for _ in range(distinct_selections)
+    ]
+
+    def post_timeseries(i: int) -> float:
+        body = json.dumps({"censustracts": selections[i % distinct_selections], "trends": trends})
+        request = urllib.request.Request(
+            f"{url}/timeseries", data=body.encode("utf-8"), headers={"Content-Type": "application/json"}
+        )
+        start = time.perf_counter()
+        with urllib.request.urlopen(request) as response:
+            response.read()
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = np.fromiter(executor.map(post_timeseries, range(requests)), dtype=float)
+    summarize_latencies("POST /timeseries", latencies, time.perf_counter() - start)
+
+
+def join_process_df(
+    df: pd.DataFrame, operation_types_df: pd.DataFrame, typology_types_df: pd.DataFrame
+) -> pd.DataFrame:
+    """The deep copy and join implementation process_df replaced, kept as a baseline."""
+    copy_df = df.copy(deep=True)
+    return (
+        copy_df.astype({"ADOPERATIONID": "int", "ADTYPOLOGYID": "int"})
+        .join(operation_types_df.set_index("ID"), on="ADOPERATIONID", how="left", validate="m:1")
+        .rename(columns={"SHORTNAME": "ADOPERATION"})
+        .astype({"ADOPERATION": "category", "ADOPERATIONID": "category"})
+        .drop(columns=("DESCRIPTION"))
+        .join(typology_types_df.set_index("ID"), on="ADTYPOLOGYID", how="left", validate="m:1")
+        .rename(columns={"SHORTNAME": "ADTYPOLOGY"})
+        .astype({"ADTYPOLOGY": "category", "ADTYPOLOGYID": "category"})
+        .drop(columns=("DESCRIPTION"))
+    )
+
+
+def measure_peak_memory(func, *args):
+    """Run func and return its result, elapsed seconds and peak traced allocation in bytes."""
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func(*args)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+@app.command()
+def process_memory(repeat: int = 1):
+    """
+    Compare the peak memory of process_df with the join-based implementation.
+
+    The listings are concatenated repeat times to simulate a larger city.
+    Only allocations made while decoding are traced, not the loaded input.
+    """
+    dtypes_coupled_dict = load_dtypes(INPUT_DTYPES_COUPLED_JSON_PATH)
+    df = load_main_data(INPUT_DATA_PATH, dtypes_coupled_dict)
+    if repeat > 1:
+        df = pd.concat([df] * repeat, ignore_index=True)
+    operation_types_df = load_operation_types(INPUT_OPERATION_TYPES_PATH, dtypes_coupled_dict)
+    typology_types_df = load_typology_types(INPUT_TYPOLOGY_TYPES_PATH, dtypes_coupled_dict)
+
+    input_bytes = df.memory_usage(deep=True).sum()
+    logger.info(f"{len(df)} listings, {input_bytes / 2**20:.1f} MiB in memory")
+
+    results = {}
+    for name, func in [("join", join_process_df), ("decode", process_df)]:
+        results[name], elapsed, peak = measure_peak_memory(func, df, operation_types_df, typology_types_df)
+        logger.info(
+            f"{name}: {elapsed:.2f}s, peak {peak / 2**20:.1f} MiB "
+            f"({peak / input_bytes:.2f}x the input)"
+        )
+
+    for column in ["ADOPERATIONID", "ADTYPOLOGYID", "ADOPERATION", "ADTYPOLOGY"]:
+        expected = results["join"][column].astype(str)
+        if not expected.equals(results["decode"][column].astype(str)):
+            logger.warning(f"{column} differs between the implementations")
+
+
+def time_best(func, *args, repeat: int = 3):
+    """Run func repeat times and return its last result and the best elapsed seconds."""
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        best = min(best, time.perf_counter() - start)
+    return result, best
+
+
+@app.command()
+def geometry_payload(city: str = DEFAULT_CITY, repeat: int = 3):
+    """
+    Compare the parse time of the GeoJSON and GeoParquet geometry layers of a
+    city, and the bytes sent to the browser as full precision GeoJSON and as
+    quantized TopoJSON.
+
+    The files are read into memory first, so only parsing is timed.
+    """
+    city_config = CITIES[city]
+    layers = {"censustracts": city_config["censustract_geojson"], "interventions": city_config.get("interventions_geojson")}
+
+    for name, geojson_path in layers.items():
+        if geojson_path is None:
+            continue
+        geojson_bytes = geojson_path.read_bytes()
+        gdf, geojson_seconds = time_best(lambda: gpd.read_file(io.BytesIO(geojson_bytes)), repeat=repeat)
+
+        parquet_sink = io.BytesIO()
+        gdf.to_parquet(parquet_sink, index=False)
+        parquet_bytes = parquet_sink.getvalue()
+        _, parquet_seconds = time_best(lambda: gpd.read_parquet(io.BytesIO(parquet_bytes)), repeat=repeat)
+
+        logger.info(
+            f"{name}: {len(gdf)} geometries, parse GeoJSON {geojson_seconds:.3f}s ({len(geojson_bytes) / 2**20:.1f} MiB), "
+            f"GeoParquet {parquet_seconds:.3f}s ({len(parquet_bytes) / 2**20:.1f} MiB)"
+        )
+
+        columns = ["TITOL_WO"] if "TITOL_WO" in gdf.columns else []
+        payloads = {
+            "GeoJSON": gdf[[*columns, "geometry"]].to_crs("EPSG:4326").to_json(drop_id=True).encode("utf-8"),
+            "TopoJSON": json.dumps(get_layer_topojson(gdf, name, columns)).encode("utf-8"),
+        }
+        for payload_name, payload in payloads.items():
+            logger.info(
+                f"{name} {payload_name} payload: {len(payload) / 1024:.0f} KiB, "
+                f"{len(gzip.compress(payload)) / 1024:.0f} KiB gzipped"
+            )
+
+
+@app.command()
+def dataframe_backends(
+    scale: List[int] = [1, 100],
+    selections: int = 20,
+    tracts_per_selection: int = 20,
+    repeat: int = 3,
+    seed: int = 0,
+):
+    """
+    Compare the pandas and Polars backends (DATAFRAME_BACKEND) on loading the
+    listings CSV and on aggregating random census tract selections into the
+    series of every metric and statistic, at each data scale.
+
+    The listings are repeated scale times, in the CSV and in memory, to
+    simulate a larger city. The outputs of both backends are checked to be
+    equal up to BACKEND_RTOL: the CSV parsers may round floats differently in
+    the last bit, and the reductions sum in different orders.
+    """
+    dtypes_coupled_dict = load_dtypes(INPUT_DTYPES_COUPLED_JSON_PATH)
+    operation_types_df = load_operation_types(INPUT_OPERATION_TYPES_PATH, dtypes_coupled_dict)
+    typology_types_df = load_typology_types(INPUT_TYPOLOGY_TYPES_PATH, dtypes_coupled_dict)
+    csv_bytes = INPUT_DATA_PATH.read_bytes()
+    header, body = csv_bytes.split(b"\n", 1)
+    if not body.endswith(b"\n"):
+        body += b"\n"
+
+    for factor in scale:
+        scaled_csv = header + b"\n" + body * factor
+        loaded = {}
+        for backend in ["pandas", "polars"]:
+            loaded[backend], seconds = time_best(
+                lambda: read_main_data(io.BytesIO(scaled_csv), dtypes_coupled_dict, backend), repeat=repeat
+            )
+            logger.info(f"{factor}x load {backend}: {len(loaded[backend])} listings in {seconds:.2f}s")
+        pd.testing.assert_frame_equal(loaded["pandas"], loaded["polars"], check_exact=False, rtol=BACKEND_RTOL)
+
+        df = process_df(loaded.pop("pandas"), operation_types_df, typology_types_df)
+        del loaded
+        _, seconds = time_best(get_polars_listings, df, repeat=1)
+        logger.info(f"{factor}x conversion to Polars: {seconds:.2f}s (once per dataset version)")
+
+        rng = np.random.default_rng(seed)
+        censustracts = df["CENSUSTRACT"].unique()
+        metrics = get_metric_columns(df)
+        selected = [
+            rng.choice(censustracts, size=min(tracts_per_selection, len(censustracts)), replace=False).tolist()
+            for _ in range(selections)
+        ]
+
+        results = {}
+        for backend in ["pandas", "polars"]:
+            results[backend], seconds = time_best(
+                lambda: [
+                    get_multi_metric_timeseries(df, tracts, metrics, AGGREGATION_STATISTICS, backend=backend)
+                    for tracts in selected
+                ],
+                repeat=repeat,
+            )
+            logger.info(
+                f"{factor}x aggregate {backend}: {selections} selections in {seconds:.2f}s "
+                f"({seconds / selections * 1000:.1f}ms per selection)"
+            )
+        for pandas_result, polars_result in zip(results["pandas"], results["polars"]):
+            pd.testing.assert_frame_equal(pandas_result, polars_result, check_exact=False, rtol=BACKEND_RTOL)
+        logger.success(f"{factor}x: both backends return the same listings and series")
+
+
+if __name__ == "__main__":
+    app()
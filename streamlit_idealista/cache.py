@@ -0,0 +1,236 @@
+from collections import OrderedDict
+import hashlib
+import json
+import sys
+import threading
+import time
+import weakref
+from typing import Any, Callable, Dict, Hashable, Iterable, Optional
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from scipy import sparse
+
+from streamlit_idealista.config import CACHE_POLICIES
+
+
+def selection_fingerprint(*parts: Any) -> str:
+    """
+    Build a stable fingerprint for a selection of census tracts and plot options.
+
+    Iterables (lists, sets, Series) are sorted so that the same selection always
+    produces the same fingerprint regardless of the order of its elements.
+
+    Args:
+      *parts: Tract collections, flags and scalars describing the selection.
+
+    Returns:
+      str: Hex digest identifying the selection.
+    """
+    normalized = []
+    for part in parts:
+        if part is None or isinstance(part, (str, int, float, bool)):
+            normalized.append(part)
+        elif isinstance(part, Iterable):
+            normalized.append(sorted(str(item) for item in part))
+        else:
+            normalized.append(str(part))
+
+    payload = json.dumps(normalized, separators=(",", ":"))
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+
+def estimate_nbytes(value: Any) -> int:
+    """
+    Estimate the memory held by a cached value: pandas and Polars dataframes,
+    Arrow tables, arrays, sparse matrices and dicts, lists or tuples of them.
+
+    Args:
+      value: The cached value.
+
+    Returns:
+      int: Approximate size in bytes.
+    """
+    if isinstance(value, (pd.DataFrame, pd.Series, pd.Index)):
+        usage = value.memory_usage(deep=True)
+        return int(usage.sum() if isinstance(usage, pd.Series) else usage)
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if sparse.issparse(value):
+        value = value.tocsr()
+        return value.data.nbytes + value.indices.nbytes + value.indptr.nbytes
+    if isinstance(value, (pa.Table, pa.RecordBatch)):
+        return value.nbytes
+    if hasattr(value, "estimated_size"):
+        # Polars dataframes and series
+        return int(value.estimated_size())
+    if isinstance(value, dict):
+        return sum(estimate_nbytes(item) for item in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(estimate_nbytes(item) for item in value)
+    return sys.getsizeof(value)
+
+
+class LRUCache:
+    """
+    Small in-process least-recently-used cache, safe to share between the
+    Streamlit sessions and worker threads of the process.
+
+    Named caches are registered in CACHE_REGISTRY, so they can be inspected
+    and evicted from the cache inspector page.
+
+    Args:
+      max_entries (int): Maximum number of entries kept before evicting
+        the least recently used one.
+      max_bytes (Optional[int]): Memory budget; least recently used entries are
+        evicted while the total size is over it, keeping at least the newest one.
+      ttl (Optional[float]): Seconds after which an entry expires; never if None.
+      sizeof (Callable[[Any], int]): Size in bytes of a value.
+      name (Optional[str]): Name of the cache in CACHE_REGISTRY.
+    """
+
+    def __init__(self,
+                 max_entries: int = 64,
+                 max_bytes: Optional[int] = None,
+                 ttl: Optional[float] = None,
+                 sizeof: Callable[[Any], int] = estimate_nbytes,
+                 name: Optional[str] = None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sizeof = sizeof
+        self.name = name
+        self._entries = OrderedDict()
+        # Size in bytes, insertion time and hits of each entry
+        self._stats: Dict[Hashable, dict] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.nbytes = 0
+        if name is not None:
+            CACHE_REGISTRY[name] = self
+
+    def _is_expired(self, key: Hashable, now: float) -> bool:
+        return self.ttl is not None and now - self._stats[key]["created"] > self.ttl
+
+    def _evict(self, key: Hashable) -> None:
+        del self._entries[key]
+        self.nbytes -= self._stats.pop(key)["nbytes"]
+        self.evictions += 1
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            if key in self._entries and self._is_expired(key, time.monotonic()):
+                self._evict(key)
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            self._stats[key]["hits"] += 1
+            return self._entries[key]
+
+    def put(self, key: Hashable, value: Any) -> None:
+        size = self.sizeof(value)
+        with self._lock:
+            now = time.monotonic()
+            previous = self._stats.get(key, {"nbytes": 0, "hits": 0})
+            self.nbytes += size - previous["nbytes"]
+            self._entries[key] = value
+            self._stats[key] = {"nbytes": size, "created": now, "hits": previous["hits"]}
+            self._entries.move_to_end(key)
+
+            for expired_key in [k for k in self._entries if k != key and self._is_expired(k, now)]:
+                self._evict(expired_key)
+            while len(self._entries) > self.max_entries or (
+                self.max_bytes is not None and self.nbytes > self.max_bytes and len(self._entries) > 1
+            ):
+                self._evict(next(iter(self._entries)))
+
+    def pop(self, key: Hashable) -> None:
+        """Evict an entry, if present."""
+        with self._lock:
+            if key in self._entries:
+                self._evict(key)
+
+    def clear(self) -> None:
+        with self._lock:
+            self.evictions += len(self._entries)
+            self._entries.clear()
+            self._stats.clear()
+            self.nbytes = 0
+
+    def entries(self) -> pd.DataFrame:
+        """
+        Get the entries of the cache, least recently used first.
+
+        Returns:
+          pd.DataFrame: The KEY, NBYTES, AGE (seconds since inserted) and HITS of each entry.
+        """
+        with self._lock:
+            now = time.monotonic()
+            return pd.DataFrame(
+                [(str(key), stats["nbytes"], now - stats["created"], stats["hits"]) for key, stats in self._stats.items()],
+                columns=["KEY", "NBYTES", "AGE", "HITS"],
+            )
+
+    @property
+    def hit_rate(self) -> float:
+        requests = self.hits + self.misses
+        return self.hits / requests if requests else float("nan")
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+# Named caches of the process, by name
+CACHE_REGISTRY: Dict[str, LRUCache] = {}
+
+# Content digests of the dataframes of the process, by id; an entry is dropped
+# when its dataframe is garbage collected, so a reused id never gets it
+_FRAME_VERSIONS: Dict[int, str] = {}
+_FRAME_VERSIONS_LOCK = threading.Lock()
+
+
+def get_frame_version(df: pd.DataFrame) -> str:
+    """
+    Get the content digest of a dataframe: its shape, columns and the hash of
+    every row. It is computed on the first call for each dataframe object
+    (e.g. when a city is loaded) and looked up afterwards.
+
+    Dataframes are treated as immutable once versioned, as the shared city
+    datasets are.
+
+    Args:
+      df (pd.DataFrame): The dataframe.
+
+    Returns:
+      str: Hex digest identifying the dataframe contents.
+    """
+    version = _FRAME_VERSIONS.get(id(df))
+    if version is None:
+        row_hashes = pd.util.hash_pandas_object(df, index=False).values
+        version = selection_fingerprint(str(df.shape), list(df.columns), hashlib.sha1(row_hashes.tobytes()).hexdigest())
+        with _FRAME_VERSIONS_LOCK:
+            if id(df) not in _FRAME_VERSIONS:
+                _FRAME_VERSIONS[id(df)] = version
+                weakref.finalize(df, _FRAME_VERSIONS.pop, id(df), None)
+    return version
+
+
+def make_cache(name: str) -> LRUCache:
+    """
+    Create a named cache with its policy from config.CACHE_POLICIES.
+
+    Args:
+      name (str): Name of the cache, a key of CACHE_POLICIES.
+
+    Returns:
+      LRUCache: The cache, registered in CACHE_REGISTRY.
+    """
+    return LRUCache(name=name, **CACHE_POLICIES[name])
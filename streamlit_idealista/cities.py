@@ -0,0 +1,189 @@
+import threading
+from typing import Any, Callable, Dict
+
+import pandas as pd
+import streamlit as st
+
+from streamlit_idealista import functions as fc
+from streamlit_idealista.cache import get_frame_version, make_cache
+from streamlit_idealista.config import (
+    CITIES,
+    DEFAULT_CITY,
+    INPUT_DTYPES_COUPLED_JSON_PATH,
+    INPUT_OPERATION_TYPES_PATH,
+    INPUT_TYPOLOGY_TYPES_PATH,
+)
+from streamlit_idealista.dataset import (
+    get_geometry_path,
+    load_censustract_geojson,
+    load_dtypes,
+    load_interventions,
+    load_main_data,
+    load_operation_types,
+    load_typology_types,
+    process_df,
+)
+
+# Loaded cities, shared by every session of the process and unloaded least
+# recently used first once over the memory budget
+CITY_CACHE = make_cache("cities")
+_CITY_LOCKS: Dict[str, threading.Lock] = {city: threading.Lock() for city in CITIES}
+
+
+def load_city(city: str) -> dict:
+    """
+    Load the datasets of a city of the registry (config.CITIES).
+
+    Args:
+      city (str): Key of the city in CITIES.
+
+    Returns:
+      dict: The city "config", its "processed_df" listings, "gdf_ine" census
+        tracts and "interventions_gdf" (None if the city has no intervention
+        layer), and the "dataset_version" of the listings, hashed once here
+        and looked up by the caches keyed on it.
+    """
+    city_config = CITIES[city]
+    dtypes_coupled_dict = load_dtypes(INPUT_DTYPES_COUPLED_JSON_PATH)
+    df = load_main_data(city_config["data_path"], dtypes_coupled_dict)
+    operation_types_df = load_operation_types(INPUT_OPERATION_TYPES_PATH, dtypes_coupled_dict)
+    typology_types_df = load_typology_types(INPUT_TYPOLOGY_TYPES_PATH, dtypes_coupled_dict)
+
+    interventions_path = city_config.get("interventions_geojson")
+    processed_df = process_df(df, operation_types_df, typology_types_df)
+    return {
+        "config": city_config,
+        "processed_df": processed_df,
+        "dataset_version": get_frame_version(processed_df),
+        "gdf_ine": load_censustract_geojson(get_geometry_path(city_config["censustract_geojson"])),
+        "interventions_gdf": load_interventions(get_geometry_path(interventions_path)) if interventions_path else None,
+    }
+
+
+def get_city(city: str) -> dict:
+    """
+    Get the datasets of a city, loading them on first use.
+
+    Concurrent sessions asking for the same city wait for a single load.
+    """
+    if city not in CITIES:
+        raise KeyError(f"Unknown city: {city}. Available cities: {sorted(CITIES)}")
+
+    city_data = CITY_CACHE.get(city)
+    if city_data is None:
+        with _CITY_LOCKS[city]:
+            city_data = CITY_CACHE.get(city)
+            if city_data is None:
+                city_data = load_city(city)
+                CITY_CACHE.put(city, city_data)
+    return city_data
+
+
+def get_city_resource(city: str, name: str) -> Any:
+    """
+    Get an index derived from the datasets of a city (grid index, intervention
+    index, ...), building it on first use with its builder in CITY_RESOURCES.
+
+    Resources are stored with the city, so they count towards its memory and
+    are unloaded with it.
+
+    Args:
+      city (str): Key of the city in CITIES.
+      name (str): Name of the resource in CITY_RESOURCES.
+    """
+    build = CITY_RESOURCES[name]
+    city_data = get_city(city)
+    if name not in city_data:
+        with _CITY_LOCKS[city]:
+            if name not in city_data:
+                city_data[name] = build(city_data)
+                # Account for the memory of the new resource
+                CITY_CACHE.put(city, city_data)
+    return city_data[name]
+
+
+def empty_intervention_index() -> pd.DataFrame:
+    """Intervention index of a city without an intervention layer."""
+    return pd.DataFrame({
+        "CENSUSTRACT": pd.Series(dtype=str),
+        "START": pd.Series(dtype="datetime64[ns]"),
+        "END": pd.Series(dtype="datetime64[ns]"),
+        "TITOL_WO": pd.Series(dtype=str),
+        "SHORTNAME": pd.Series(dtype=str),
+    })
+
+
+def build_intervention_index(city_data: dict) -> pd.DataFrame:
+    if city_data["interventions_gdf"] is None:
+        return empty_intervention_index()
+    return fc.build_intervention_index(city_data["interventions_gdf"])
+
+
+def build_tract_layer(city_data: dict) -> dict:
+    gdf_ine = city_data["gdf_ine"]
+    return fc.get_layer_topojson(
+        gdf_ine.assign(CENSUSTRACT=gdf_ine["CENSUSTRACT"].astype(str).str.zfill(10)),
+        "censustracts",
+        ["CENSUSTRACT"],
+    )
+
+
+def get_projected_tracts(city_data: dict):
+    # Shared by the resources measuring in meters, projected by the first one built
+    if "gdf_ine_projected" not in city_data:
+        city_data["gdf_ine_projected"] = fc.project_censustracts(city_data["gdf_ine"])
+    return city_data["gdf_ine_projected"]
+
+
+def build_sql_tables(city_data: dict) -> dict:
+    # The SQL console dependencies are only imported by its page
+    from streamlit_idealista import sql_console
+
+    intervention_index = city_data.get("intervention_index")
+    if intervention_index is None:
+        intervention_index = build_intervention_index(city_data)
+    return sql_console.build_sql_tables(city_data, intervention_index)
+
+
+# Builders of the resources derived from the datasets of a city, by name (see
+# get_city_resource), shared by the pages and the warm-up
+CITY_RESOURCES: Dict[str, Callable[[dict], Any]] = {
+    "intervention_index": build_intervention_index,
+    "period_index": lambda data: fc.get_period_index(data["processed_df"]),
+    "grid_index": lambda data: fc.build_grid_index(data["gdf_ine"]),
+    "gdf_ine_4326": lambda data: data["gdf_ine"].to_crs("EPSG:4326"),
+    "gdf_ine_projected": get_projected_tracts,
+    "tract_layer": build_tract_layer,
+    "sql_tables": build_sql_tables,
+    "interventions_gdf_4326": lambda data: data["interventions_gdf"].to_crs("EPSG:4326"),
+    "intervention_layer": lambda data: fc.get_layer_topojson(data["interventions_gdf"], "interventions", ["TITOL_WO"]),
+    "intervention_overlap_matrix": lambda data: fc.build_intervention_overlap_matrix(data["interventions_gdf"], get_projected_tracts(data)),
+    "intervention_tract_bitmaps": lambda data: fc.build_intervention_tract_bitmaps(data["interventions_gdf"], data["gdf_ine"]),
+}
+# The resources only defined for cities with an intervention layer
+INTERVENTION_RESOURCES = [
+    "interventions_gdf_4326",
+    "intervention_layer",
+    "intervention_overlap_matrix",
+    "intervention_tract_bitmaps",
+]
+
+
+def select_city() -> str:
+    """
+    Show the city selector in the sidebar and return the selected city.
+
+    The selection is kept in the session, so it is shared by all the pages.
+    """
+    cities = list(CITIES)
+    if st.session_state.get("city") not in CITIES:
+        st.session_state["city"] = DEFAULT_CITY if DEFAULT_CITY in CITIES else cities[0]
+
+    city = st.sidebar.selectbox(
+        "City",
+        options=cities,
+        index=cities.index(st.session_state["city"]),
+        format_func=lambda key: CITIES[key]["name"],
+    )
+    st.session_state["city"] = city
+    return city
@@ -46,6 +46,45 @@ INPUT_TYPOLOGY_TYPES_PATH = PROCESSED_DATA_DIR / "full/dimension-table_data-t-ad
 
 INPUT_INE_CENSUSTRACT_GEOJSON = PROCESSED_DATA_DIR / "censustracts_geometries.geojson"
 
+# Geometry layers are read from the GeoJSON files, or with "geoparquet" from the
+# GeoParquet files written next to them by `python -m streamlit_idealista.dataset geometries`
+GEOMETRY_FORMAT = os.getenv("GEOMETRY_FORMAT", "geojson")
+
+# City registry. Each city has its own listings, census tract geometries and
+# (optional) intervention layer; the dimension tables and dtypes are shared.
+# "crs" is the CRS of the census tract geometries, drawn shapes are projected to it.
+CITIES = {
+    "barcelona": {
+        "name": "Barcelona",
+        "data_path": INPUT_DATA_PATH,
+        "censustract_geojson": INPUT_INE_CENSUSTRACT_GEOJSON,
+        "interventions_geojson": INPUT_SUPERILLES_INTERVENTIONS_GEOJSON,
+        "center": [41.40463, 2.17924],
+        "zoom": 13,
+        "crs": "EPSG:25830",
+    },
+}
+DEFAULT_CITY = os.getenv("DEFAULT_CITY", "barcelona")
+# Memory budget of the loaded cities; least recently used ones are unloaded past it
+CITY_CACHE_MAX_BYTES = int(os.getenv("CITY_CACHE_MAX_BYTES", 4 * 2**30))
+
+# Listings stored as Parquet, hive-partitioned by the province and municipality
+# prefix of the 10 digit CENSUSTRACT (see `python -m streamlit_idealista.dataset partition`)
+INPUT_PARTITIONED_DATA_PATH = PROCESSED_DATA_DIR / "partitioned/02-metricas-de-mercado"
+CENSUSTRACT_PARTITION_COLUMN = "MUNICIPALITY"
+CENSUSTRACT_PARTITION_PREFIX_LENGTH = 5
+
+# Column of the interventions layer holding the short display names, if any
+INTERVENTIONS_SHORTNAME_COLUMN = "SHORTNAME"
+INTERVENTIONS_SHORTNAME_MAX_LENGTH = 30
+
+# Projected CRS used for areas and distances
+PROJECTED_CRS = "EPSG:25831"
+
+# Grid pre-index for approximate lookups of drawn shapes (cell sizes in meters)
+GRID_INDEX_RESOLUTIONS = [50, 100, 200, 400]
+GRID_INDEX_MAX_QUERY_CELLS = 20000
+
 
 SAVE_OUTPUT = False
 OUTPUT_DATA_PATH = PROCESSED_DATA_DIR / "full/"
@@ -60,6 +99,108 @@ INTERVENTION_COLOR = '#EE8A82'
 INTERSECT_COLOR = '#A68A82'
 TREND_LINE = 'dot'
 
+# Grid positions per axis of the TopoJSON layers sent to the maps (about 0.1 m in a city)
+TOPOJSON_QUANTIZATION = 100_000
+
+# Edges in meters (of PROJECTED_CRS) of the distance rings of census tracts
+# around the selected interventions: 0-250 m, 250-500 m and 500-1000 m
+IMPACT_RING_EDGES = [0, 250, 500, 1000]
+
+# Styles of the map layers
+MAP_LAYER_STYLES = {
+    "interventions": {"fillColor": "grey", "color": "grey", "weight": 1, "fillOpacity": 0.3},
+    "selected": {"fillColor": INTERVENTION_COLOR, "color": INTERVENTION_COLOR, "weight": 2, "fillOpacity": 0.6},
+    "impacted": {"fillColor": INTERSECT_COLOR, "color": INTERSECT_COLOR, "weight": 1, "fillOpacity": 0.4},
+    "district": {"fillColor": CONTROL_COLOR, "color": CONTROL_COLOR, "weight": 1, "fillOpacity": 0.3},
+    "control": {"fillColor": CONTROL_COLOR, "color": CONTROL_COLOR, "weight": 1, "fillOpacity": 0.3},
+    # One style per distance ring, fading with the distance
+    **{
+        f"ring_{i}": {"fillColor": INTERSECT_COLOR, "color": INTERSECT_COLOR, "weight": 1,
+                      "fillOpacity": 0.3 * (1 - i / (len(IMPACT_RING_EDGES) - 1))}
+        for i in range(len(IMPACT_RING_EDGES) - 1)
+    },
+}
+
+# Plotly colour scales of the citywide map measures; the changes use diverging
+# scales centred on zero
+CHOROPLETH_COLOR_SCALES = {"value": "Viridis", "yoy": "RdBu_r", "intervention_delta": "RdBu_r"}
+# Percentiles of each measure (over every tract and period) mapped to the ends
+# of its colour scale, so outliers do not flatten the map
+CHOROPLETH_PERCENTILES = (2, 98)
+# Style of the census tracts of the citywide map, without their fill colour
+CHOROPLETH_STYLE = {"color": "white", "weight": 0.5, "fillOpacity": 0.7}
+
+# Keyword arguments of Prophet for the trend fits
+TREND_MODEL_SETTINGS = {}
+# Trends precomputed by `python -m streamlit_idealista.modeling.train precompute-trends`,
+# one Parquet file per city
+TREND_STORE_DIR = PROCESSED_DATA_DIR / "trends"
+
+# Bootstrap confidence bands over the census tracts of a selection
+BOOTSTRAP_REPLICATES = 2000
+BOOTSTRAP_CONFIDENCE = 0.95
+BOOTSTRAP_SEED = 0
+BAND_OPACITY = 0.2
+
+# Event study: quarters shown before and after the start of the interventions,
+# quarters before the start averaged as the baseline of each intervention, and
+# percentiles of the spread band across interventions
+EVENT_STUDY_WINDOW = (-8, 12)
+EVENT_STUDY_BASELINE_QUARTERS = 4
+EVENT_STUDY_BAND_PERCENTILES = (25, 75)
+
+# Caching Parameters
+
+# Policy of each in-process cache: max_entries, max_bytes (memory budget, None
+# for no budget) and ttl (seconds before an entry expires, None for never).
+# The entries are listed, and can be evicted, on the Cache Inspector page.
+CACHE_POLICIES = {
+    # Serialized figures of plot_timeseries
+    "figures": {"max_entries": 64, "max_bytes": 128 * 2**20, "ttl": 6 * 3600},
+    # Aggregated series, bootstrap bands and event studies
+    "aggregates": {"max_entries": 256, "max_bytes": 256 * 2**20, "ttl": 24 * 3600},
+    # Prophet trends
+    "trends": {"max_entries": 256, "max_bytes": 64 * 2**20, "ttl": None},
+    # Per-metric aggregate cubes and citywide map measures
+    "cubes": {"max_entries": 8, "max_bytes": 1 * 2**30, "ttl": None},
+    # Loaded cities and their indexes
+    "cities": {"max_entries": max(len(CITIES), 1), "max_bytes": CITY_CACHE_MAX_BYTES, "ttl": None},
+    # Polars copies of the listings, with DATAFRAME_BACKEND = "polars"
+    "polars": {"max_entries": max(len(CITIES), 1), "max_bytes": CITY_CACHE_MAX_BYTES, "ttl": None},
+}
+# Library loading the listings CSV and aggregating the in-memory listings into
+# series: "pandas", or "polars" (multi-threaded; the polars package is optional)
+DATAFRAME_BACKEND = os.getenv("DATAFRAME_BACKEND", "pandas")
+
+# Downloads of the selected listings and series: rows written per chunk
+EXPORT_CHUNK_ROWS = 100_000
+
+# SQL console (DuckDB): seconds before a query is interrupted, rows kept per
+# result, rows fetched per batch and shown per page, queries run at once, and
+# threads and memory of each query
+SQL_QUERY_TIMEOUT = float(os.getenv("SQL_QUERY_TIMEOUT", "30"))
+SQL_MAX_ROWS = int(os.getenv("SQL_MAX_ROWS", "100000"))
+SQL_PAGE_ROWS = 1000
+SQL_WORKERS = int(os.getenv("SQL_WORKERS", "2"))
+SQL_THREADS = int(os.getenv("SQL_THREADS", "2"))
+SQL_MEMORY_LIMIT = os.getenv("SQL_MEMORY_LIMIT", "2GB")
+# Levels of the census tract hierarchy, as prefix lengths of the 10 digit
+# CENSUSTRACT code (province, municipality, district; the rest is the section)
+CENSUSTRACT_HIERARCHY = {"PROVINCE": 2, "MUNICIPALITY": 5, "DISTRICT": 7}
+
+# Warm-up before serving (see `python -m streamlit_idealista.warmup`): the cities
+# whose datasets, indexes and default series are prepared, the metric of their
+# aggregates, whether their trends are fitted too, and the threads fitting them
+WARM_UP_CITIES = [city for city in os.getenv("WARM_UP_CITIES", DEFAULT_CITY).split(",") if city]
+WARM_UP_METRIC = os.getenv("WARM_UP_METRIC", "UNITPRICE_ASKING")
+WARM_UP_TRENDS = os.getenv("WARM_UP_TRENDS", "1") == "1"
+WARM_UP_WORKERS = int(os.getenv("WARM_UP_WORKERS", str(os.cpu_count() or 1)))
+
+# Query API
+API_HOST = os.getenv("API_HOST", "127.0.0.1")
+API_PORT = int(os.getenv("API_PORT", "8502"))
+API_WORKERS = int(os.getenv("API_WORKERS", "4"))
+
 # Log the important paths
 logger.info(f"Input data path: {INPUT_DATA_PATH}")
 logger.info(f"Input JSON path: {INPUT_DTYPES_COUPLED_JSON_PATH}")
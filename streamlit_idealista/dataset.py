@@ -1,14 +1,265 @@
+import json
 from pathlib import Path
+from typing import BinaryIO, Tuple
 
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
 import typer
 from loguru import logger
 from tqdm import tqdm
+from upath import UPath
 
-from streamlit_idealista.config import PROCESSED_DATA_DIR, RAW_DATA_DIR
+from streamlit_idealista.config import (
+    CENSUSTRACT_PARTITION_COLUMN,
+    CENSUSTRACT_PARTITION_PREFIX_LENGTH,
+    CITIES,
+    DATAFRAME_BACKEND,
+    GEOMETRY_FORMAT,
+    INPUT_DATA_PATH,
+    INPUT_DTYPES_COUPLED_JSON_PATH,
+    INPUT_OPERATION_TYPES_PATH,
+    INPUT_PARTITIONED_DATA_PATH,
+    INPUT_TYPOLOGY_TYPES_PATH,
+    PROCESSED_DATA_DIR,
+    RAW_DATA_DIR,
+)
+
+# Partition values are kept as strings, so leading zeros are not lost
+CENSUSTRACT_PARTITIONING = ds.partitioning(
+    pa.schema([(CENSUSTRACT_PARTITION_COLUMN, pa.string())]), flavor="hive"
+)
 
 app = typer.Typer()
 
 
+def load_dtypes(dtypes_path: UPath) -> dict:
+    with dtypes_path.open("rb") as f:
+        return json.load(f)
+
+
+def read_main_data(f: BinaryIO, dtypes: dict, backend: str = DATAFRAME_BACKEND) -> pd.DataFrame:
+    """
+    Read the listings CSV with pandas or, with the "polars" backend, with the
+    multi-threaded Polars reader (see polars_backend.read_listings_csv), with
+    the same columns and dtypes.
+    """
+    if backend == "polars":
+        from streamlit_idealista.polars_backend import read_listings_csv
+
+        return read_listings_csv(f, dtypes)
+    return pd.read_csv(f, sep=";", dtype=dtypes, encoding="unicode_escape")
+
+
+def load_main_data(main_data_path: UPath, dtypes: dict, backend: str = DATAFRAME_BACKEND) -> pd.DataFrame:
+    with main_data_path.open("rb") as f:
+        return read_main_data(f, dtypes, backend)
+
+
+def get_geometry_path(geojson_path: UPath) -> UPath:
+    """Path of a geometry layer in GEOMETRY_FORMAT: the GeoJSON file or the GeoParquet file next to it."""
+    if GEOMETRY_FORMAT == "geoparquet":
+        return geojson_path.with_suffix(".parquet")
+    return geojson_path
+
+
+def read_geometries(path: UPath) -> gpd.GeoDataFrame:
+    """Read a geometry layer from GeoParquet (.parquet) or any format read by gpd.read_file."""
+    with path.open("rb") as f:
+        if path.suffix == ".parquet":
+            return gpd.read_parquet(f)
+        return gpd.read_file(f)
+
+
+def load_censustract_geojson(censustract_geojson_path: UPath) -> gpd.GeoDataFrame:
+    gdf_ine = read_geometries(censustract_geojson_path)
+    gdf_ine["CENSUSTRACT"] = gdf_ine["CENSUSTRACT"].astype(int).astype(str)
+    return gdf_ine
+
+
+def load_operation_types(operation_types_path: UPath, dtypes: dict) -> pd.DataFrame:
+    with operation_types_path.open("rb") as f:
+        return pd.read_csv(f, sep=";", dtype=dtypes, encoding="unicode_escape")
+
+
+def load_typology_types(typology_types_path: UPath, dtypes: dict) -> pd.DataFrame:
+    with typology_types_path.open("rb") as f:
+        return pd.read_csv(f, sep=";", dtype=dtypes)
+
+
+def load_interventions(interventions_path: UPath) -> gpd.GeoDataFrame:
+    return read_geometries(interventions_path)
+
+
+def decode_dimension(ids: pd.Series, dimension_df: pd.DataFrame) -> Tuple[pd.Categorical, pd.Categorical]:
+    """
+    Decode an ID column with a dimension table (ID, SHORTNAME, DESCRIPTION).
+
+    Only the distinct IDs are parsed and looked up, and the listings are
+    mapped through their category codes, so no column of the size of the
+    listings is allocated apart from the new codes.
+
+    Args:
+      ids (pd.Series): The ID column of the listings, as strings, integers or categorical.
+      dimension_df (pd.DataFrame): The dimension table.
+
+    Returns:
+      Tuple[pd.Categorical, pd.Categorical]: The IDs and their SHORTNAME, as
+        categoricals whose categories are the dimension table IDs and names
+        present in the listings. IDs missing from the table decode to NaN.
+    """
+    if not isinstance(ids.dtype, pd.CategoricalDtype):
+        ids = ids.astype("category")
+
+    dimension_ids = pd.Index(dimension_df["ID"].astype(int))
+    names = pd.Index(dimension_df["SHORTNAME"])
+    name_categories = names.unique()
+
+    # Position in the dimension table of each distinct ID, then of each listing
+    category_positions = dimension_ids.get_indexer(ids.cat.categories.astype(int))
+    listing_codes = ids.cat.codes.to_numpy()
+    positions = np.where(listing_codes >= 0, category_positions[listing_codes], -1)
+
+    id_codes = positions.astype(np.min_scalar_type(-len(dimension_ids)))
+    name_codes = np.where(positions >= 0, name_categories.get_indexer(names)[positions], -1).astype(id_codes.dtype)
+
+    decoded_ids = pd.Categorical.from_codes(id_codes, categories=dimension_ids).remove_unused_categories()
+    decoded_names = pd.Categorical.from_codes(name_codes, categories=name_categories).remove_unused_categories()
+    return decoded_ids, decoded_names
+
+
+def decode_periods(periods: pd.Series) -> np.ndarray:
+    """
+    Parse the PERIOD column into quarter ordinals (quarters since 1970Q1, as
+    pd.Period("...", freq="Q").ordinal).
+
+    Only the distinct periods are parsed, and the result is an int16 array,
+    so later time-window filters compare small integers instead of strings.
+
+    Args:
+      periods (pd.Series): The PERIOD column, as dates or date strings.
+
+    Returns:
+      np.ndarray: The quarter of each listing; missing periods are the minimum int16.
+    """
+    codes, uniques = pd.factorize(periods)
+    quarters = pd.PeriodIndex(pd.to_datetime(uniques), freq="Q").asi8.astype(np.int16)
+    return np.where(codes >= 0, quarters[codes], np.iinfo(np.int16).min).astype(np.int16)
+
+
+def process_df(
+    df: pd.DataFrame, operation_types_df: pd.DataFrame, typology_types_df: pd.DataFrame
+) -> pd.DataFrame:
+    """
+    Decode the operation and typology IDs of the listings with the dimension tables.
+
+    The ID columns become categoricals and ADOPERATION and ADTYPOLOGY are added
+    with the SHORTNAME of each ID. PERIOD is parsed once into the QUARTER
+    index (see decode_periods). The other columns are shared with df, not copied.
+    """
+    operation_ids, operations = decode_dimension(df["ADOPERATIONID"], operation_types_df)
+    typology_ids, typologies = decode_dimension(df["ADTYPOLOGYID"], typology_types_df)
+
+    columns = {column: df[column] for column in df.columns}
+    columns.update(
+        ADOPERATIONID=operation_ids,
+        ADTYPOLOGYID=typology_ids,
+        ADOPERATION=operations,
+        ADTYPOLOGY=typologies,
+        QUARTER=decode_periods(df["PERIOD"]),
+    )
+    return pd.DataFrame(columns, index=df.index, copy=False)
+
+
+def write_partitioned_listings(df: pd.DataFrame, partitioned_path: UPath, part: int = 0):
+    """
+    Append processed listings to the partitioned Parquet dataset.
+
+    CENSUSTRACT is stored zero-padded to 10 digits and its first
+    CENSUSTRACT_PARTITION_PREFIX_LENGTH digits (province and municipality)
+    are the partition key.
+
+    Args:
+      df (pd.DataFrame): Processed listings, as returned by process_df.
+      partitioned_path (UPath): Root directory of the dataset.
+      part (int): Number of this chunk, used to name its files.
+    """
+    censustracts = df["CENSUSTRACT"].astype(str).str.zfill(10)
+    table = pa.Table.from_pandas(
+        df.assign(
+            CENSUSTRACT=censustracts,
+            **{CENSUSTRACT_PARTITION_COLUMN: censustracts.str[:CENSUSTRACT_PARTITION_PREFIX_LENGTH]},
+        ),
+        preserve_index=False,
+    )
+    ds.write_dataset(
+        table,
+        partitioned_path.path,
+        filesystem=partitioned_path.fs,
+        format="parquet",
+        partitioning=CENSUSTRACT_PARTITIONING,
+        basename_template=f"part-{part}-{{i}}.parquet",
+        existing_data_behavior="overwrite_or_ignore",
+    )
+
+
+def open_partitioned_listings(partitioned_path: UPath) -> ds.Dataset:
+    """Open the partitioned listings lazily; nothing is read until it is queried."""
+    return ds.dataset(
+        partitioned_path.path,
+        filesystem=partitioned_path.fs,
+        format="parquet",
+        partitioning=CENSUSTRACT_PARTITIONING,
+    )
+
+
+@app.command()
+def partition(chunksize: int = 1_000_000):
+    """
+    Convert the listings CSV (INPUT_DATA_PATH) into the partitioned Parquet
+    dataset (INPUT_PARTITIONED_DATA_PATH), in chunks, so datasets larger than
+    memory can be converted.
+    """
+    input_path, output_path = INPUT_DATA_PATH, INPUT_PARTITIONED_DATA_PATH
+    dtypes_coupled_dict = load_dtypes(INPUT_DTYPES_COUPLED_JSON_PATH)
+    operation_types_df = load_operation_types(INPUT_OPERATION_TYPES_PATH, dtypes_coupled_dict)
+    typology_types_df = load_typology_types(INPUT_TYPOLOGY_TYPES_PATH, dtypes_coupled_dict)
+
+    if output_path.exists():
+        output_path.fs.rm(output_path.path, recursive=True)
+
+    logger.info(f"Partitioning {input_path} into {output_path}...")
+    with input_path.open("rb") as f:
+        chunks = pd.read_csv(f, sep=";", dtype=dtypes_coupled_dict, encoding="unicode_escape", chunksize=chunksize)
+        for part, chunk in enumerate(tqdm(chunks)):
+            write_partitioned_listings(process_df(chunk, operation_types_df, typology_types_df), output_path, part)
+    logger.success("Partitioning complete.")
+
+
+@app.command()
+def geometries():
+    """
+    Convert the census tract and intervention GeoJSON layers of every city
+    (see config.CITIES) to GeoParquet files next to them, read instead of the
+    GeoJSON files with GEOMETRY_FORMAT=geoparquet.
+    """
+    geojson_paths = {
+        city_config[layer]
+        for city_config in CITIES.values()
+        for layer in ["censustract_geojson", "interventions_geojson"]
+        if city_config.get(layer)
+    }
+    for geojson_path in tqdm(sorted(geojson_paths, key=str)):
+        geoparquet_path = geojson_path.with_suffix(".parquet")
+        gdf = read_geometries(geojson_path)
+        with geoparquet_path.open("wb") as f:
+            gdf.to_parquet(f, index=False)
+        logger.info(f"Wrote {len(gdf)} geometries to {geoparquet_path}")
+    logger.success("Geometry conversion complete.")
+
+
 @app.command()
 def main(
     # ---- REPLACE DEFAULT PATHS AS APPROPRIATE ----
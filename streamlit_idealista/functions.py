@@ -1,32 +1,108 @@
 
+from concurrent.futures import Future, ThreadPoolExecutor
 import datetime
+import copy
+import hashlib
+import io
 import json
+import textwrap
+import threading
+import warnings
 from pathlib import Path
-from typing import List, Optional, Tuple, Union
+from typing import BinaryIO, Dict, Iterable, Iterator, List, Optional, Tuple, Union
 
 import folium as folium
 import geopandas as gpd
+from branca.element import MacroElement
+from jinja2 import Template
 import numpy as np
 import pandas as pd
+import plotly.colors
 import plotly.graph_objects as go
+import plotly.io as pio
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
 import shapely
 import streamlit as st
-from folium.plugins import Draw
+from folium.plugins import Draw, Fullscreen
 from plotly.subplots import make_subplots
 from prophet import Prophet
+from scipy import sparse
 from pyproj import Transformer
 from shapely.geometry import GeometryCollection, shape
 from shapely.ops import transform
 from streamlit_folium import st_folium
 
-
-
-def transform_geometry(geometry):
+from streamlit_idealista.cache import get_frame_version, make_cache, selection_fingerprint
+from streamlit_idealista.dataset import decode_periods
+from streamlit_idealista.topology import encode_topology
+from streamlit_idealista.config import (
+    BAND_OPACITY,
+    BOOTSTRAP_CONFIDENCE,
+    BOOTSTRAP_REPLICATES,
+    BOOTSTRAP_SEED,
+    CENSUSTRACT_PARTITION_COLUMN,
+    CENSUSTRACT_PARTITION_PREFIX_LENGTH,
+    CHOROPLETH_COLOR_SCALES,
+    CHOROPLETH_PERCENTILES,
+    CHOROPLETH_STYLE,
+    DATAFRAME_BACKEND,
+    EVENT_STUDY_BAND_PERCENTILES,
+    EVENT_STUDY_BASELINE_QUARTERS,
+    EVENT_STUDY_WINDOW,
+    EXPORT_CHUNK_ROWS,
+    GRID_INDEX_MAX_QUERY_CELLS,
+    GRID_INDEX_RESOLUTIONS,
+    IMPACT_RING_EDGES,
+    INTERVENTIONS_SHORTNAME_COLUMN,
+    INTERVENTIONS_SHORTNAME_MAX_LENGTH,
+    MAP_LAYER_STYLES,
+    PROJECTED_CRS,
+    TREND_MODEL_SETTINGS,
+    TREND_STORE_DIR,
+)
+
+# Serialized figures of plot_timeseries, keyed by selection fingerprint
+FIGURE_CACHE = make_cache("figures")
+# Aggregated series and Prophet trends, shared by the pages and the query API
+AGGREGATE_CACHE = make_cache("aggregates")
+TREND_CACHE = make_cache("trends")
+# Per-metric sums and counts by census tract, period, operation and typology
+CUBE_CACHE = make_cache("cubes")
+# Polars copies of the listings, keyed by dataset version (DATAFRAME_BACKEND = "polars")
+POLARS_CACHE = make_cache("polars")
+
+# Precomputed trends by trend key, loaded on first use (see load_trend_store)
+_TREND_STORE: Optional[Dict[str, pd.Series]] = None
+_TREND_STORE_LOCK = threading.Lock()
+
+# Exact geometry refinements of approximate grid lookups
+_REFINE_EXECUTOR = ThreadPoolExecutor(max_workers=2, thread_name_prefix="refine")
+
+AGGREGATION_STATISTICS = ["mean", "median", "min", "max", "std", "sum", "count"]
+
+PRICE_TYPE_OPERATIONS = {"sale": ["sale"], "rent": ["rent"], "both": ["sale", "rent"]}
+PRICE_TYPE_LABELS = {"sale": "buy", "rent": "rent"}
+# Time window of a chart: the first and last quarters (pd.Period, freq "Q") to include
+PeriodRange = Tuple[pd.Period, pd.Period]
+# Download formats and their MIME types
+EXPORT_FORMATS = {"parquet": "application/vnd.apache.parquet", "csv": "text/csv"}
+CHOROPLETH_MEASURES = {
+    "value": "Value",
+    "yoy": "Year-over-year change",
+    "intervention_delta": "Change since before the interventions",
+}
+TYPOLOGY_COLORS = plotly.colors.qualitative.Safe
+
+
+def transform_geometry(geometry, crs: str = "EPSG:25830"):
     """
-    Transform geometry from EPSG:4326 to EPSG:25831.
+    Transform geometry from EPSG:4326 to the CRS of the census tracts.
 
     Args:
       geometry (dict): Geometry in GeoJSON format.
+      crs (str): Target CRS (see the "crs" of the city in config.CITIES).
 
     Returns:
       shapely.geometry.base.BaseGeometry: Transformed geometry.
@@ -34,8 +110,8 @@ def transform_geometry(geometry):
     # Convert GeoJSON to Shapely geometry
     geom = shape(geometry)
 
-    # Create a transformer instance to convert from EPSG:4326 to EPSG:25831
-    transformer = Transformer.from_crs("EPSG:4326", "EPSG:25830", always_xy=True)
+    # Create a transformer instance to convert from EPSG:4326 to the target CRS
+    transformer = Transformer.from_crs("EPSG:4326", crs, always_xy=True)
 
     # Transform the geometry using the transformer instance
     transformed_geom = transform(lambda x, y: transformer.transform(x, y), geom)
@@ -85,15 +161,673 @@ def get_impacted_censustracts(geometries: Union[shapely.geometry.GeometryCollect
     mask = ine_gdf['geometry'].intersects(geometries)
     return ine_gdf[mask]['CENSUSTRACT'].unique().tolist()
 
-def get_timeseries_of_census_tracts(df: pd.DataFrame, censustract_list: Optional[List[str]] = None, operation: str = "mean") -> Optional[pd.DataFrame]:
+def get_district_gdf(interventions_gdf: gpd.GeoDataFrame,
+                     ine_gdf: gpd.GeoDataFrame
+                     ) -> gpd.GeoDataFrame:
+    """
+    Get the census tracts of the districts of the interventions, without the
+    intervened census tracts, to use as control group.
+
+    The district is the first 7 digits (province, municipality and district)
+    of the 10 digit CENSUSTRACT. Neither input is modified.
+
+    Args:
+      interventions_gdf (gpd.GeoDataFrame): The selected interventions.
+      ine_gdf (gpd.GeoDataFrame): Geopandas with INE information about
+      censustracts and their polygons.
+
+    Returns:
+      gpd.GeoDataFrame: The census tracts of the districts.
+    """
+    intervention_districts = interventions_gdf["CENSUSTRACT"].astype(str).str.zfill(10).str[0:7]
+    ine_districts = ine_gdf["CENSUSTRACT"].astype(str).str.zfill(10).str[0:7]
+    intervened = interventions_gdf["CENSUSTRACT"].astype(str).astype(int)
+    return ine_gdf[ine_districts.isin(intervention_districts) & ~ine_gdf["CENSUSTRACT"].astype(int).isin(intervened)]
+
+def get_ring_labels(ring_edges: List[float] = IMPACT_RING_EDGES) -> List[str]:
+    """Get the labels of the distance rings, e.g. "0-250 m"."""
+    return [f"{inner:g}-{outer:g} m" for inner, outer in zip(ring_edges[:-1], ring_edges[1:])]
+
+def project_censustracts(ine_gdf: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
+    """
+    Get the censustracts in PROJECTED_CRS with their spatial index built, so
+    distances and areas are in meters. Census tracts already in PROJECTED_CRS
+    are returned as they are, keeping their spatial index.
+    """
+    if ine_gdf.crs == PROJECTED_CRS:
+        return ine_gdf
+    tracts = ine_gdf.to_crs(PROJECTED_CRS)
+    tracts.sindex
+    return tracts
+
+def get_impact_rings(interventions_gdf: gpd.GeoDataFrame,
+                     ine_gdf: gpd.GeoDataFrame,
+                     ring_edges: List[float] = IMPACT_RING_EDGES
+                     ) -> pd.DataFrame:
+    """
+    Get the census tracts in concentric distance rings around the interventions.
+
+    The footprints are buffered once by the outer edge in PROJECTED_CRS, the
+    candidates come from one spatial index query of the projected census tracts and their distances to the
+    footprints are computed in a single vectorized pass. A census tract falls
+    in the ring of its nearest distance; the intersected census tracts
+    (distance 0) are the impacted ones and are not in any ring.
+
+    Args:
+      interventions_gdf (gpd.GeoDataFrame): The selected interventions.
+      ine_gdf (gpd.GeoDataFrame): Geopandas with INE information about
+      censustracts and their polygons, in PROJECTED_CRS (the "gdf_ine_projected"
+      city resource) so they are not reprojected on every call.
+      ring_edges (List[float]): Increasing ring edges in meters.
+
+    Returns:
+      pd.DataFrame: The CENSUSTRACT, its DISTANCE in meters and its RING
+        (a categorical of the get_ring_labels labels), sorted by DISTANCE.
+    """
+    labels = get_ring_labels(ring_edges)
+    columns = {
+        "CENSUSTRACT": pd.Series(dtype=ine_gdf["CENSUSTRACT"].dtype),
+        "DISTANCE": pd.Series(dtype=float),
+        "RING": pd.Categorical([], categories=labels),
+    }
+    if interventions_gdf is None or interventions_gdf.empty:
+        return pd.DataFrame(columns)
+
+    footprint = interventions_gdf.geometry.to_crs(PROJECTED_CRS).union_all()
+    tracts = project_censustracts(ine_gdf)
+    positions = tracts.sindex.query(footprint.buffer(ring_edges[-1]), predicate="intersects")
+
+    distances = shapely.distance(tracts.geometry.values[positions], footprint)
+    ring_codes = np.searchsorted(ring_edges, distances, side="left") - 1
+    in_ring = (distances > 0) & (ring_codes >= 0) & (ring_codes < len(labels))
+
+    columns.update(
+        CENSUSTRACT=tracts["CENSUSTRACT"].values[positions][in_ring],
+        DISTANCE=distances[in_ring],
+        RING=pd.Categorical.from_codes(ring_codes[in_ring], categories=labels),
+    )
+    # Census tracts split in several rows keep their nearest part
+    rings = pd.DataFrame(columns).sort_values("DISTANCE", kind="stable")
+    return rings.drop_duplicates("CENSUSTRACT").reset_index(drop=True)
+
+def get_censustract_overlap_weights(geometries: Union[shapely.geometry.base.BaseGeometry, None],
+                                    ine_gdf: gpd.GeoDataFrame
+                                    ) -> Optional[pd.Series]:
+    """
+    Get the fraction of each censustract area covered by the given geometries.
+
+    Candidates are restricted with the spatial index of ine_gdf and the
+    intersection areas are computed in PROJECTED_CRS with the vectorized
+    shapely functions. Censustracts that only touch the geometries are dropped.
+
+    Args:
+      geometries (shapely.geometry.base.BaseGeometry): The areas to check,
+        in the CRS of ine_gdf.
+      ine_gdf (gpd.GeoDataFrame): Geopandas with INE information about
+      censustracts and their polygons.
+
+    Returns:
+      Optional[pd.Series]: The covered fraction (0, 1] indexed by CENSUSTRACT.
+    """
+    if geometries is None:
+        return None
+
+    positions = ine_gdf.sindex.query(geometries, predicate="intersects")
+    candidates = ine_gdf.iloc[positions]
+
+    candidate_geometries = candidates.geometry.to_crs(PROJECTED_CRS).values
+    area = gpd.GeoSeries([geometries], crs=ine_gdf.crs).to_crs(PROJECTED_CRS).values[0]
+
+    fractions = shapely.area(shapely.intersection(candidate_geometries, area)) / shapely.area(candidate_geometries)
+    weights = pd.Series(fractions, index=candidates["CENSUSTRACT"].values, name="WEIGHT")
+    weights = weights.groupby(level=0).max()
+
+    return weights[weights > 0]
+
+def build_intervention_overlap_matrix(interventions_gdf: gpd.GeoDataFrame,
+                                      ine_gdf: gpd.GeoDataFrame
+                                      ) -> Tuple[sparse.csr_matrix, pd.Index, pd.Index]:
+    """
+    Precompute the overlap weights of every intervention footprint on the censustracts.
+
+    Footprints are dissolved by TITOL_WO. Candidate pairs come from one bulk
+    spatial index query and their intersection areas are computed in a single
+    vectorized pass in PROJECTED_CRS.
+
+    Args:
+      interventions_gdf (gpd.GeoDataFrame): The information about interventions.
+      ine_gdf (gpd.GeoDataFrame): Geopandas with INE information about
+      censustracts and their polygons, preferably in PROJECTED_CRS (the
+      "gdf_ine_projected" city resource).
+
+    Returns:
+      Tuple[sparse.csr_matrix, pd.Index, pd.Index]: The interventions x
+        censustracts matrix of covered censustract fractions, and the
+        intervention names and censustracts labelling its rows and columns.
+    """
+    footprints = interventions_gdf[["TITOL_WO", "geometry"]].to_crs(PROJECTED_CRS).dissolve(by="TITOL_WO")
+    tracts = project_censustracts(ine_gdf)
+
+    rows, columns = tracts.sindex.query(footprints.geometry.values, predicate="intersects")
+    tract_geometries = tracts.geometry.values[columns]
+    fractions = (
+        shapely.area(shapely.intersection(footprints.geometry.values[rows], tract_geometries))
+        / shapely.area(tract_geometries)
+    )
+
+    overlap_matrix = sparse.coo_matrix(
+        (fractions, (rows, columns)), shape=(len(footprints), len(tracts))
+    ).tocsr()
+    overlap_matrix.eliminate_zeros()
+
+    return overlap_matrix, pd.Index(footprints.index), pd.Index(tracts["CENSUSTRACT"])
+
+def get_intervention_overlap_weights(overlap_matrix: sparse.csr_matrix,
+                                     interventions: pd.Index,
+                                     censustracts: pd.Index,
+                                     selection: List[str]
+                                     ) -> pd.Series:
+    """
+    Get the covered fraction of each censustract for a selection of interventions.
+
+    The fractions of the selected footprints are added and capped at 1, which
+    is exact as long as the selected footprints do not overlap each other.
+
+    Args:
+      overlap_matrix (sparse.csr_matrix): As built by build_intervention_overlap_matrix.
+      interventions (pd.Index): Intervention names labelling the matrix rows.
+      censustracts (pd.Index): Censustracts labelling the matrix columns.
+      selection (List[str]): The selected intervention names (TITOL_WO).
+
+    Returns:
+      pd.Series: The covered fraction (0, 1] indexed by CENSUSTRACT.
+    """
+    rows = interventions.get_indexer(selection)
+    coverage = np.minimum(np.asarray(overlap_matrix[rows[rows >= 0]].sum(axis=0)).ravel(), 1.0)
+    covered = np.flatnonzero(coverage)
+
+    return pd.Series(coverage[covered], index=censustracts[covered], name="WEIGHT")
+
+def build_intervention_tract_bitmaps(interventions_gdf: gpd.GeoDataFrame,
+                                     ine_gdf: gpd.GeoDataFrame
+                                     ) -> dict:
+    """
+    Precompute, per intervention, bitsets over the rows of ine_gdf of the
+    census tract sets the pages derive from a selection of interventions.
+
+    Footprints are dissolved by TITOL_WO. The intersections come from one bulk
+    spatial index query of the footprints and one of the census tracts against
+    themselves, so selecting interventions needs no geometry work: the sets
+    of a selection are bitwise ORs of its rows (see select_intervention_tracts).
+
+    Args:
+      interventions_gdf (gpd.GeoDataFrame): The information about interventions.
+      ine_gdf (gpd.GeoDataFrame): Geopandas with INE information about
+      censustracts and their polygons.
+
+    Returns:
+      dict: The "interventions" (TITOL_WO) labelling the rows, the number of
+        "censustracts" (rows of ine_gdf) and, as np.packbits rows, the
+        "impacted" census tracts intersecting each footprint (as
+        get_impacted_gdf), the "series" census tracts intersecting those (as
+        plot_timeseries averages them), and the census tracts of the
+        "district" and the "intervened" ones of each intervention (as
+        get_district_gdf, which removes the latter from the former).
+    """
+    n_tracts = len(ine_gdf)
+    footprints = interventions_gdf[["TITOL_WO", "geometry"]].to_crs(ine_gdf.crs).dissolve(by="TITOL_WO")
+    interventions = pd.Index(footprints.index)
+
+    def to_matrix(rows, columns, shape):
+        return sparse.csr_matrix((np.ones(len(rows), dtype=np.int32), (rows, columns)), shape=shape)
+
+    rows, columns = ine_gdf.sindex.query(footprints.geometry.values, predicate="intersects")
+    impacted = to_matrix(rows, columns, (len(interventions), n_tracts))
+    rows, columns = ine_gdf.sindex.query(ine_gdf.geometry.values, predicate="intersects")
+    adjacency = to_matrix(rows, columns, (n_tracts, n_tracts))
+
+    # Districts and intervened census tracts come from the CENSUSTRACT attribute of the layer
+    intervention_rows = interventions.get_indexer(interventions_gdf["TITOL_WO"])
+    intervention_tracts = interventions_gdf["CENSUSTRACT"].astype(str).str.zfill(10)
+    ine_tracts = ine_gdf["CENSUSTRACT"].astype(str).str.zfill(10)
+
+    def get_membership(intervention_codes: pd.Series, ine_codes: pd.Series) -> sparse.csr_matrix:
+        codes, uniques = pd.factorize(ine_codes)
+        intervention_columns = uniques.get_indexer(intervention_codes)
+        known = intervention_columns >= 0
+        by_code = to_matrix(intervention_rows[known], intervention_columns[known], (len(interventions), len(uniques)))
+        return by_code @ to_matrix(codes, np.arange(n_tracts), (len(uniques), n_tracts))
+
+    bitsets = {
+        "impacted": impacted,
+        "series": impacted @ adjacency,
+        "district": get_membership(intervention_tracts.str[0:7], ine_tracts.str[0:7]),
+        "intervened": get_membership(intervention_tracts, ine_tracts),
+    }
+    return {
+        "interventions": interventions,
+        "censustracts": n_tracts,
+        **{name: np.packbits(matrix.toarray() > 0, axis=1) for name, matrix in bitsets.items()},
+    }
+
+def select_intervention_tracts(bitmaps: dict, selection: List[str]) -> Dict[str, np.ndarray]:
+    """
+    Get the census tract sets of a selection of interventions from their bitsets.
+
+    Args:
+      bitmaps (dict): As built by build_intervention_tract_bitmaps.
+      selection (List[str]): The selected intervention names (TITOL_WO).
+
+    Returns:
+      Dict[str, np.ndarray]: Boolean masks over the rows of ine_gdf of the
+        "impacted" census tracts, the "series" census tracts averaged for
+        them, and the "control" census tracts (district minus intervened).
+    """
+    rows = bitmaps["interventions"].get_indexer(selection)
+    rows = rows[rows >= 0]
+    union = {
+        name: np.bitwise_or.reduce(bitmaps[name][rows], axis=0)
+        for name in ["impacted", "series", "district", "intervened"]
+    }
+    union["control"] = union["district"] & ~union["intervened"]
+
+    return {
+        name: np.unpackbits(union[name], count=bitmaps["censustracts"]).astype(bool)
+        for name in ["impacted", "series", "control"]
+    }
+
+def build_grid_index(ine_gdf: gpd.GeoDataFrame,
+                     resolutions: List[int] = GRID_INDEX_RESOLUTIONS
+                     ) -> Dict[int, dict]:
+    """
+    Rasterize the censustracts onto square grids at several resolutions.
+
+    For every resolution (cell size in meters of PROJECTED_CRS) the coverage
+    matrix stores, for each cell and censustract, the fraction of the
+    censustract area that falls inside the cell.
+
+    Args:
+      ine_gdf (gpd.GeoDataFrame): Geopandas with INE information about
+      censustracts and their polygons.
+      resolutions (List[int]): Cell sizes in meters.
+
+    Returns:
+      Dict[int, dict]: Per resolution, the grid origin, shape and cell size,
+        the cells x censustracts coverage matrix and the censustracts
+        labelling its columns.
+    """
+    tracts = ine_gdf.to_crs(PROJECTED_CRS)
+    tract_areas = shapely.area(tracts.geometry.values)
+    x_min, y_min, x_max, y_max = tracts.total_bounds
+
+    grid_index = {}
+    for cell_size in resolutions:
+        n_cols = int(np.ceil((x_max - x_min) / cell_size))
+        n_rows = int(np.ceil((y_max - y_min) / cell_size))
+        rows, cols = np.divmod(np.arange(n_rows * n_cols), n_cols)
+        cells = shapely.box(
+            x_min + cols * cell_size, y_min + rows * cell_size,
+            x_min + (cols + 1) * cell_size, y_min + (rows + 1) * cell_size,
+        )
+
+        cell_ids, tract_ids = tracts.sindex.query(cells, predicate="intersects")
+        fractions = (
+            shapely.area(shapely.intersection(cells[cell_ids], tracts.geometry.values[tract_ids]))
+            / tract_areas[tract_ids]
+        )
+        coverage = sparse.coo_matrix(
+            (fractions, (cell_ids, tract_ids)), shape=(n_rows * n_cols, len(tracts))
+        ).tocsr()
+        coverage.eliminate_zeros()
+
+        grid_index[cell_size] = {
+            "origin": (x_min, y_min),
+            "shape": (n_rows, n_cols),
+            "cell_size": cell_size,
+            "coverage": coverage,
+            "censustracts": pd.Index(tracts["CENSUSTRACT"]),
+        }
+
+    return grid_index
+
+def query_grid_index(grid_index: Dict[int, dict],
+                     geometries: shapely.geometry.base.BaseGeometry,
+                     crs: str
+                     ) -> pd.Series:
+    """
+    Get the approximate covered fraction of each censustract by cell lookup.
+
+    The finest resolution whose cells within the bounding box of the geometries
+    do not exceed GRID_INDEX_MAX_QUERY_CELLS is used, so the cost does not grow
+    with the number of censustracts covered. Cells are selected when their
+    centre lies inside the geometries; if none does (a point, a thin shape or
+    a shape smaller than a cell), the cells the geometries intersect are.
+
+    Args:
+      grid_index (Dict[int, dict]): As built by build_grid_index.
+      geometries (shapely.geometry.base.BaseGeometry): The areas to check.
+      crs (str): The CRS of the geometries.
+
+    Returns:
+      pd.Series: The approximate covered fraction indexed by CENSUSTRACT.
+    """
+    area = gpd.GeoSeries([geometries], crs=crs).to_crs(PROJECTED_CRS).values[0]
+    bounds = shapely.bounds(area)
+
+    for cell_size in sorted(grid_index):
+        grid = grid_index[cell_size]
+        (x_min, y_min), (n_rows, n_cols) = grid["origin"], grid["shape"]
+        first_col, first_row = np.floor((bounds[:2] - (x_min, y_min)) / cell_size).astype(int)
+        last_col, last_row = np.floor((bounds[2:] - (x_min, y_min)) / cell_size).astype(int)
+        first_col, last_col = np.clip([first_col, last_col], 0, n_cols - 1)
+        first_row, last_row = np.clip([first_row, last_row], 0, n_rows - 1)
+        if (last_row - first_row + 1) * (last_col - first_col + 1) <= GRID_INDEX_MAX_QUERY_CELLS:
+            break
+
+    rows, cols = np.meshgrid(np.arange(first_row, last_row + 1), np.arange(first_col, last_col + 1), indexing="ij")
+    centres_x = x_min + (cols.ravel() + 0.5) * cell_size
+    centres_y = y_min + (rows.ravel() + 0.5) * cell_size
+    inside = shapely.contains_xy(area, centres_x, centres_y)
+    if not inside.any():
+        inside = shapely.intersects(
+            area,
+            shapely.box(centres_x - cell_size / 2, centres_y - cell_size / 2,
+                        centres_x + cell_size / 2, centres_y + cell_size / 2),
+        )
+    cell_ids = (rows.ravel() * n_cols + cols.ravel())[inside]
+
+    coverage = np.minimum(np.asarray(grid["coverage"][cell_ids].sum(axis=0)).ravel(), 1.0)
+    covered = np.flatnonzero(coverage)
+
+    return pd.Series(coverage[covered], index=grid["censustracts"][covered], name="WEIGHT")
+
+def refine_censustracts_in_background(geometries: shapely.geometry.base.BaseGeometry,
+                                      ine_gdf: gpd.GeoDataFrame
+                                      ) -> Future:
+    """
+    Compute the exact covered fractions of the censustracts in a worker thread.
+
+    Args:
+      geometries (shapely.geometry.base.BaseGeometry): The areas to check,
+        in the CRS of ine_gdf.
+      ine_gdf (gpd.GeoDataFrame): Geopandas with INE information about
+      censustracts and their polygons.
+
+    Returns:
+      Future: Resolves to the output of get_censustract_overlap_weights.
+    """
+    return _REFINE_EXECUTOR.submit(get_censustract_overlap_weights, geometries, ine_gdf)
+
+def get_drawing_key(geometry: dict) -> str:
+    """
+    Get a stable key identifying a drawn GeoJSON geometry.
+
+    Args:
+      geometry (dict): Geometry in GeoJSON format.
+
+    Returns:
+      str: Hex digest of the geometry.
+    """
+    payload = json.dumps(geometry, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+def diff_drawings(previous_drawings: Dict[str, List[str]],
+                  drawings: List[dict],
+                  ine_gdf: gpd.GeoDataFrame
+                  ) -> Dict[str, List[str]]:
+    """
+    Update the impacted censustracts of each drawing on the map.
+
+    Drawings already present in previous_drawings keep their censustracts,
+    removed drawings are dropped and only new drawings are intersected with
+    the censustracts, using the spatial index of ine_gdf.
+
+    Args:
+      previous_drawings (Dict[str, List[str]]): Impacted censustracts per
+        drawing key, as returned by the previous call.
+      drawings (List[dict]): GeoJSON features drawn on the map (EPSG:4326).
+      ine_gdf (gpd.GeoDataFrame): Geopandas with INE information about
+      censustracts and their polygons.
+
+    Returns:
+      Dict[str, List[str]]: The impacted censustracts per drawing key.
+    """
+    current_drawings = {}
+    for drawing in drawings:
+        key = get_drawing_key(drawing["geometry"])
+        if key in previous_drawings:
+            current_drawings[key] = previous_drawings[key]
+            continue
+
+        geometry = gpd.GeoSeries([shape(drawing["geometry"])], crs="EPSG:4326").to_crs(ine_gdf.crs).iloc[0]
+        positions = ine_gdf.sindex.query(geometry, predicate="intersects")
+        current_drawings[key] = ine_gdf['CENSUSTRACT'].iloc[positions].unique().tolist()
+
+    return current_drawings
+
+def read_censustract_partitions(dataset: ds.Dataset,
+                                censustract_list: List[str],
+                                columns: Optional[List[str]] = None,
+                                period_range: Optional[PeriodRange] = None
+                                ) -> pd.DataFrame:
+    """
+    Read the listings of the given census tracts from the partitioned dataset.
+
+    The partition filter prunes every province and municipality without a
+    selected census tract, and the CENSUSTRACT (and QUARTER) filters are pushed
+    down to the Parquet row groups, so only the selected listings are loaded.
+
+    Args:
+      dataset (ds.Dataset): The partitioned listings (see dataset.open_partitioned_listings).
+      censustract_list (List[str]): The census tracts to read.
+      columns (Optional[List[str]]): The columns to read; all if None.
+      period_range (Optional[PeriodRange]): Only read these quarters; all if None.
+        Partitions written without the QUARTER column are filtered after reading.
+
+    Returns:
+      pd.DataFrame: The listings of the census tracts, with 10 digit CENSUSTRACT.
+    """
+    censustracts = sorted({str(ct).zfill(10) for ct in censustract_list})
+    prefixes = sorted({ct[:CENSUSTRACT_PARTITION_PREFIX_LENGTH] for ct in censustracts})
+    expression = ds.field(CENSUSTRACT_PARTITION_COLUMN).isin(prefixes) & ds.field("CENSUSTRACT").isin(censustracts)
+
+    if period_range is not None and "QUARTER" in dataset.schema.names:
+        first_quarter, last_quarter = get_quarter_bounds(period_range)
+        expression &= (ds.field("QUARTER") >= first_quarter) & (ds.field("QUARTER") <= last_quarter)
+        period_range = None
+
+    df = dataset.to_table(columns=columns, filter=expression).to_pandas()
+    return filter_period_range(df, period_range)
+
+def get_period_index(df: pd.DataFrame) -> pd.PeriodIndex:
+    """
+    Get the quarters covered by the listings, in order.
+
+    Args:
+      df (pd.DataFrame): The processed listings, with the QUARTER index
+        (see dataset.decode_periods); PERIOD is parsed otherwise.
+
+    Returns:
+      pd.PeriodIndex: The distinct quarters of the listings.
+    """
+    quarters = df["QUARTER"] if "QUARTER" in df.columns else decode_periods(df["PERIOD"])
+    quarters = np.unique(quarters)
+    return pd.PeriodIndex.from_ordinals(quarters[quarters > np.iinfo(np.int16).min], freq="Q")
+
+def get_quarter_bounds(period_range: PeriodRange) -> Tuple[int, int]:
+    """Get the first and last quarter ordinals (as in the QUARTER column) of a period range."""
+    first_period, last_period = (pd.Period(period, freq="Q") for period in period_range)
+    return first_period.ordinal, last_period.ordinal
+
+def get_listing_quarters(df: pd.DataFrame) -> np.ndarray:
+    """
+    Get the quarter ordinal of every listing: the QUARTER index added by
+    process_df, or PERIOD decoded for listings without it.
+    """
+    return df["QUARTER"].to_numpy() if "QUARTER" in df.columns else decode_periods(df["PERIOD"])
+
+def filter_period_range(df: pd.DataFrame, period_range: Optional[PeriodRange] = None) -> pd.DataFrame:
+    """
+    Keep the listings of the quarters of period_range, comparing the integer
+    QUARTER index instead of the PERIOD strings.
+
+    Args:
+      df (pd.DataFrame): The listings.
+      period_range (Optional[PeriodRange]): The first and last quarters; all if None.
+
+    Returns:
+      pd.DataFrame: The listings in the range; df itself if period_range is None.
+    """
+    if period_range is None:
+        return df
+
+    first_quarter, last_quarter = get_quarter_bounds(period_range)
+    quarters = get_listing_quarters(df)
+    return df[(quarters >= first_quarter) & (quarters <= last_quarter)]
+
+def get_metric_columns(df: Union[pd.DataFrame, ds.Dataset]) -> List[str]:
+    """
+    Get the numeric metric columns of the listings dataframe.
+
+    Args:
+      df (Union[pd.DataFrame, ds.Dataset]): The dataframe containing the data,
+        or the partitioned listings (only the schema is read).
+
+    Returns:
+      List[str]: The numeric columns, excluding the ID columns.
+    """
+    if isinstance(df, ds.Dataset):
+        df = df.schema.empty_table().to_pandas()
+    return [
+        column for column in df.select_dtypes("number").columns
+        if not column.endswith("ID") and column not in ["CENSUSTRACT", "PERIOD", "QUARTER"]
+    ]
+
+def get_polars_listings(df: pd.DataFrame) -> dict:
+    """
+    Get the Polars copy of the listings used by the "polars" DATAFRAME_BACKEND
+    (see polars_backend.to_polars_listings), converted once per dataset version.
+    """
+    from streamlit_idealista import polars_backend
+
+    key = get_dataset_version(df)
+    listings = POLARS_CACHE.get(key)
+    if listings is None:
+        listings = polars_backend.to_polars_listings(df, get_metric_columns(df))
+        POLARS_CACHE.put(key, listings)
+    return listings
+
+def get_multi_metric_timeseries(df: Union[pd.DataFrame, ds.Dataset],
+                                censustract_list: Optional[List[str]] = None,
+                                metrics: Optional[List[str]] = None,
+                                statistics: List[str] = ["mean"],
+                                weights: Optional[pd.Series] = None,
+                                period_range: Optional[PeriodRange] = None,
+                                backend: str = DATAFRAME_BACKEND
+                                ) -> Optional[pd.DataFrame]:
+    """
+    Get the timeseries of several metrics and statistics for the given census tracts.
+    All of them are computed in a single filter and groupby pass.
+
+    Args:
+      df (Union[pd.DataFrame, ds.Dataset]): The dataframe containing the data, or
+        the partitioned listings, of which only the selected census tracts are read.
+      censustract_list (Optional[List[str]]): The list of census tracts to filter.
+      metrics (Optional[List[str]]): The metric columns; all of them
+        (get_metric_columns) if None.
+      statistics (List[str]): Aggregation statistics (see AGGREGATION_STATISTICS).
+      weights (Optional[pd.Series]): Weight of each census tract, indexed by
+        CENSUSTRACT (e.g. its covered area fraction). When given, the weighted
+        mean is taken; only supported with the mean statistic.
+      period_range (Optional[PeriodRange]): Only aggregate the listings of
+        these quarters; all if None.
+      backend (str): "pandas", or "polars" to aggregate in-memory listings
+        with the same output in Polars (see polars_backend).
+
+    Returns:
+      Optional[pd.DataFrame]: The timeseries indexed by PERIOD, with
+        (metric, statistic, ADOPERATION) MultiIndex columns.
+        If censustract_list is None, returns None.
+    """
+    if censustract_list is None:
+        return None
+
+    if metrics is None:
+        metrics = get_metric_columns(df)
+
+    # Check if the statistics are valid
+    invalid_statistics = set(statistics) - set(AGGREGATION_STATISTICS)
+    if invalid_statistics:
+        raise ValueError(f"Statistics must be in {AGGREGATION_STATISTICS}, got {sorted(invalid_statistics)}")
+    if weights is not None and list(statistics) != ["mean"]:
+        raise ValueError("Weights are only supported with the 'mean' statistic")
+
+    if isinstance(df, ds.Dataset):
+        # The partitioned listings store CENSUSTRACT zero-padded to 10 digits
+        censustract_list = [str(ct).zfill(10) for ct in censustract_list]
+        if weights is not None:
+            weights = weights.rename(index=lambda ct: str(ct).zfill(10))
+        df = read_censustract_partitions(
+            df, censustract_list, ["CENSUSTRACT", "PERIOD", "ADOPERATION", *metrics], period_range
+        )
+        period_range = None
+    elif backend == "polars":
+        from streamlit_idealista import polars_backend
+
+        listings = get_polars_listings(df)
+        quarter_bounds = None if period_range is None else get_quarter_bounds(period_range)
+        if weights is None:
+            return polars_backend.get_multi_metric_timeseries(
+                listings, censustract_list, metrics, list(statistics), quarter_bounds
+            )
+        # The weighted sums below are compensated pandas sums, so only the
+        # selection is done in Polars
+        df = polars_backend.select_listings(listings, censustract_list, metrics, quarter_bounds)
+        period_range = None
+
+    # Filter the dataframe for the given census tracts, then the time window
+    filtered_df = filter_period_range(df[df["CENSUSTRACT"].isin(censustract_list)], period_range)
+
+    if weights is not None:
+        # Weighted mean: sum(w * x) / sum(w) over the rows with a value
+        tract_weights = filtered_df["CENSUSTRACT"].map(weights).astype(float)
+        values = filtered_df[metrics]
+        row_weights = values.notna().mul(tract_weights, axis=0)
+        weighted_sums = (
+            pd.concat([values.mul(tract_weights, axis=0), row_weights], axis=1, keys=["WEIGHTED_VALUE", "WEIGHT"])
+            .assign(PERIOD=filtered_df["PERIOD"], ADOPERATION=filtered_df["ADOPERATION"])
+            .groupby(["PERIOD", "ADOPERATION"], observed=False)
+            .sum()
+        )
+        aggregated_df = pd.concat(
+            {"mean": weighted_sums["WEIGHTED_VALUE"] / weighted_sums["WEIGHT"].replace(0.0, np.nan)}, axis=1
+        ).swaplevel(0, 1, axis=1)
+    else:
+        # Group by 'PERIOD' and 'ADOPERATION', then apply every statistic to every metric
+        aggregated_df = (
+            filtered_df
+            .groupby(["PERIOD", "ADOPERATION"], observed=False)[metrics]
+            .agg(list(statistics))
+        )
+
+    # Pivot on 'ADOPERATION'
+    return aggregated_df.unstack("ADOPERATION")
+
+def get_timeseries_of_census_tracts(df: Union[pd.DataFrame, ds.Dataset], censustract_list: Optional[List[str]] = None, operation: str = "mean", weights: Optional[pd.Series] = None, metric: str = "UNITPRICE_ASKING", period_range: Optional[PeriodRange] = None) -> Optional[pd.DataFrame]:
     """
     Get the timeseries of prices (rent, sale) for the given census tracts.
     If more than one census tract, the mean or other specified operation is taken.
 
     Args:
-      df (pd.DataFrame): The dataframe containing the data.
+      df (Union[pd.DataFrame, ds.Dataset]): The dataframe containing the data, or
+        the partitioned listings, of which only the selected census tracts are read.
       censustract_list (Optional[List[str]]): The list of census tracts to filter.
       operation (str): Aggregation operation (mean, median).
+      weights (Optional[pd.Series]): Weight of each census tract, indexed by
+        CENSUSTRACT (e.g. its covered area fraction). When given, the weighted
+        mean is taken; only supported with the mean operation.
+      metric (str): The metric column to aggregate.
+      period_range (Optional[PeriodRange]): Only aggregate these quarters; all if None.
 
     Returns:
       Optional[pd.DataFrame]: The timeseries for the given census tracts,
@@ -107,27 +841,819 @@ def get_timeseries_of_census_tracts(df: pd.DataFrame, censustract_list: Optional
     if operation not in ["mean", "median"]:
         raise ValueError("Operation must be 'mean' or 'median'")
 
-    # Filter the dataframe for the given census tracts
-    filtered_df = df[df["CENSUSTRACT"].isin(censustract_list)]
-
-    # Define the aggregation methods based on the requested statistics
-    # Group by 'PERIOD' and 'ADOPERATION', then apply the aggregation methods
-    aggregated_df = (
-        filtered_df
-        .groupby(["PERIOD", "ADOPERATION"], observed=False)
-        .agg({"UNITPRICE_ASKING": operation})
-        .reset_index()  # Reset index to flatten the dataframe
-        .pivot(index="PERIOD", columns="ADOPERATION", values="UNITPRICE_ASKING")  # Pivot on 'ADOPERATION'
+    aggregated_df = get_multi_metric_timeseries(df, censustract_list, [metric], [operation], weights, period_range)
+
+    return aggregated_df[metric][operation]
+
+def iter_censustract_listings(df: Union[pd.DataFrame, ds.Dataset],
+                               censustract_list: List[str],
+                               period_range: Optional[PeriodRange] = None,
+                               chunksize: int = EXPORT_CHUNK_ROWS
+                               ) -> Iterator[pd.DataFrame]:
+    """
+    Yield the listings of the given census tracts in chunks of at most chunksize rows.
+
+    Only the positions of the selected rows are computed up front, so at most
+    one chunk of the selection is copied at a time.
+
+    Args:
+      df (Union[pd.DataFrame, ds.Dataset]): The processed listings, or the
+        partitioned listings, read batch by batch.
+      censustract_list (List[str]): The census tracts to export.
+      period_range (Optional[PeriodRange]): Only export these quarters; all if None.
+      chunksize (int): Maximum number of rows per chunk.
+
+    Yields:
+      pd.DataFrame: The chunks; a single empty one if no listing is selected,
+        so the columns are still known.
+    """
+    if isinstance(df, ds.Dataset):
+        censustracts = sorted({str(ct).zfill(10) for ct in censustract_list})
+        prefixes = sorted({ct[:CENSUSTRACT_PARTITION_PREFIX_LENGTH] for ct in censustracts})
+        expression = ds.field(CENSUSTRACT_PARTITION_COLUMN).isin(prefixes) & ds.field("CENSUSTRACT").isin(censustracts)
+        if period_range is not None and "QUARTER" in df.schema.names:
+            first_quarter, last_quarter = get_quarter_bounds(period_range)
+            expression &= (ds.field("QUARTER") >= first_quarter) & (ds.field("QUARTER") <= last_quarter)
+            period_range = None
+
+        empty = True
+        for batch in df.to_batches(filter=expression, batch_size=chunksize):
+            chunk = filter_period_range(batch.to_pandas(), period_range)
+            if len(chunk):
+                empty = False
+                yield chunk
+        if empty:
+            yield df.schema.empty_table().to_pandas()
+        return
+
+    selected = df["CENSUSTRACT"].isin(censustract_list).to_numpy()
+    if period_range is not None:
+        first_quarter, last_quarter = get_quarter_bounds(period_range)
+        quarters = get_listing_quarters(df)
+        selected = selected & (quarters >= first_quarter) & (quarters <= last_quarter)
+
+    positions = np.flatnonzero(selected)
+    for start in range(0, max(len(positions), 1), chunksize):
+        yield df.take(positions[start:start + chunksize])
+
+def write_chunks(chunks: Iterable[pd.DataFrame], sink: BinaryIO, file_format: str = "parquet") -> int:
+    """
+    Write dataframe chunks to a binary file as they come, as Parquet (one row
+    group per chunk) or CSV (one header).
+
+    Args:
+      chunks (Iterable[pd.DataFrame]): Chunks with the same columns.
+      sink (BinaryIO): The file to write to.
+      file_format (str): One of EXPORT_FORMATS.
+
+    Returns:
+      int: The number of rows written.
+    """
+    if file_format not in EXPORT_FORMATS:
+        raise ValueError(f"File format must be in {list(EXPORT_FORMATS)}, got {file_format}")
+
+    rows = 0
+    writer = None
+    for chunk in chunks:
+        if file_format == "parquet":
+            table = pa.Table.from_pandas(chunk, preserve_index=False)
+            if writer is None:
+                writer = pq.ParquetWriter(sink, table.schema)
+            writer.write_table(table.cast(writer.schema))
+        else:
+            sink.write(chunk.to_csv(index=False, header=rows == 0).encode("utf-8"))
+        rows += len(chunk)
+
+    if writer is not None:
+        writer.close()
+    return rows
+
+def export_listings(df: Union[pd.DataFrame, ds.Dataset],
+                    censustract_list: List[str],
+                    file_format: str = "parquet",
+                    period_range: Optional[PeriodRange] = None
+                    ) -> io.BytesIO:
+    """
+    Export the listings of the given census tracts, written chunk by chunk
+    (see iter_censustract_listings), for a download button.
+    """
+    sink = io.BytesIO()
+    write_chunks(iter_censustract_listings(df, censustract_list, period_range), sink, file_format)
+    sink.seek(0)
+    return sink
+
+def export_timeseries(df: Union[pd.DataFrame, ds.Dataset],
+                      censustract_list: List[str],
+                      file_format: str = "parquet",
+                      weights: Optional[pd.Series] = None,
+                      period_range: Optional[PeriodRange] = None
+                      ) -> io.BytesIO:
+    """
+    Export the mean timeseries of every metric of the given census tracts, as
+    plotted, with one <metric>_<operation> column per series.
+
+    The series are read from the aggregate cache (see get_cached_timeseries).
+    When weights are given, the census tracts are those of the weights, as in
+    the area-weighted curves of plot_timeseries.
+    """
+    if weights is not None:
+        censustract_list = weights.index.tolist()
+
+    timeseries = pd.concat(
+        {
+            metric: get_cached_timeseries(df, censustract_list, weights=weights, metric=metric, period_range=period_range)
+            for metric in get_metric_columns(df)
+        },
+        axis=1,
+    )
+    timeseries.columns = [f"{metric}_{operation}" for metric, operation in timeseries.columns]
+
+    sink = io.BytesIO()
+    write_chunks([timeseries.reset_index()], sink, file_format)
+    sink.seek(0)
+    return sink
+
+def get_dataset_version(df: Union[pd.DataFrame, ds.Dataset]) -> str:
+    """
+    Get the content fingerprint of a dataframe.
+
+    Every row is hashed, once per dataframe object (see cache.get_frame_version);
+    the city datasets are versioned when they are loaded. Partitioned listings
+    are identified by their schema and files.
+
+    Args:
+      df (Union[pd.DataFrame, ds.Dataset]): The dataframe.
+
+    Returns:
+      str: Hex digest identifying the dataframe contents.
+    """
+    if isinstance(df, ds.Dataset):
+        return selection_fingerprint(df.schema.to_string(), df.files)
+
+    return get_frame_version(df)
+
+def get_cached_timeseries(df: Union[pd.DataFrame, ds.Dataset],
+                          censustract_list: Optional[List[str]] = None,
+                          operation: str = "mean",
+                          weights: Optional[pd.Series] = None,
+                          metric: str = "UNITPRICE_ASKING",
+                          period_range: Optional[PeriodRange] = None
+                          ) -> Optional[pd.DataFrame]:
+    """
+    Cached version of get_timeseries_of_census_tracts.
+
+    The timeseries of every metric column are computed together and kept in
+    AGGREGATE_CACHE, keyed by the dataset version, the census tracts, the
+    operation, the weights and the period range, so switching metric is a cache hit.
+    """
+    if censustract_list is None:
+        return None
+
+    # Check if the operation is valid
+    if operation not in ["mean", "median"]:
+        raise ValueError("Operation must be 'mean' or 'median'")
+
+    key = selection_fingerprint(
+        get_dataset_version(df),
+        censustract_list,
+        operation,
+        None if weights is None else weights.round(6).items(),
+        None if period_range is None else str(get_quarter_bounds(period_range)),
+    )
+    aggregated_df = AGGREGATE_CACHE.get(key)
+    if aggregated_df is None:
+        aggregated_df = get_multi_metric_timeseries(
+            df, censustract_list, statistics=[operation], weights=weights, period_range=period_range
+        )
+        AGGREGATE_CACHE.put(key, aggregated_df)
+    return aggregated_df[metric][operation]
+
+def build_aggregate_cube(df: pd.DataFrame, metric: str = "UNITPRICE_ASKING") -> dict:
+    """
+    Pre-aggregate a metric by census tract, period, operation and typology.
+
+    Sums and counts of the non-null values are stored as dense arrays, so the
+    mean over any set of census tracts and typologies is a slice and a sum of
+    these arrays, without filtering the listings again.
+
+    Args:
+      df (pd.DataFrame): The processed dataframe from idealista dataset 02 metricas de mercado.
+      metric (str): The metric column to aggregate.
+
+    Returns:
+      dict: The "censustracts", "periods", "operations" and "typologies"
+        indexes labelling the axes, the "quarters" ordinals of the periods,
+        and the "sums" and "counts" arrays of shape
+        (censustracts, periods, operations, typologies).
+    """
+    tract_codes, censustracts = pd.factorize(df["CENSUSTRACT"], sort=True)
+    period_codes, periods = pd.factorize(df["PERIOD"], sort=True)
+    operation_codes = df["ADOPERATION"].cat.codes.to_numpy()
+    typology_codes = df["ADTYPOLOGY"].cat.codes.to_numpy()
+    operations = pd.Index(df["ADOPERATION"].cat.categories, name="ADOPERATION")
+    typologies = pd.Index(df["ADTYPOLOGY"].cat.categories, name="ADTYPOLOGY")
+
+    cube_shape = (len(censustracts), len(periods), len(operations), len(typologies))
+    values = df[metric].to_numpy(dtype=float)
+    valid = ~np.isnan(values) & (tract_codes >= 0) & (period_codes >= 0) & (operation_codes >= 0) & (typology_codes >= 0)
+
+    cells = np.ravel_multi_index(
+        (tract_codes[valid], period_codes[valid], operation_codes[valid], typology_codes[valid]), cube_shape
+    )
+    size = int(np.prod(cube_shape))
+
+    return {
+        "metric": metric,
+        "censustracts": pd.Index(censustracts, name="CENSUSTRACT"),
+        "periods": pd.Index(periods, name="PERIOD"),
+        "quarters": decode_periods(pd.Series(periods)),
+        "operations": operations,
+        "typologies": typologies,
+        "sums": np.bincount(cells, weights=values[valid], minlength=size).reshape(cube_shape),
+        "counts": np.bincount(cells, minlength=size).reshape(cube_shape).astype(np.int32),
+    }
+
+def get_cached_cube(df: pd.DataFrame, metric: str = "UNITPRICE_ASKING") -> dict:
+    """
+    Cached version of build_aggregate_cube, keyed by the dataset version and the metric.
+    """
+    key = selection_fingerprint(get_dataset_version(df), metric)
+    cube = CUBE_CACHE.get(key)
+    if cube is None:
+        cube = build_aggregate_cube(df, metric)
+        CUBE_CACHE.put(key, cube)
+    return cube
+
+def select_cube_cells(cube: dict,
+                      censustract_list: List[str],
+                      typologies: Optional[List[str]] = None,
+                      period_range: Optional[PeriodRange] = None
+                      ) -> Tuple[np.ndarray, np.ndarray, pd.Index, pd.Index, pd.Index]:
+    """
+    Slice the sums and counts of the given census tracts, typologies and
+    quarters from an aggregate cube.
+
+    Args:
+      cube (dict): As built by build_aggregate_cube.
+      censustract_list (List[str]): The census tracts; those not in the cube are skipped.
+      typologies (Optional[List[str]]): The typologies to keep; all if None or empty.
+      period_range (Optional[PeriodRange]): The quarters to keep; all if None.
+
+    Returns:
+      Tuple[np.ndarray, np.ndarray, pd.Index, pd.Index, pd.Index]: The sums and
+        counts of shape (censustracts, periods, operations, typologies), and the
+        census tracts, periods and typologies found in the cube, labelling their
+        first, second and last axes.
+    """
+    censustracts = pd.Index(list(censustract_list))
+    tract_positions = cube["censustracts"].get_indexer(censustracts)
+    found = tract_positions >= 0
+    tract_positions = tract_positions[found]
+
+    typology_positions = np.arange(len(cube["typologies"]))
+    if typologies:
+        typology_positions = cube["typologies"].get_indexer(list(typologies))
+        typology_positions = typology_positions[typology_positions >= 0]
+
+    # The periods are sorted, so the time window is a contiguous slice
+    periods = slice(None)
+    if period_range is not None:
+        first_quarter, last_quarter = get_quarter_bounds(period_range)
+        periods = slice(
+            np.searchsorted(cube["quarters"], first_quarter, side="left"),
+            np.searchsorted(cube["quarters"], last_quarter, side="right"),
+        )
+
+    sums = cube["sums"][tract_positions, periods][..., typology_positions]
+    counts = cube["counts"][tract_positions, periods][..., typology_positions]
+    return sums, counts, censustracts[found], cube["periods"][periods], cube["typologies"][typology_positions]
+
+def get_cube_timeseries(cube: dict,
+                        censustract_list: Optional[List[str]],
+                        typologies: Optional[List[str]] = None,
+                        weights: Optional[pd.Series] = None,
+                        by_typology: bool = False,
+                        period_range: Optional[PeriodRange] = None
+                        ) -> Optional[pd.DataFrame]:
+    """
+    Get the mean timeseries of the given census tracts from an aggregate cube.
+
+    Args:
+      cube (dict): As built by build_aggregate_cube.
+      censustract_list (Optional[List[str]]): The list of census tracts.
+      typologies (Optional[List[str]]): The typologies to keep; all if None or empty.
+      weights (Optional[pd.Series]): Weight of each census tract, indexed by
+        CENSUSTRACT. When given, the weighted mean is taken.
+      by_typology (bool): Whether to return one timeseries per typology instead
+        of the mean over the selected typologies.
+      period_range (Optional[PeriodRange]): Only include these quarters; all if None.
+
+    Returns:
+      Optional[pd.DataFrame]: The timeseries indexed by PERIOD, with ADOPERATION
+        columns, or (ADTYPOLOGY, ADOPERATION) columns if by_typology.
+        If censustract_list is None, returns None.
+    """
+    if censustract_list is None:
+        return None
+
+    sums, counts, censustracts, period_index, typology_index = select_cube_cells(
+        cube, censustract_list, typologies, period_range
+    )
+
+    if weights is not None:
+        tract_weights = weights.reindex(censustracts).fillna(0.0).to_numpy()
+        sums = np.einsum("t,tpoy->poy", tract_weights, sums)
+        counts = np.einsum("t,tpoy->poy", tract_weights, counts)
+    else:
+        sums = sums.sum(axis=0)
+        counts = counts.sum(axis=0)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        if by_typology:
+            means = sums / counts
+            columns = pd.MultiIndex.from_product(
+                [typology_index, cube["operations"]], names=["ADTYPOLOGY", "ADOPERATION"]
+            )
+            return pd.DataFrame(means.transpose(0, 2, 1).reshape(len(period_index), -1), index=period_index, columns=columns)
+
+        means = sums.sum(axis=-1) / counts.sum(axis=-1)
+        return pd.DataFrame(means, index=period_index, columns=cube["operations"])
+
+def get_ring_timeseries(cube: dict,
+                        rings: pd.DataFrame,
+                        typologies: Optional[List[str]] = None,
+                        period_range: Optional[PeriodRange] = None
+                        ) -> pd.DataFrame:
+    """
+    Get the mean timeseries of every distance ring from an aggregate cube.
+
+    The cells of all the ring census tracts are sliced from the cube at once
+    and summed per ring with a single (rings x census tracts) product.
+
+    Args:
+      cube (dict): As built by build_aggregate_cube.
+      rings (pd.DataFrame): As returned by get_impact_rings.
+      typologies (Optional[List[str]]): The typologies to keep; all if None or empty.
+      period_range (Optional[PeriodRange]): Only include these quarters; all if None.
+
+    Returns:
+      pd.DataFrame: The timeseries indexed by PERIOD, with (RING, ADOPERATION)
+        columns for every ring, NaN where a ring has no listings.
+    """
+    ring_labels = rings["RING"].cat.categories
+    sums, counts, censustracts, period_index, _ = select_cube_cells(
+        cube, rings["CENSUSTRACT"].tolist(), typologies, period_range
+    )
+    ring_codes = rings["RING"].cat.codes.to_numpy()[pd.Index(rings["CENSUSTRACT"]).get_indexer(censustracts)]
+    membership = np.eye(len(ring_labels))[:, ring_codes]
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = (
+            np.einsum("rt,tpo->rpo", membership, sums.sum(axis=-1))
+            / np.einsum("rt,tpo->rpo", membership, counts.sum(axis=-1))
+        )
+    columns = pd.MultiIndex.from_product([ring_labels, cube["operations"]], names=["RING", "ADOPERATION"])
+    return pd.DataFrame(means.transpose(1, 0, 2).reshape(len(period_index), -1), index=period_index, columns=columns)
+
+def get_bootstrap_bands(cube: dict,
+                        censustract_list: Optional[List[str]],
+                        typologies: Optional[List[str]] = None,
+                        weights: Optional[pd.Series] = None,
+                        replicates: int = BOOTSTRAP_REPLICATES,
+                        confidence: float = BOOTSTRAP_CONFIDENCE,
+                        seed: int = BOOTSTRAP_SEED,
+                        period_range: Optional[PeriodRange] = None
+                        ) -> Optional[Tuple[pd.DataFrame, pd.DataFrame]]:
+    """
+    Get bootstrap confidence bands of the mean timeseries of a set of census tracts.
+
+    The census tracts are resampled with replacement. The number of draws of
+    each tract in each replicate is one (replicates, censustracts) matrix,
+    multiplied against the (censustracts, periods x operations) sums and
+    counts of the cube, so every replicate mean is computed in two matrix
+    products.
+
+    Args:
+      cube (dict): As built by build_aggregate_cube.
+      censustract_list (Optional[List[str]]): The list of census tracts.
+      typologies (Optional[List[str]]): The typologies to keep; all if None or empty.
+      weights (Optional[pd.Series]): Weight of each census tract, indexed by
+        CENSUSTRACT, applied on top of the resampling.
+      replicates (int): Number of bootstrap replicates.
+      confidence (float): Confidence level of the bands.
+      seed (int): Seed of the resampling, so the bands of a selection are stable.
+      period_range (Optional[PeriodRange]): Only include these quarters; all if None.
+
+    Returns:
+      Optional[Tuple[pd.DataFrame, pd.DataFrame]]: The lower and upper bands,
+        indexed by PERIOD with ADOPERATION columns. None if no census tract of
+        the list is in the cube.
+    """
+    if not censustract_list:
+        return None
+
+    sums, counts, censustracts, period_index, _ = select_cube_cells(cube, censustract_list, typologies, period_range)
+    n_tracts = len(censustracts)
+    if n_tracts == 0:
+        return None
+
+    # (censustracts, periods x operations), summed over the typologies
+    flat_sums = sums.sum(axis=-1).reshape(n_tracts, -1)
+    flat_counts = counts.sum(axis=-1).reshape(n_tracts, -1).astype(float)
+
+    rng = np.random.default_rng(seed)
+    draws = rng.multinomial(n_tracts, np.full(n_tracts, 1 / n_tracts), size=replicates).astype(float)
+    if weights is not None:
+        draws *= weights.reindex(censustracts).fillna(0.0).to_numpy()
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        replicate_means = (draws @ flat_sums) / (draws @ flat_counts)
+        alpha = (1 - confidence) / 2
+        lower, upper = np.nanquantile(replicate_means, [alpha, 1 - alpha], axis=0)
+
+    shape = (len(period_index), len(cube["operations"]))
+    return tuple(
+        pd.DataFrame(band.reshape(shape), index=period_index, columns=cube["operations"])
+        for band in (lower, upper)
+    )
+
+def get_cached_bootstrap_bands(df: pd.DataFrame,
+                               censustract_list: Optional[List[str]],
+                               metric: str = "UNITPRICE_ASKING",
+                               typologies: Optional[List[str]] = None,
+                               weights: Optional[pd.Series] = None,
+                               period_range: Optional[PeriodRange] = None
+                               ) -> Optional[Tuple[pd.DataFrame, pd.DataFrame]]:
+    """
+    Cached version of get_bootstrap_bands over the aggregate cube of a metric.
+
+    The bands are kept in AGGREGATE_CACHE with the series, keyed by the dataset
+    version, the metric, the census tracts, the typologies, the weights, the
+    period range and the bootstrap parameters.
+    """
+    if not censustract_list:
+        return None
+
+    key = selection_fingerprint(
+        "bootstrap",
+        get_dataset_version(df),
+        metric,
+        censustract_list,
+        typologies,
+        None if weights is None else weights.round(6).items(),
+        None if period_range is None else str(get_quarter_bounds(period_range)),
+        BOOTSTRAP_REPLICATES, BOOTSTRAP_CONFIDENCE, BOOTSTRAP_SEED,
+    )
+    bands = AGGREGATE_CACHE.get(key)
+    if bands is None:
+        bands = get_bootstrap_bands(
+            get_cached_cube(df, metric), censustract_list, typologies, weights, period_range=period_range
+        )
+        AGGREGATE_CACHE.put(key, bands)
+    return bands
+
+def build_choropleth_arrays(cube: dict, intervention_index: pd.DataFrame) -> dict:
+    """
+    Compute the citywide map measures of every census tract, period and
+    operation in one vectorized pass over an aggregate cube:
+
+    - "value": the mean of the metric over all typologies.
+    - "yoy": the change of the value since the same period twelve months earlier.
+    - "intervention_delta": the change of the value since before the
+      interventions of the census tract, i.e. relative to its mean over the
+      quarters before the first intervention started; only defined for the
+      quarters after the last intervention ended.
+
+    Args:
+      cube (dict): As built by build_aggregate_cube.
+      intervention_index (pd.DataFrame): The output of build_intervention_index.
+
+    Returns:
+      dict: The zero-padded "censustracts", "periods" and "operations" indexes
+        labelling the axes, and the arrays of each measure of shape
+        (censustracts, periods, operations) in "measures", NaN where undefined.
+    """
+    sums = cube["sums"].sum(axis=-1)
+    counts = cube["counts"].sum(axis=-1)
+    quarters = cube["quarters"].astype(np.int64)
+    censustracts = pd.Index(cube["censustracts"].astype(str).str.zfill(10), name="CENSUSTRACT")
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        value = sums / counts
+
+        # Position of the period twelve months earlier, where it is in the cube
+        months = pd.PeriodIndex(pd.to_datetime(cube["periods"]), freq="M").asi8
+        previous = np.clip(np.searchsorted(months, months - 12), 0, max(len(months) - 1, 0))
+        has_previous = months[previous] == months - 12
+        yoy = np.full_like(value, np.nan)
+        yoy[:, has_previous] = value[:, has_previous] / value[:, previous[has_previous]] - 1
+
+        # First start and last end quarter of the interventions of each census
+        # tract; NaN for the census tracts without interventions
+        spans = intervention_index.groupby("CENSUSTRACT").agg(START=("START", "min"), END=("END", "max"))
+        first_start = pd.Series(spans["START"].dt.to_period("Q").array.asi8, index=spans.index, dtype=float)
+        last_end = pd.Series(spans["END"].dt.to_period("Q").array.asi8, index=spans.index, dtype=float)
+        first_start = first_start.reindex(censustracts).to_numpy()
+        last_end = last_end.reindex(censustracts).to_numpy()
+
+        before = (quarters[None, :] < first_start[:, None])[..., None]
+        after = (quarters[None, :] > last_end[:, None])[..., None]
+        baseline = (sums * before).sum(axis=1) / (counts * before).sum(axis=1)
+        intervention_delta = np.where(after, value / baseline[:, None, :] - 1, np.nan)
+
+    return {
+        "metric": cube["metric"],
+        "censustracts": censustracts,
+        "periods": cube["periods"],
+        "operations": cube["operations"],
+        "measures": {"value": value, "yoy": yoy, "intervention_delta": intervention_delta},
+    }
+
+def get_cached_choropleth_arrays(df: pd.DataFrame,
+                                 intervention_index: pd.DataFrame,
+                                 metric: str = "UNITPRICE_ASKING"
+                                 ) -> dict:
+    """
+    Cached version of build_choropleth_arrays over the aggregate cube of a
+    metric, kept in CUBE_CACHE and keyed by the versions of the listings and
+    the intervention index and the metric.
+    """
+    key = selection_fingerprint(
+        "choropleth", get_dataset_version(df), get_dataset_version(intervention_index), metric
+    )
+    choropleth = CUBE_CACHE.get(key)
+    if choropleth is None:
+        choropleth = build_choropleth_arrays(get_cached_cube(df, metric), intervention_index)
+        CUBE_CACHE.put(key, choropleth)
+    return choropleth
+
+def get_choropleth_colors(choropleth: dict,
+                          measure: str,
+                          period: pd.Timestamp,
+                          operation: str
+                          ) -> Tuple[pd.DataFrame, List[Tuple[float, str]]]:
+    """
+    Colour the census tracts by a measure of the citywide map in one period.
+
+    The colour scale (CHOROPLETH_COLOR_SCALES) spans the CHOROPLETH_PERCENTILES
+    of the measure over all the periods, so colours are comparable while
+    moving through the periods; the changes use a scale symmetric around zero.
+
+    Args:
+      choropleth (dict): As built by build_choropleth_arrays.
+      measure (str): A key of CHOROPLETH_MEASURES.
+      period (pd.Timestamp): The PERIOD shown, from choropleth["periods"].
+      operation (str): The operation (sale, rent) shown.
+
+    Returns:
+      Tuple[pd.DataFrame, List[Tuple[float, str]]]: The COLOR and LABEL of the
+        census tracts with a value in this period, indexed by CENSUSTRACT, and
+        the (value, colour) stops of the legend.
+    """
+    values = choropleth["measures"][measure][:, :, choropleth["operations"].get_loc(operation)]
+    finite = values[np.isfinite(values)]
+    if finite.size:
+        low, high = np.percentile(finite, CHOROPLETH_PERCENTILES)
+    else:
+        low, high = 0.0, 1.0
+    if measure != "value":
+        high = max(abs(low), abs(high))
+        low = -high
+    if high <= low:
+        high = low + 1.0
+
+    period_values = pd.Series(
+        values[:, choropleth["periods"].get_loc(period)], index=choropleth["censustracts"]
+    ).dropna()
+    scale = CHOROPLETH_COLOR_SCALES[measure]
+    positions = np.clip((period_values.to_numpy() - low) / (high - low), 0.0, 1.0)
+    colors = plotly.colors.sample_colorscale(scale, positions.tolist()) if len(positions) else []
+
+    if measure == "value":
+        labels = period_values.map("{:,.1f}".format)
+    else:
+        labels = (period_values * 100).map("{:+.1f}%".format)
+
+    stops = np.linspace(low, high, 5)
+    legend = list(zip(stops.tolist(), plotly.colors.sample_colorscale(scale, np.linspace(0.0, 1.0, 5).tolist())))
+    return pd.DataFrame({"COLOR": colors, "LABEL": labels.to_numpy()}, index=period_values.index), legend
+
+def build_event_study(cube: dict,
+                      intervention_index: pd.DataFrame,
+                      typologies: Optional[List[str]] = None,
+                      window: Tuple[int, int] = EVENT_STUDY_WINDOW,
+                      baseline_quarters: int = EVENT_STUDY_BASELINE_QUARTERS
+                      ) -> dict:
+    """
+    Align the impacted series of every intervention on its start quarter.
+
+    The sums and counts of the census tracts of each intervention are added
+    with one sparse (interventions x census tracts) product over the cube,
+    laid on a gapless quarter axis, and the window around every start quarter
+    is gathered for all the interventions at once. Each aligned series is the
+    relative change over its mean in the baseline_quarters before the start.
+
+    Args:
+      cube (dict): As built by build_aggregate_cube.
+      intervention_index (pd.DataFrame): The output of build_intervention_index;
+        the interventions are its TITOL_WOs, starting at their first START.
+      typologies (Optional[List[str]]): The typologies to keep; all if None or empty.
+      window (Tuple[int, int]): First and last quarter, relative to the start quarter.
+      baseline_quarters (int): Quarters before the start averaged as baseline.
+
+    Returns:
+      dict: The "interventions", their "labels" (SHORTNAME), "starts" and
+        "censustracts" count, the quarter "offsets" and the "operations" labelling the axes, and the
+        "changes" array of shape (interventions, offsets, operations), NaN where
+        the listings do not cover the quarter or the baseline.
+    """
+    typology_positions = np.arange(len(cube["typologies"]))
+    if typologies:
+        typology_positions = cube["typologies"].get_indexer(list(typologies))
+        typology_positions = typology_positions[typology_positions >= 0]
+    sums = cube["sums"][..., typology_positions].sum(axis=-1)
+    counts = cube["counts"][..., typology_positions].sum(axis=-1)
+    n_tracts, n_periods, n_operations = sums.shape
+
+    # Interventions x census tracts membership, from the zero-padded census tracts of the index
+    intervention_codes, interventions = pd.factorize(intervention_index["TITOL_WO"], sort=True)
+    tract_positions = cube["censustracts"].astype(str).str.zfill(10).get_indexer(intervention_index["CENSUSTRACT"])
+    found = tract_positions >= 0
+    membership = sparse.coo_matrix(
+        (np.ones(found.sum()), (intervention_codes[found], tract_positions[found])),
+        shape=(len(interventions), n_tracts),
+    ).tocsr()
+    membership.data[:] = 1.0
+    intervention_sums = (membership @ sums.reshape(n_tracts, -1)).reshape(-1, n_periods, n_operations)
+    intervention_counts = (membership @ counts.reshape(n_tracts, -1)).reshape(-1, n_periods, n_operations)
+
+    # Gapless quarter axis, so an offset from the start is a fixed step
+    quarters = cube["quarters"].astype(np.int64)
+    valid = quarters > np.iinfo(np.int16).min
+    first_quarter = quarters[valid].min() if valid.any() else 0
+    span = int(quarters[valid].max() - first_quarter + 1) if valid.any() else 0
+    dense_sums = np.zeros((len(interventions), span, n_operations))
+    dense_counts = np.zeros((len(interventions), span, n_operations))
+    # Added up, as the monthly periods of a quarter share its position
+    np.add.at(dense_sums, (slice(None), quarters[valid] - first_quarter), intervention_sums[:, valid])
+    np.add.at(dense_counts, (slice(None), quarters[valid] - first_quarter), intervention_counts[:, valid])
+
+    by_intervention = intervention_index.groupby("TITOL_WO")
+    starts = by_intervention["START"].min().reindex(interventions)
+    labels = by_intervention["SHORTNAME"].first().reindex(interventions)
+    start_positions = starts.dt.to_period("Q").array.asi8 - first_quarter
+
+    def gather(offsets: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        # (interventions, offsets) positions on the quarter axis, zero outside of it
+        positions = start_positions[:, None] + offsets[None, :]
+        inside = ((positions >= 0) & (positions < span))[..., None]
+        if span == 0:
+            return np.zeros(inside.shape[:2] + (n_operations,)), np.zeros(inside.shape[:2] + (n_operations,))
+        rows = np.arange(len(interventions))[:, None]
+        clipped = np.clip(positions, 0, span - 1)
+        return np.where(inside, dense_sums[rows, clipped], 0.0), np.where(inside, dense_counts[rows, clipped], 0.0)
+
+    offsets = np.arange(window[0], window[1] + 1)
+    aligned_sums, aligned_counts = gather(offsets)
+    baseline_sums, baseline_counts = gather(np.arange(-baseline_quarters, 0))
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        baseline = baseline_sums.sum(axis=1) / baseline_counts.sum(axis=1)
+        changes = (aligned_sums / aligned_counts) / baseline[:, None, :] - 1
+
+    return {
+        "metric": cube["metric"],
+        "interventions": pd.Index(interventions, name="TITOL_WO"),
+        "labels": pd.Index(labels.values, name="SHORTNAME"),
+        "starts": pd.DatetimeIndex(starts.values, name="START"),
+        "censustracts": np.asarray(membership.sum(axis=1)).ravel().astype(int),
+        "offsets": pd.Index(offsets, name="QUARTERS_SINCE_START"),
+        "operations": cube["operations"],
+        "changes": changes,
+    }
+
+def get_cached_event_study(df: pd.DataFrame,
+                           intervention_index: pd.DataFrame,
+                           metric: str = "UNITPRICE_ASKING",
+                           typologies: Optional[List[str]] = None
+                           ) -> dict:
+    """
+    Cached version of build_event_study over the aggregate cube of a metric,
+    kept in AGGREGATE_CACHE and keyed by the versions of the listings and the
+    intervention index, the metric, the typologies and the window.
+    """
+    key = selection_fingerprint(
+        "event_study", get_dataset_version(df), get_dataset_version(intervention_index), metric, typologies,
+        str(EVENT_STUDY_WINDOW), EVENT_STUDY_BASELINE_QUARTERS,
+    )
+    event_study = AGGREGATE_CACHE.get(key)
+    if event_study is None:
+        event_study = build_event_study(get_cached_cube(df, metric), intervention_index, typologies)
+        AGGREGATE_CACHE.put(key, event_study)
+    return event_study
+
+def get_event_study_summary(event_study: dict,
+                            interventions: Optional[List[str]] = None,
+                            percentiles: Tuple[float, float] = EVENT_STUDY_BAND_PERCENTILES
+                            ) -> pd.DataFrame:
+    """
+    Summarize the aligned changes across interventions.
+
+    Args:
+      event_study (dict): As built by build_event_study.
+      interventions (Optional[List[str]]): The TITOL_WOs to include; all if None or empty.
+      percentiles (Tuple[float, float]): Lower and upper percentiles of the spread band.
+
+    Returns:
+      pd.DataFrame: Indexed by the quarter offsets, with (statistic, ADOPERATION)
+        columns: the "mean" change, the "lower" and "upper" band and the "count"
+        of interventions with a change.
+    """
+    changes = event_study["changes"]
+    if interventions:
+        changes = changes[event_study["interventions"].isin(interventions)]
+
+    with warnings.catch_warnings():
+        # Offsets without any intervention are NaN
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        statistics = {
+            "mean": np.nanmean(changes, axis=0),
+            "lower": np.nanpercentile(changes, percentiles[0], axis=0),
+            "upper": np.nanpercentile(changes, percentiles[1], axis=0),
+            "count": (~np.isnan(changes)).sum(axis=0),
+        }
+    return pd.concat(
+        {
+            name: pd.DataFrame(values, index=event_study["offsets"], columns=event_study["operations"])
+            for name, values in statistics.items()
+        },
+        axis=1,
     )
 
-    #print("Resultado dentro de get_timeseries_of_census_tracts:", aggregated_df)
+def get_trend_key(series: pd.Series) -> str:
+    """
+    Get the key of the trend of a series: its name, its contents and the
+    Prophet settings (TREND_MODEL_SETTINGS).
 
-    return aggregated_df
+    Args:
+      series (pd.Series): The time series.
+
+    Returns:
+      str: Hex digest identifying the trend.
+    """
+    series_hash = hashlib.sha1(pd.util.hash_pandas_object(series).values.tobytes()).hexdigest()
+    return selection_fingerprint(str(series.name), series_hash, json.dumps(TREND_MODEL_SETTINGS, sort_keys=True))
+
+def get_cached_trend(series: pd.Series) -> pd.Series:
+    """
+    Cached version of get_trend_of_timeseries.
+
+    Trends are kept in TREND_CACHE, keyed by the contents of the series, so
+    the same curve is only fitted once per process.
+    """
+    key = get_trend_key(series)
+    trend = TREND_CACHE.get(key)
+    if trend is None:
+        trend = get_trend_of_timeseries(series)
+        TREND_CACHE.put(key, trend)
+    return trend
+
+def load_trend_store(store_dir: Path = TREND_STORE_DIR) -> Dict[str, pd.Series]:
+    """
+    Load the precomputed trends, once per process.
+
+    Args:
+      store_dir (Path): Directory of the Parquet files written by
+        modeling/train.py precompute-trends.
+
+    Returns:
+      Dict[str, pd.Series]: The trends by trend key (see get_trend_key).
+        Empty if nothing has been precomputed.
+    """
+    global _TREND_STORE
+    with _TREND_STORE_LOCK:
+        if _TREND_STORE is None:
+            store = {}
+            if store_dir.exists():
+                for path in sorted(store_dir.glob("*.parquet")):
+                    with path.open("rb") as f:
+                        trends_df = pd.read_parquet(f, columns=["KEY", "NAME", "PERIOD", "TREND"])
+                    for key, trend_df in trends_df.groupby("KEY", sort=False):
+                        store[key] = pd.Series(
+                            trend_df["TREND"].values,
+                            index=pd.DatetimeIndex(trend_df["PERIOD"], name="PERIOD"),
+                            name=trend_df["NAME"].iloc[0],
+                        )
+            _TREND_STORE = store
+    return _TREND_STORE
 
 def get_trend_of_timeseries(series: pd.Series) -> pd.Series:
     """
     Get the trend of a time series.
 
+    Trends precomputed for the districts and interventions are read from the
+    trend store; any other series (e.g. of a drawn polygon) is fitted live.
+
     Args:
       series (pd.Series): The time series.
 
@@ -141,12 +1667,28 @@ def get_trend_of_timeseries(series: pd.Series) -> pd.Series:
     if series.name is None:
         series.name = "trend"
 
+    stored_trend = load_trend_store().get(get_trend_key(series))
+    if stored_trend is not None:
+        return stored_trend.rename(series.name)
+
+    return fit_trend(series)
+
+def fit_trend(series: pd.Series) -> pd.Series:
+    """
+    Fit the trend of a named time series with Prophet (TREND_MODEL_SETTINGS).
+
+    Args:
+      series (pd.Series): The time series.
+
+    Returns:
+      pd.Series: The trend of the time series.
+    """
     # Prepare the data for Prophet
     series_copy = series.reset_index()
     series_copy.columns = ["ds", "y"]
 
     # Initialize and fit the Prophet model
-    trend = Prophet()
+    trend = Prophet(**TREND_MODEL_SETTINGS)
     trend.fit(series_copy)
 
     # Create a future DataFrame and make predictions
@@ -161,26 +1703,102 @@ def get_trend_of_timeseries(series: pd.Series) -> pd.Series:
 
     return trend_series_flat
 
-def merge_intervals(intervals):
-    """Merge overlapping intervals and return merged intervals with associated interventions."""
-    if not intervals:
+def get_intervention_shortnames(interventions_gdf: gpd.GeoDataFrame) -> pd.Series:
+    """
+    Get a short display name for each intervention.
+
+    The short name column of the interventions layer is used when present.
+    Otherwise the name is derived from TITOL_WO, keeping the text before any
+    ':' or '(' and shortening it to INTERVENTIONS_SHORTNAME_MAX_LENGTH.
+
+    Args:
+      interventions_gdf (gpd.GeoDataFrame): The information about interventions.
+
+    Returns:
+      pd.Series: The short names, aligned with interventions_gdf.
+    """
+    titles = interventions_gdf["TITOL_WO"].astype(str)
+    derived = (
+        titles
+        .str.split(r"[:(]", n=1, regex=True).str[0]
+        .str.strip(" .-")
+        .where(lambda names: names != "", titles.str.strip())
+        .map(lambda name: textwrap.shorten(name, width=INTERVENTIONS_SHORTNAME_MAX_LENGTH, placeholder="…"))
+    )
+
+    if INTERVENTIONS_SHORTNAME_COLUMN in interventions_gdf.columns:
+        return interventions_gdf[INTERVENTIONS_SHORTNAME_COLUMN].fillna(derived).astype(str)
+    return derived
+
+def build_intervention_index(interventions_gdf: gpd.GeoDataFrame) -> pd.DataFrame:
+    """
+    Build the table of intervention periods per census tract.
+
+    Meant to be computed once at load time; the input is not modified.
+
+    Args:
+      interventions_gdf (gpd.GeoDataFrame): The information about interventions.
+
+    Returns:
+      pd.DataFrame: One row per (census tract, intervention) with the
+        zero-padded CENSUSTRACT, the START and END dates, the TITOL_WO
+        identifying the intervention and its SHORTNAME label, sorted by START.
+    """
+    def as_naive_dates(column: pd.Series) -> pd.Series:
+        dates = pd.to_datetime(column)
+        if dates.dt.tz is not None:
+            dates = dates.dt.tz_localize(None)
+        return dates.dt.normalize()
+
+    intervention_index = pd.DataFrame({
+        "CENSUSTRACT": interventions_gdf["CENSUSTRACT"].astype(int).astype(str).str.zfill(10).values,
+        "START": as_naive_dates(interventions_gdf["DATA_INICI"]).values,
+        "END": as_naive_dates(interventions_gdf["DATA_FI_REAL"]).values,
+        "TITOL_WO": interventions_gdf["TITOL_WO"].astype(str).values,
+        "SHORTNAME": get_intervention_shortnames(interventions_gdf).values,
+    })
+
+    return (
+        intervention_index
+        .dropna(subset=["START", "END"])
+        .sort_values(["START", "END"])
+        .reset_index(drop=True)
+    )
+
+def get_intervention_periods(intervention_index: pd.DataFrame,
+                             censustract_list: Optional[List[str]]
+                             ) -> List[Tuple[pd.Timestamp, pd.Timestamp, set]]:
+    """
+    Get the merged intervention periods for a set of census tracts.
+
+    Overlapping intervals of the intervention index (sorted by START) are
+    merged: a new period starts whenever an interval begins after the latest
+    end seen so far.
+
+    Args:
+      intervention_index (pd.DataFrame): The output of build_intervention_index.
+      censustract_list (Optional[List[str]]): The census tracts to look up.
+
+    Returns:
+      List[Tuple[pd.Timestamp, pd.Timestamp, set]]: The merged periods with the
+        short names of the interventions they cover.
+    """
+    if not censustract_list:
         return []
 
-    # Sort intervals by start time
-    intervals.sort(key=lambda x: x[0])
-    merged = []
-    current_start, current_end, interventions = intervals[0][0], intervals[0][1], intervals[0][2]
+    censustracts = pd.Index(censustract_list).astype(str).str.zfill(10)
+    selected = intervention_index[intervention_index["CENSUSTRACT"].isin(censustracts)]
+    if selected.empty:
+        return []
 
-    for start, end, intervention in intervals[1:]:
-        if start <= current_end:  # Overlapping intervals
-            current_end = max(current_end, end)
-            interventions.update(intervention)
-        else:
-            merged.append((current_start, current_end, interventions))
-            current_start, current_end, interventions = start, end, intervention
+    period_id = (selected["START"] > selected["END"].cummax().shift()).cumsum()
+    merged = (
+        selected
+        .groupby(period_id)
+        .agg(START=("START", "min"), END=("END", "max"), SHORTNAME=("SHORTNAME", set))
+    )
 
-    merged.append((current_start, current_end, interventions))
-    return merged
+    return list(merged.itertuples(index=False, name=None))
 
 def add_geometry_layer(gdf, geojson_layer, style_dict = None):
     for _, row in gdf.iterrows():
@@ -198,16 +1816,197 @@ def add_geometry_layer(gdf, geojson_layer, style_dict = None):
         ).add_to(geojson_layer)
     
 
+def get_layer_topojson(gdf: gpd.GeoDataFrame, name: str, columns: Optional[List[str]] = None) -> dict:
+    """
+    Encode a map layer as a quantized EPSG:4326 TopoJSON topology (see
+    topology.encode_topology), much smaller than its GeoJSON.
+
+    Args:
+      gdf (gpd.GeoDataFrame): The geometries.
+      name (str): Name of the object of the topology.
+      columns (Optional[List[str]]): The properties to keep; none if None.
+
+    Returns:
+      dict: The TopoJSON Topology, with the layer in objects[name].
+    """
+    return encode_topology({name: gdf.to_crs("EPSG:4326")}, {name: columns or []})
+
+def build_base_map(city_config: dict,
+                   intervention_layer: Optional[dict] = None,
+                   draw_options: Optional[dict] = None
+                   ) -> folium.Map:
+    """
+    Build the static part of a page map: the tiles, the whole intervention
+    layer, the drawing tools and the fullscreen button.
+
+    The map is built the same way on every rerun, so streamlit-folium keeps the
+    map already shown in the browser and only swaps the overlays passed as
+    feature_group_to_add (see build_overlay). Maps are not shared between
+    reruns because st_folium modifies them when rendering.
+
+    Args:
+      city_config (dict): The city, from config.CITIES (map centre and zoom).
+      intervention_layer (Optional[dict]): The intervention layer, as returned by
+        get_layer_topojson with the "interventions" name and the TITOL_WO column;
+        no layer if None.
+      draw_options (Optional[dict]): The draw_options of the Draw plugin.
+
+    Returns:
+      folium.Map: The base map.
+    """
+    m = folium.Map(location=city_config["center"], zoom_start=city_config["zoom"], tiles="cartodbpositron")
+
+    if intervention_layer is not None:
+        # TopoJson adds the styles to the geometries, so the shared layer is not modified
+        folium.TopoJson(
+            {**intervention_layer, "objects": copy.deepcopy(intervention_layer["objects"])},
+            "objects.interventions",
+            name="Show Urban Interventions",
+            tooltip=folium.GeoJsonTooltip(["TITOL_WO"], labels=False),
+            style_function=lambda x: MAP_LAYER_STYLES["interventions"],
+        ).add_to(m)
+
+    Draw(draw_options=draw_options, edit_options={"edit": True}).add_to(m)
+    Fullscreen(
+        position="bottomleft",
+        title="Expand me",
+        title_cancel="Exit me",
+        force_separate_button=True,
+    ).add_to(m)
+    return m
+
+def build_overlay(name: str, layers: List[Tuple[gpd.GeoDataFrame, str]]) -> folium.FeatureGroup:
+    """
+    Build a dynamic overlay of a page map, to pass to st_folium as
+    feature_group_to_add, so a selection change only sends the overlay.
+
+    Each layer is a single quantized TopoJSON (see get_layer_topojson), so the
+    borders shared by its census tracts are only sent once.
+
+    Args:
+      name (str): Name of the overlay in the layer control.
+      layers (List[Tuple[gpd.GeoDataFrame, str]]): The geometries and their
+        style in MAP_LAYER_STYLES. A TITOL_WO column is shown as tooltip.
+
+    Returns:
+      folium.FeatureGroup: The overlay.
+    """
+    overlay = folium.FeatureGroup(name=name)
+    for gdf, style in layers:
+        if gdf.empty:
+            continue
+        tooltip_columns = [column for column in ["TITOL_WO"] if column in gdf.columns]
+        folium.TopoJson(
+            get_layer_topojson(gdf, style, tooltip_columns),
+            f"objects.{style}",
+            tooltip=folium.GeoJsonTooltip(tooltip_columns, labels=False) if tooltip_columns else None,
+            style_function=lambda x, style=style: MAP_LAYER_STYLES[style],
+        ).add_to(overlay)
+    return overlay
+
+# Registers a TopoJSON layer of a map by name, so the colour overlays restyle it in place
+_CHOROPLETH_LAYER_TEMPLATE = Template("""
+{% macro script(this, kwargs) %}
+    window.choropleth_layers = window.choropleth_layers || {};
+    window.choropleth_layers[{{ this.layer_name|tojson }}] = {{ this._parent.get_name() }};
+{% endmacro %}
+""")
+
+# Sets the fill colour and tooltip of every feature of a registered layer; features
+# without a colour are left unfilled
+_CHOROPLETH_COLORS_TEMPLATE = Template("""
+{% macro script(this, kwargs) %}
+    (function() {
+        var layer = (window.choropleth_layers || {})[{{ this.layer_name|tojson }}];
+        if (!layer) { return; }
+        var colors = {{ this.colors|tojson }};
+        var labels = {{ this.labels|tojson }};
+        layer.eachLayer(function(feature_layer) {
+            var censustract = feature_layer.feature.properties.CENSUSTRACT;
+            var color = colors[censustract];
+            feature_layer.setStyle({fillColor: color || "grey", fillOpacity: color ? {{ this.fill_opacity }} : 0});
+            feature_layer.unbindTooltip();
+            feature_layer.bindTooltip(censustract + (color ? ": " + labels[censustract] : ""), {sticky: true});
+        });
+    })();
+{% endmacro %}
+""")
+
+def build_choropleth_map(city_config: dict, tract_layer: dict) -> folium.Map:
+    """
+    Build the static part of the citywide map: the tiles and every census
+    tract, uncoloured, registered for build_choropleth_overlay.
+
+    The map is the same for every measure and period, so streamlit-folium only
+    loads the census tract geometries once and a new period only sends the
+    colours of the census tracts.
+
+    Args:
+      city_config (dict): The city, from config.CITIES (map centre and zoom).
+      tract_layer (dict): The census tracts, as returned by get_layer_topojson
+        with the "censustracts" name and the zero-padded CENSUSTRACT column.
+
+    Returns:
+      folium.Map: The base map.
+    """
+    m = folium.Map(location=city_config["center"], zoom_start=city_config["zoom"], tiles="cartodbpositron")
+
+    layer = folium.TopoJson(
+        {**tract_layer, "objects": copy.deepcopy(tract_layer["objects"])},
+        "objects.censustracts",
+        name="Census tracts",
+        style_function=lambda x: {**CHOROPLETH_STYLE, "fillOpacity": 0},
+    ).add_to(m)
+    registration = MacroElement()
+    registration._template = _CHOROPLETH_LAYER_TEMPLATE
+    registration.layer_name = "censustracts"
+    registration.add_to(layer)
+
+    Fullscreen(position="bottomleft", force_separate_button=True).add_to(m)
+    return m
+
+def build_choropleth_overlay(colors: pd.DataFrame) -> folium.FeatureGroup:
+    """
+    Build the colours of the citywide map, to pass to st_folium as
+    feature_group_to_add: the overlay has no geometries, it restyles the
+    census tracts of build_choropleth_map in place.
+
+    Args:
+      colors (pd.DataFrame): The COLOR and LABEL of the census tracts, indexed
+        by zero-padded CENSUSTRACT, as returned by get_choropleth_colors.
+
+    Returns:
+      folium.FeatureGroup: The overlay.
+    """
+    overlay = folium.FeatureGroup(name="Colours", control=False)
+    restyle = MacroElement()
+    restyle._template = _CHOROPLETH_COLORS_TEMPLATE
+    restyle.layer_name = "censustracts"
+    restyle.colors = colors["COLOR"].to_dict()
+    restyle.labels = colors["LABEL"].to_dict()
+    restyle.fill_opacity = CHOROPLETH_STYLE["fillOpacity"]
+    restyle.add_to(overlay)
+    return overlay
+
 def plot_timeseries(df: pd.DataFrame,
-                    interventions_gdf: gpd.GeoDataFrame,
-                    impacted_gdf: gpd.GeoDataFrame,
+                    intervention_index: pd.DataFrame,
+                    impacted_gdf: Optional[gpd.GeoDataFrame],
                     ine_gdf: gpd.GeoDataFrame,
                     include_trends: bool=True,
                     price_type: str = 'both',
                     district: bool =True,
                     district_gdf: gpd.GeoDataFrame = None,
                     control_polygon: bool = False,
-                    control_gdf: gpd.GeoDataFrame = None,
+                    control_censustracts: Optional[List[str]] = None,
+                    area_weighted: bool = False,
+                    impacted_weights: Optional[pd.Series] = None,
+                    impacted_censustracts: Optional[List[str]] = None,
+                    metric: str = "UNITPRICE_ASKING",
+                    typologies: Optional[List[str]] = None,
+                    typology_breakdown: bool = False,
+                    confidence_bands: bool = False,
+                    period_range: Optional[PeriodRange] = None,
+                    impact_rings: Optional[pd.DataFrame] = None,
                     SALE_COLOR: str =  '#FBBC05',
                     RENT_COLOR: str =  '#45B905',
                     CONTROL_SALE: str = '#626262',
@@ -221,215 +2020,289 @@ def plot_timeseries(df: pd.DataFrame,
     If more than one census tract, the mean is taken.
     If include_trends is True, the trends are also plotted.
 
+    Figures are cached as serialized JSON, keyed by the fingerprint of the
+    selected, district and control census tracts, the plot options and the
+    colours, so repeated views skip every aggregation. Typology filters and
+    breakdowns are served from the pre-aggregated cube of the metric.
+
     Args:
       df (pd.DataFrame): The processed dataframe from idealista dataset 02 metricas de mercado.
-      interventions_gdf (gpd.GeoDataFrame): The information about interventions.
+      intervention_index (pd.DataFrame): Intervention periods per census tract,
+        as built by build_intervention_index.
+      impacted_gdf (Optional[gpd.GeoDataFrame]): The selected geometries; may be
+        None when impacted_censustracts or impacted_weights are given.
       censustract_list (Union[List[str], None]): The list of census tracts.
       include_trends (bool): Whether to include the trends.
+      area_weighted (bool): Weight each impacted census tract by the fraction of
+        its area covered by the selection instead of counting it in full.
+      impacted_weights (Optional[pd.Series]): Precomputed covered fractions per
+        census tract; computed from impacted_gdf when area_weighted and None.
+      impacted_censustracts (Optional[List[str]]): Precomputed impacted census
+        tracts (e.g. from an approximate grid lookup); when given, impacted_gdf
+        is not intersected with ine_gdf again.
+      control_censustracts (Optional[List[str]]): The census tracts of the
+        control group, plotted when control_polygon; aggregated from df like
+        the impacted ones.
+      metric (str): The metric column to plot.
+      typologies (Optional[List[str]]): Only include these typologies (ADTYPOLOGY);
+        all if None or empty.
+      typology_breakdown (bool): Whether to add one curve per typology for the
+        impacted census tracts.
+      confidence_bands (bool): Whether to shade the bootstrap confidence band
+        (see get_bootstrap_bands) of each average curve.
+      period_range (Optional[PeriodRange]): Only aggregate, fit and plot these
+        quarters; the whole span of the listings if None.
+      impact_rings (Optional[pd.DataFrame]): Distance rings around the
+        selection (see get_impact_rings); adds one curve per ring, from the
+        aggregate cube of the metric, fading with the distance.
 
     Returns:
       go.Figure: The figure.
 
     """
 
-    interventions_dict = {'Urbanització c. Almogàvers (Badajoz -Roc Boronat).': 'Almogàvers',
-                      'Superilla de Poblenou': 'Superilla Poblenou',
-                      'Eixos Verds Eixample ': 'Eixample',
-                      'Supermanzana EJE VERDE (Consell de cent, Rocafort, Conde Borrell y Girona)': 'Superilla EixVerd',
-                      'Eixos Verds LOT 4: Consell de Cent (Aribau - Rambla Catalunya)': 'LOT 4',
-                      'Eje verde de la calle de Girona entre la calle de la Diputació y la Gran Via de les Corts Catalanes': 'EixVerd Girona',
-                      'Urbanización de tramos de las calles de Puigcerdà, Cristòbal de Moura i Veneçuela ': 'Urbanització PCV',
-                      'Supermanzana EJE VERDE Consejo de Ciento con Rocafort, Conde Borrell, Enric Granados y Girona': 'Consell de Cent',
-                      'Eixos Verds LOT 2: Borrell (Aragó - Diputació) + Consell de Cent (Calàbria - Urgell) + Cruïlla': 'LOT 2',
-                      'Eixos Verds LOT 1: ': 'LOT 1',
-                      'Eix verd Sant Antoni': 'Sant Antoni'}
+    if area_weighted:
+        if impacted_weights is None:
+            impacted_weights = get_censustract_overlap_weights(impacted_gdf["geometry"].union_all(), ine_gdf)
+        censustract_list = impacted_weights.index.tolist()
+    elif impacted_censustracts is not None:
+        impacted_weights = None
+        censustract_list = list(impacted_censustracts)
+    else:
+        impacted_weights = None
+        censustract_list = get_impacted_censustracts(impacted_gdf["geometry"].union_all(), ine_gdf) 
+    census_district = list(district_gdf['CENSUSTRACT'].astype(int).astype(str)) if district else None
+    census_control = sorted({str(int(ct)) for ct in control_censustracts or []}) if control_polygon else None
+
+    # Only the operations that survive the price type filter are computed
+    operations = PRICE_TYPE_OPERATIONS.get(price_type, ["sale", "rent"])
+
+    figure_key = selection_fingerprint(
+        get_dataset_version(df),
+        [str(ct).zfill(10) for ct in censustract_list or []],
+        census_district,
+        census_control,
+        operations, include_trends, metric, typologies, typology_breakdown, confidence_bands,
+        None if period_range is None else str(get_quarter_bounds(period_range)),
+        None if impacted_weights is None else impacted_weights.round(6).items(),
+        None if impact_rings is None else (impact_rings["CENSUSTRACT"].astype(str) + "|" + impact_rings["RING"].astype(str)),
+        SALE_COLOR, RENT_COLOR, CONTROL_SALE, CONTROL_COLOR, INTERVENTION_COLOR,
+    )
+    cached_figure = FIGURE_CACHE.get(figure_key)
+    if cached_figure is not None:
+        return pio.from_json(cached_figure)
+
+    def get_series(data_df, censustracts, weights=None):
+        # Filtering by typology slices the pre-aggregated cube instead of the listings
+        if typologies:
+            return get_cube_timeseries(
+                get_cached_cube(df, metric), censustracts, typologies, weights, period_range=period_range
+            )
+        return get_cached_timeseries(data_df, censustracts, weights=weights, metric=metric, period_range=period_range)
 
-    censustract_list = get_impacted_censustracts(impacted_gdf["geometry"].union_all(), ine_gdf) 
-    df_census = get_timeseries_of_census_tracts(df, censustract_list)
+    df_census = get_series(df, censustract_list, impacted_weights)
 
     if df_census is None:
         raise ValueError("funtion get_timeseries_of_census_tracts returned None")
 
-    fig = make_subplots(specs=[[{"secondary_y": True}]])
-
-    fig.add_trace(
-        go.Scatter(x=df_census["sale"].index,
-                   y=df_census["sale"].values, 
-                   name="Average buy",
-                   line=dict(color= SALE_COLOR)),
-        secondary_y=False,
-    )
-
-    fig.add_trace(
-        go.Scatter(x=df_census["rent"].index,
-                   y=df_census["rent"].values,
-                   name="Average rent",
-                   line=dict(color= RENT_COLOR)),
-        secondary_y=True,
-    )
+    # Each group of series is drawn as one line per operation, plus its trend
+    series_groups = [
+        {"name": "Average", "trend_name": "Trend", "data": df_census,
+         "censustracts": censustract_list, "weights": impacted_weights,
+         "colors": {"sale": SALE_COLOR, "rent": RENT_COLOR},
+         "trend_colors": {"sale": SALE_COLOR, "rent": RENT_COLOR}},
+    ]
 
     if district == True:
-        census_district = list(district_gdf['CENSUSTRACT'].astype(int).astype(str))
-        df_district_census = get_timeseries_of_census_tracts(df, census_district)
-
-        fig.add_trace(
-            go.Scatter(x=df_district_census["sale"].index, 
-                       y=df_district_census["sale"].values, 
-                       name="District buy", 
-                       line=dict(color= CONTROL_SALE)),
-            secondary_y=False,
-        )
-        fig.add_trace(
-            go.Scatter(x=df_district_census["rent"].index, 
-                       y=df_district_census["rent"].values, 
-                       name="District rent", 
-                       line=dict(color= CONTROL_COLOR)),
-            secondary_y=True,
-        )
-    
-    if control_polygon == True:
-        census_district = list(district_gdf['CENSUSTRACT'].astype(int).astype(str))
-        control_gdf_census = get_timeseries_of_census_tracts(control_gdf, control_gdf['CENSUSTRACT'])
-
-        fig.add_trace(
-            go.Scatter(x=control_gdf_census["sale"].index, 
-                       y=control_gdf_census["sale"].values, 
-                       name="Control buy", 
-                       line=dict(color=CONTROL_SALE)),
-            secondary_y=False,
-        )
-        fig.add_trace(
-            go.Scatter(x=control_gdf_census["rent"].index, 
-                       y=control_gdf_census["rent"].values, 
-                       name="Control rent", 
-                       line=dict(color=CONTROL_COLOR)),
-            secondary_y=True,
+        series_groups.append(
+            {"name": "District", "trend_name": "Trend district",
+             "data": get_series(df, census_district),
+             "censustracts": census_district, "weights": None,
+             "colors": {"sale": CONTROL_SALE, "rent": CONTROL_COLOR},
+             "trend_colors": {"sale": CONTROL_SALE, "rent": CONTROL_COLOR}}
         )
 
-    if include_trends:
-        trend_sale = get_trend_of_timeseries(df_census["sale"])
-        trend_rent = get_trend_of_timeseries(df_census["rent"])
-
-        fig.add_trace(
-            go.Scatter(x=trend_sale.index, 
-                       y=trend_sale.values, 
-                       name="Trend buy",
-                       line=dict(color= SALE_COLOR, dash="dash")),
-            secondary_y=False,
-        )
-        fig.add_trace(
-            go.Scatter(x=trend_rent.index, 
-                       y=trend_rent.values, 
-                       name="Trend rent",
-                       line=dict(color= RENT_COLOR, dash="dash")),
-
-            secondary_y=True,
+    if control_polygon == True:
+        series_groups.append(
+            {"name": "Control", "trend_name": "Trend control",
+             "data": get_series(df, census_control),
+             "censustracts": census_control, "weights": None,
+             "colors": {"sale": CONTROL_SALE, "rent": CONTROL_COLOR},
+             "trend_colors": {"sale": CONTROL_COLOR, "rent": CONTROL_COLOR}}
         )
 
-        if district == True:
-            trend_sale_district = get_trend_of_timeseries(df_district_census["sale"])
-            trend_rent_district = get_trend_of_timeseries(df_district_census["rent"])
-
-            fig.add_trace(
-            go.Scatter(x=trend_sale_district.index, 
-                       y=trend_sale_district.values, 
-                       name="Trend district buy",
-                       line=dict(color= CONTROL_SALE, dash="dash")),
-            secondary_y=False,
-            )
-            fig.add_trace(
-                go.Scatter(x=trend_rent_district.index, 
-                           y=trend_rent_district.values, 
-                           name="Trend district rent",
-                           line=dict(color= CONTROL_COLOR, dash="dash")),
-                secondary_y=True,
-            )
-        
-
-        if control_polygon == True:
-            trend_sale_control = get_trend_of_timeseries(control_gdf_census["sale"])
-            trend_rent_control = get_trend_of_timeseries(control_gdf_census["rent"])
+    fig = make_subplots(specs=[[{"secondary_y": True}]])
 
-            fig.add_trace(
-            go.Scatter(x=trend_sale_control.index, 
-                       y=trend_sale_control.values, 
-                       name="Trend control buy",
-                       line=dict(color= CONTROL_COLOR, dash="dash")),
-            secondary_y=False,
+    if confidence_bands:
+        for group in series_groups:
+            bands = get_cached_bootstrap_bands(
+                df, group["censustracts"], metric, typologies, group["weights"], period_range
             )
+            if bands is None:
+                continue
+            lower, upper = bands
+            for operation in operations:
+                red, green, blue = plotly.colors.hex_to_rgb(group["colors"][operation])
+                # Upper edge first, then the lower edge filled up to it
+                for band, fill in [(upper, None), (lower, "tonexty")]:
+                    fig.add_trace(
+                        go.Scatter(x=band.index,
+                                   y=band[operation].values,
+                                   name=f"{group['name']} {PRICE_TYPE_LABELS[operation]} {BOOTSTRAP_CONFIDENCE:.0%} band",
+                                   legendgroup=f"{group['name']} {operation} band",
+                                   showlegend=fill is not None,
+                                   fill=fill,
+                                   fillcolor=f"rgba({red}, {green}, {blue}, {BAND_OPACITY})",
+                                   line=dict(width=0),
+                                   hoverinfo="skip"),
+                        secondary_y=operation == "rent",
+                    )
+
+    for group in series_groups:
+        for operation in operations:
             fig.add_trace(
-                go.Scatter(x=trend_rent_control.index, 
-                           y=trend_rent_control.values, 
-                           name="Trend control rent",
-                           line=dict(color= CONTROL_COLOR, dash="dash")),
-                secondary_y=True,
+                go.Scatter(x=group["data"][operation].index,
+                           y=group["data"][operation].values,
+                           name=f"{group['name']} {PRICE_TYPE_LABELS[operation]}",
+                           line=dict(color=group["colors"][operation])),
+                secondary_y=operation == "rent",
             )
 
-    # Ensure CENSUSTRACT values in interventions_gdf are strings with 10 digits
-    interventions_gdf["CENSUSTRACT"] = interventions_gdf["CENSUSTRACT"].astype(int).astype(str).str.zfill(10)
-
-    # Ensure the census tract list values are also 10 digits
-    censustract_list = [str(ct).zfill(10) for ct in censustract_list]
-
-    # Debugging print
-    #print("CENSUSTRACT values in interventions_gdf:", interventions_gdf["CENSUSTRACT"].unique())
-    #print("Censustract list provided:", censustract_list)
-    #print(interventions_gdf["CENSUSTRACT"].values)
-
-    if any(census_tract in interventions_gdf["CENSUSTRACT"].values for census_tract in censustract_list):
-        # Prepare data for merging intervals
-
-        intervals = []
-        # Ensure CENSUSTRACT values in interventions_gdf are strings with 10 digits
-        interventions_gdf["CENSUSTRACT"] = interventions_gdf["CENSUSTRACT"].astype(str).str.zfill(10)
-
-        # Ensure the census tract list values are also 10 digits
-        censustract_list = [str(ct).zfill(10) for ct in censustract_list]
+    if typology_breakdown:
+        typology_df = get_cube_timeseries(
+            get_cached_cube(df, metric), censustract_list, typologies, impacted_weights,
+            by_typology=True, period_range=period_range,
+        )
+        for i, typology in enumerate(typology_df.columns.get_level_values("ADTYPOLOGY").unique()):
+            for operation in operations:
+                fig.add_trace(
+                    go.Scatter(x=typology_df.index,
+                               y=typology_df[(typology, operation)].values,
+                               name=f"{typology} {PRICE_TYPE_LABELS[operation]}",
+                               line=dict(color=TYPOLOGY_COLORS[i % len(TYPOLOGY_COLORS)], dash="dot")),
+                    secondary_y=operation == "rent",
+                )
+
+    if impact_rings is not None:
+        ring_df = get_ring_timeseries(get_cached_cube(df, metric), impact_rings, typologies, period_range)
+        ring_labels = ring_df.columns.get_level_values("RING").unique()
+        for i, ring in enumerate(ring_labels):
+            for operation in operations:
+                # The colour of the average curve, faded towards white with the distance
+                red, green, blue = plotly.colors.find_intermediate_color(
+                    plotly.colors.hex_to_rgb(series_groups[0]["colors"][operation]), (255, 255, 255),
+                    (i + 1) / (len(ring_labels) + 1), colortype="tuple",
+                )
+                fig.add_trace(
+                    go.Scatter(x=ring_df.index,
+                               y=ring_df[(ring, operation)].values,
+                               name=f"{ring} {PRICE_TYPE_LABELS[operation]}",
+                               line=dict(color=f"rgb({red:.0f}, {green:.0f}, {blue:.0f})", dash="dashdot")),
+                    secondary_y=operation == "rent",
+                )
 
-        # Filter censustract_list to include only those that are present in the DataFrame
-        valid_censustracts = [ct for ct in censustract_list if ct in interventions_gdf["CENSUSTRACT"].values]
-
-        # Now proceed with only the valid census tracts
-        intervals = []
-        #print(interventions_gdf.set_index("CENSUSTRACT").loc[valid_censustracts])
-
-        for row, intervention in interventions_gdf.set_index("CENSUSTRACT").loc[valid_censustracts].iterrows():
-            # Debugging print
-            #print(f"Processing intervention: {intervention}")
-
-            data_inici = pd.to_datetime(intervention["DATA_INICI"].strftime('%Y-%m-%d'))
-            data_fi = pd.to_datetime(intervention["DATA_FI_REAL"].strftime('%Y-%m-%d'))
-            intervals.append((data_inici, data_fi, {interventions_dict[intervention["TITOL_WO"]]}))
-
-        # Merge overlapping intervals
-        merged_intervals = merge_intervals(intervals)
-
-        # Draw rectangles for each merged interval
-        for start, end, interventions in merged_intervals:
-            # Create annotation text with line breaks
-            annotation_text = '<br>'.join(sorted(interventions))
-
-            fig.add_vrect(
-                x0=start,
-                x1=end,
-                annotation_text=annotation_text,
-                annotation_position="bottom right",
-                fillcolor=INTERVENTION_COLOR,
-                opacity=0.25,
-                line_width=0
-            )
-                # Price type filtering
+    if include_trends:
+        for group in series_groups:
+            for operation in operations:
+                trend = get_cached_trend(group["data"][operation])
+
+                fig.add_trace(
+                    go.Scatter(x=trend.index,
+                               y=trend.values,
+                               name=f"{group['trend_name']} {PRICE_TYPE_LABELS[operation]}",
+                               line=dict(color=group["trend_colors"][operation], dash="dash")),
+                    secondary_y=operation == "rent",
+                )
+
+    # Shaded periods of the interventions touching the selected census tracts
+    merged_intervals = get_intervention_periods(intervention_index, censustract_list)
+    if period_range is not None:
+        # Clip them to the time window, dropping those outside of it
+        window_start, window_end = period_range[0].start_time, period_range[1].end_time
+        merged_intervals = [
+            (max(start, window_start), min(end, window_end), interventions)
+            for start, end, interventions in merged_intervals
+            if start <= window_end and end >= window_start
+        ]
+
+    # Draw rectangles for each merged interval
+    for start, end, interventions in merged_intervals:
+        # Create annotation text with line breaks
+        annotation_text = '<br>'.join(sorted(interventions))
+
+        fig.add_vrect(
+            x0=start,
+            x1=end,
+            annotation_text=annotation_text,
+            annotation_position="bottom right",
+            fillcolor=INTERVENTION_COLOR,
+            opacity=0.25,
+            line_width=0
+        )
 
-    if price_type == 'sale':
-        fig.data = [trace for trace in fig.data if "buy" in trace.name]
-    elif price_type == 'rent':
-        fig.data = [trace for trace in fig.data if "rent" in trace.name]
+    metric_label = "price" if metric == "UNITPRICE_ASKING" else metric
 
     fig.update_layout(
-        title_text="Average Rent/Buy prices for all the Census tracts"
+        title_text=f"Average Rent/Buy {'prices' if metric == 'UNITPRICE_ASKING' else metric} for all the Census tracts"
     )
 
     fig.update_xaxes(title_text="Periods")
-    fig.update_yaxes(title_text="<b>Rent</b> price", secondary_y=True, showgrid=False)
-    fig.update_yaxes(title_text="<b>Buy</b> price", secondary_y=False)
-    return fig
\ No newline at end of file
+    fig.update_yaxes(title_text=f"<b>Rent</b> {metric_label}", secondary_y=True, showgrid=False)
+    fig.update_yaxes(title_text=f"<b>Buy</b> {metric_label}", secondary_y=False)
+
+    FIGURE_CACHE.put(figure_key, fig.to_json())
+    return fig
+
+def plot_event_study(event_study: dict,
+                     interventions: Optional[List[str]] = None,
+                     price_type: str = "both",
+                     SALE_COLOR: str = '#FBBC05',
+                     RENT_COLOR: str = '#45B905'
+                     ) -> go.Figure:
+    """
+    Plot the interventions aligned on their start quarter: the change of each
+    one since its baseline as a thin line, and their mean with the spread band.
+
+    Args:
+      event_study (dict): As built by build_event_study.
+      interventions (Optional[List[str]]): The TITOL_WOs to include; all if None or empty.
+      price_type (str): "sale", "rent" or "both".
+
+    Returns:
+      go.Figure: The figure.
+    """
+    summary = get_event_study_summary(event_study, interventions)
+    selected = event_study["interventions"].isin(interventions) if interventions else np.ones(len(event_study["interventions"]), dtype=bool)
+    colors = {"sale": SALE_COLOR, "rent": RENT_COLOR}
+    offsets = event_study["offsets"]
+
+    fig = go.Figure()
+    for operation in PRICE_TYPE_OPERATIONS.get(price_type, ["sale", "rent"]):
+        if operation not in event_study["operations"]:
+            continue
+        label = PRICE_TYPE_LABELS[operation]
+        red, green, blue = plotly.colors.hex_to_rgb(colors[operation])
+        operation_position = event_study["operations"].get_loc(operation)
+
+        for name, changes in zip(event_study["labels"][selected], event_study["changes"][selected, :, operation_position]):
+            fig.add_trace(go.Scatter(x=offsets, y=changes, name=name, legendgroup=f"{operation} interventions",
+                                     showlegend=False, line=dict(color=f"rgba({red}, {green}, {blue}, 0.3)", width=1)))
+
+        lower, upper = EVENT_STUDY_BAND_PERCENTILES
+        for band, fill in [("upper", None), ("lower", "tonexty")]:
+            fig.add_trace(go.Scatter(x=offsets, y=summary[(band, operation)].values,
+                                     name=f"Interventions {label} {lower}-{upper}th percentile",
+                                     legendgroup=f"{operation} band", showlegend=fill is not None, fill=fill,
+                                     fillcolor=f"rgba({red}, {green}, {blue}, {BAND_OPACITY})",
+                                     line=dict(width=0), hoverinfo="skip"))
+        fig.add_trace(go.Scatter(x=offsets, y=summary[("mean", operation)].values, name=f"Mean {label}",
+                                 customdata=summary[("count", operation)].values,
+                                 hovertemplate="%{y:+.1%} over %{customdata} interventions",
+                                 line=dict(color=colors[operation], width=3)))
+
+    fig.add_vline(x=0, line_dash="dash", line_color="grey")
+    fig.add_hline(y=0, line_color="lightgrey")
+    fig.update_layout(title_text=f"Change since the {EVENT_STUDY_BASELINE_QUARTERS} quarters before the start of each intervention")
+    fig.update_xaxes(title_text="Quarters since the start")
+    fig.update_yaxes(title_text="Change", tickformat="+.0%")
+    return fig
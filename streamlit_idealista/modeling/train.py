@@ -1,14 +1,127 @@
+from concurrent.futures import ProcessPoolExecutor
+import json
+import os
 from pathlib import Path
+from typing import Dict, List
 
+import geopandas as gpd
+import pandas as pd
 import typer
 from loguru import logger
 from tqdm import tqdm
 
-from streamlit_idealista.config import MODELS_DIR, PROCESSED_DATA_DIR
+from streamlit_idealista import functions as fc
+from streamlit_idealista.cities import get_city
+from streamlit_idealista.config import (
+    DEFAULT_CITY,
+    MODELS_DIR,
+    PROCESSED_DATA_DIR,
+    TREND_MODEL_SETTINGS,
+    TREND_STORE_DIR,
+)
 
 app = typer.Typer()
 
 
+def get_trend_selections(gdf_ine: gpd.GeoDataFrame,
+                         interventions_gdf: gpd.GeoDataFrame
+                         ) -> Dict[str, List[str]]:
+    """
+    Get the census tract sets whose trends are shown by the dashboard pages:
+    every district, and the impacted census tracts and the district control
+    set (the district without the intervened census tracts) of every intervention.
+
+    The sets come from the same intervention bitsets as in the pages (see
+    functions.build_intervention_tract_bitmaps), so their series have the
+    same contents and their trends are found in the store.
+
+    Args:
+      gdf_ine (gpd.GeoDataFrame): The censustracts and their polygons.
+      interventions_gdf (gpd.GeoDataFrame): The interventions layer.
+
+    Returns:
+      Dict[str, List[str]]: The census tracts of each set, by set name.
+    """
+    district_codes = gdf_ine["CENSUSTRACT"].astype(str).str.zfill(10).str[0:7]
+    selections = {
+        f"district {district}": tracts.tolist()
+        for district, tracts in gdf_ine["CENSUSTRACT"].groupby(district_codes)
+    }
+
+    bitmaps = fc.build_intervention_tract_bitmaps(interventions_gdf, gdf_ine)
+    for name in bitmaps["interventions"]:
+        selected_tracts = fc.select_intervention_tracts(bitmaps, [name])
+        if selected_tracts["impacted"].any():
+            selections[f"intervention {name}"] = gdf_ine["CENSUSTRACT"][selected_tracts["series"]].tolist()
+
+        control = gdf_ine[selected_tracts["control"]]
+        if not control.empty:
+            selections[f"control {name}"] = list(control["CENSUSTRACT"].astype(int).astype(str))
+
+    return selections
+
+
+@app.command()
+def precompute_trends(
+    city: str = DEFAULT_CITY,
+    metric: str = "UNITPRICE_ASKING",
+    workers: int = os.cpu_count() or 1,
+):
+    """
+    Fit the trends of every district, intervention and district control set
+    of a city in parallel, and store them in TREND_STORE_DIR/<city>.parquet
+    with the model settings and the dataset version.
+
+    get_trend_of_timeseries reads them from there instead of fitting them live.
+    """
+    city_data = get_city(city)
+    processed_df = city_data["processed_df"]
+    interventions_gdf = city_data["interventions_gdf"]
+    if interventions_gdf is None:
+        interventions_gdf = gpd.GeoDataFrame(columns=["TITOL_WO", "CENSUSTRACT", "geometry"], crs=city_data["gdf_ine"].crs)
+
+    selections = get_trend_selections(city_data["gdf_ine"], interventions_gdf)
+    logger.info(f"Computing the series of {len(selections)} census tract sets...")
+
+    # Identical series (e.g. a district without interventions and its control set) are fitted once
+    series_by_key = {}
+    groups_by_key = {}
+    for group, censustracts in tqdm(selections.items()):
+        timeseries = fc.get_cached_timeseries(processed_df, censustracts, metric=metric)
+        for operation in timeseries.columns:
+            series = timeseries[operation]
+            key = fc.get_trend_key(series)
+            series_by_key[key] = series
+            groups_by_key.setdefault(key, []).append(f"{group} {operation}")
+
+    logger.info(f"Fitting {len(series_by_key)} trends on {workers} processes...")
+    keys = list(series_by_key)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        trends = list(tqdm(executor.map(fc.fit_trend, [series_by_key[key] for key in keys]), total=len(keys)))
+
+    dataset_version = fc.get_dataset_version(processed_df)
+    model_settings = json.dumps(TREND_MODEL_SETTINGS, sort_keys=True)
+    trends_df = pd.concat(
+        [
+            pd.DataFrame({
+                "KEY": key,
+                "NAME": str(trend.name),
+                "GROUPS": ", ".join(groups_by_key[key]),
+                "PERIOD": trend.index,
+                "TREND": trend.values,
+            })
+            for key, trend in zip(keys, trends)
+        ],
+        ignore_index=True,
+    ).assign(METRIC=metric, DATASET_VERSION=dataset_version, MODEL_SETTINGS=model_settings)
+
+    store_path = TREND_STORE_DIR / f"{city}.parquet"
+    store_path.parent.mkdir(parents=True, exist_ok=True)
+    with store_path.open("wb") as f:
+        trends_df.to_parquet(f, index=False)
+    logger.success(f"Stored {len(keys)} trends in {store_path}.")
+
+
 @app.command()
 def main(
     # ---- REPLACE DEFAULT PATHS AS APPROPRIATE ----
@@ -1,4 +1,5 @@
 from streamlit_idealista.config import   INPUT_DATA_PATH, PROJ_ROOT, INPUT_OPERATION_TYPES_PATH, INPUT_TYPOLOGY_TYPES_PATH, INPUT_OPERATION_TYPES_PATH, INPUT_SUPERILLES_INTERVENTIONS_GEOJSON, INPUT_DTYPES_COUPLED_JSON_PATH, INPUT_INE_CENSUSTRACT_GEOJSON, SALE_COLOR, RENT_COLOR, CONTROL_COLOR, INTERVENTION_COLOR, INTERSECT_COLOR, CONTROL_SALE
+from streamlit_idealista.cities import get_city, get_city_resource, select_city
 import functions as fc
 from upath import UPath
 
@@ -62,73 +63,20 @@ st.markdown(
 #st.description('Explore the effects of a selected urban intervention by comparing its impact on housing prices with the overall trends in the district. Visualize and analyze differences over time to assess intervention outcomes.')
 
 # load data
-@st.cache_data
-def load_dtypes(_dtypes_path: UPath) -> dict:
-    with _dtypes_path.open("rb") as f:
-        return json.load(f)
-dtypes_coupled_dict = load_dtypes(INPUT_DTYPES_COUPLED_JSON_PATH)
-
-@st.cache_data
-def load_main_data(_main_data_path: UPath) -> pd.DataFrame:
-    with _main_data_path.open("rb") as f:
-        df = pd.read_csv(f, sep = ';', dtype=dtypes_coupled_dict, encoding="unicode_escape")
-    return df
-df = load_main_data(INPUT_DATA_PATH)
-
-@st.cache_data
-def load_censustract_geojson(_censustract_geojson_path: UPath) -> gpd.GeoDataFrame:
-    with _censustract_geojson_path.open("rb") as f:
-        gdf_ine = gpd.read_file(f)
-    gdf_ine['CENSUSTRACT'] = gdf_ine['CENSUSTRACT'].astype(int).astype(str)
-    return gdf_ine
-gdf_ine = load_censustract_geojson(INPUT_INE_CENSUSTRACT_GEOJSON)
-
-@st.cache_data
-def load_operation_types(_operation_types_path: UPath) -> pd.DataFrame:
-    with _operation_types_path.open("rb") as f:
-        return pd.read_csv(f, sep=";", dtype=dtypes_coupled_dict, encoding="unicode_escape")
-operation_types_df = load_operation_types(INPUT_OPERATION_TYPES_PATH)
-
-@st.cache_data
-def load_typology_types(_typology_types_path: UPath) -> pd.DataFrame:
-    with _typology_types_path.open("rb") as f:
-        return pd.read_csv(f, sep=";", dtype=dtypes_coupled_dict)
-typology_types_df = load_typology_types(INPUT_TYPOLOGY_TYPES_PATH)
-
-@st.cache_data
-def load_interventions(_interventions_path: UPath) -> gpd.GeoDataFrame:
-    with _interventions_path.open("rb") as f:
-        return gpd.read_file(f)
-interventions_gdf =  load_interventions(INPUT_SUPERILLES_INTERVENTIONS_GEOJSON)
-
-@st.cache_data
-def process_df(df: pd.DataFrame) -> pd.DataFrame:
-    copy_df = df.copy(deep=True)
-    return (
-        copy_df
-        .astype({'ADOPERATIONID': 'int',
-                'ADTYPOLOGYID': 'int'
-                })
-        .join(operation_types_df.set_index('ID'), on='ADOPERATIONID', how="left", validate="m:1")
-        .rename(columns={
-            'SHORTNAME': 'ADOPERATION',
-                        }
-                )
-        .astype({'ADOPERATION': 'category',
-                'ADOPERATIONID': 'category'
-                })
-        .drop(columns=("DESCRIPTION"))
-        .join(typology_types_df.set_index('ID'), on='ADTYPOLOGYID', how="left", validate="m:1")
-        .rename(columns={
-            'SHORTNAME': 'ADTYPOLOGY',
-                        }
-                )
-        .astype({'ADTYPOLOGY': 'category',
-                'ADTYPOLOGYID': 'category'
-                })
-        .drop(columns=("DESCRIPTION"))
-    )
-processed_df = process_df(df)
+city = select_city()
+city_data = get_city(city)
+city_config = city_data["config"]
+processed_df = city_data["processed_df"]
+gdf_ine = city_data["gdf_ine"]
+interventions_gdf = city_data["interventions_gdf"]
+if interventions_gdf is None:
+    st.info(f"There is no intervention layer for {city_config['name']}.")
+    st.stop()
+
+intervention_index = get_city_resource(city, "intervention_index")
+overlap_matrix, overlap_interventions, overlap_censustracts = get_city_resource(city, "intervention_overlap_matrix")
+# Census tract sets of every intervention, so selecting interventions needs no geometry work
+intervention_tract_bitmaps = get_city_resource(city, "intervention_tract_bitmaps")
 
 # Streamlit App Logic
 st.title("Select an Intervention and Compare it with the District")
@@ -139,10 +87,63 @@ geometry_selection = st.multiselect(
     help="Select one or more geometries to filter data. Leave empty to use the drawn geometry."
 )
 
+area_weighted = st.toggle(
+    "Area-weighted averages",
+    help="Weight each census tract by the fraction of its area covered by the selection instead of counting any touching census tract in full."
+)
+
+metric_columns = fc.get_metric_columns(processed_df)
+metric = st.selectbox(
+    "Metric",
+    options=metric_columns,
+    index=metric_columns.index("UNITPRICE_ASKING") if "UNITPRICE_ASKING" in metric_columns else 0,
+    help="All metrics are aggregated together, so switching metric does not recompute the series."
+)
+
+typology_options = list(processed_df["ADTYPOLOGY"].cat.categories)
+typologies = st.multiselect(
+    "Typology",
+    options=typology_options,
+    help="Only include these typologies. Leave empty to include all of them."
+)
+typology_breakdown = st.toggle("Per-typology curves", help="Add one curve per typology for the selected census tracts.")
+confidence_bands = st.toggle(
+    "Confidence bands",
+    help="Shade the bootstrap confidence band of each average curve, resampling its census tracts."
+)
+event_study = st.toggle(
+    "Event study",
+    help="Align the impacted series of the selected interventions (all of them if none is selected) on their start quarter, to compare interventions that started in different years."
+)
+distance_rings = st.toggle(
+    "Distance rings",
+    help=f"Add one curve per ring of census tracts around the selected interventions ({', '.join(fc.get_ring_labels())}), to show how the effect fades with the distance."
+)
+
+period_index = get_city_resource(city, "period_index")
+period_range = st.select_slider(
+    "Period",
+    options=list(period_index),
+    value=(period_index[0], period_index[-1]),
+    format_func=str,
+    help="Only aggregate, fit and plot the quarters in this range."
+)
+# The full span is the default view, whose series and trends are shared with the other pages
+if period_range == (period_index[0], period_index[-1]):
+    period_range = None
+
+impacted_weights = None
+if area_weighted:
+    impacted_weights = fc.get_intervention_overlap_weights(
+        overlap_matrix, overlap_interventions, overlap_censustracts, geometry_selection
+    )
+
 left, right = st.columns([1,1])  # You can adjust these numbers to your preference
 
-interventions_gdf = interventions_gdf.to_crs('EPSG:4326')
-gdf_ine = gdf_ine.to_crs("EPSG:4326")
+# Reprojected once per city for the map
+interventions_gdf = get_city_resource(city, "interventions_gdf_4326")
+gdf_ine = get_city_resource(city, "gdf_ine_4326")
+intervention_layer = get_city_resource(city, "intervention_layer")
 
 
 
@@ -150,83 +151,33 @@ with left:
     st.subheader("Map")
 
 
-    # Create the base map
-    m = folium.Map(location=[41.40463, 2.17924], zoom_start=13, tiles="cartodbpositron")
-
-    # Create a GeoJSON layer for all geometries
-    geojson_layer = folium.FeatureGroup(name="Show Urban Interventions")
-
     # selected interventions
     filtered_interventions_gdf = interventions_gdf[interventions_gdf["TITOL_WO"].isin(geometry_selection)].copy()
 
-    # impacted area
-    impacted_gdf = fc.get_impacted_gdf(filtered_interventions_gdf, gdf_ine) 
-
-    # district of the selected intervention
-    filtered_interventions_gdf['md'] = filtered_interventions_gdf['CENSUSTRACT'].astype(str).str[0:7].astype(int)
-    gdf_ine['md'] = gdf_ine['CENSUSTRACT'].astype(str).str[0:6].astype(int)
-
-    # to use district as control group, remove intervened censustracts
-    c1 = gdf_ine['md'].isin(filtered_interventions_gdf['md'])
-    c2 = ~gdf_ine['CENSUSTRACT'].astype(int).isin(filtered_interventions_gdf['CENSUSTRACT'].astype(str).astype(int))
-    district_gdf = gdf_ine[c1 & c2]
-
-    # Add geometries to the layer
-    for _, row in interventions_gdf.iterrows():
-        folium.GeoJson(
-            row["geometry"],
-            name=row["TITOL_WO"],
-            tooltip = row["TITOL_WO"],
-            style_function=lambda x: {
-                "fillColor": "grey",
-                "color": "grey",
-                "weight": 1,
-                "fillOpacity": 0.3,
-            },
-        ).add_to(geojson_layer)
-
-    for _, row in filtered_interventions_gdf.iterrows():
-        folium.GeoJson(
-            row["geometry"],
-            name=row["TITOL_WO"],
-            tooltip = row["TITOL_WO"],
-            style_function=lambda x: {
-                "fillColor": INTERVENTION_COLOR,
-                "color": INTERVENTION_COLOR,
-                "weight": 2,
-                "fillOpacity": 0.6,
-            },
-        ).add_to(geojson_layer)
-
-    for _, row in impacted_gdf.iterrows():
-        folium.GeoJson(
-            row["geometry"],
-            style_function=lambda x: {
-                "fillColor": INTERSECT_COLOR,
-                "color": INTERSECT_COLOR,
-                "weight": 1,
-                "fillOpacity": 0.4,
-            },
-        ).add_to(geojson_layer)
-
-    for _, row in district_gdf.iterrows():
-        folium.GeoJson(
-            row["geometry"],
-            style_function=lambda x: {
-                "fillColor": CONTROL_COLOR,
-                "color": CONTROL_COLOR,
-                "weight": 1,
-                "fillOpacity": 0.3,
-            },
-        ).add_to(geojson_layer)
-
-    # Add the GeoJSON layer to the map
-    geojson_layer.add_to(m)
-
-    # Add layer control to toggle visibility of geometries
-    
-    # Initialize the Draw plugin
-    draw = Draw(
+    # impacted area, and district of the selected intervention without the
+    # intervened censustracts as control group (gdf_ine has the rows of the bitsets)
+    selected_tracts = fc.select_intervention_tracts(intervention_tract_bitmaps, geometry_selection)
+    impacted_gdf = gdf_ine[selected_tracts["impacted"]]
+    district_gdf = gdf_ine[selected_tracts["control"]]
+    series_censustracts = gdf_ine["CENSUSTRACT"][selected_tracts["series"]].tolist()
+
+    # census tracts in distance rings around the selected interventions
+    impact_rings = (
+        fc.get_impact_rings(filtered_interventions_gdf, get_city_resource(city, "gdf_ine_projected"))
+        if distance_rings and geometry_selection else None
+    )
+    ring_layers = []
+    if impact_rings is not None:
+        ring_layers = [
+            (gdf_ine[gdf_ine["CENSUSTRACT"].isin(impact_rings.loc[impact_rings["RING"] == ring, "CENSUSTRACT"])], f"ring_{i}")
+            for i, ring in enumerate(impact_rings["RING"].cat.categories)
+        ]
+
+    # The base map (tiles and all the interventions) is the same on every rerun;
+    # only the selection overlay is sent when it changes
+    m = fc.build_base_map(
+        city_config,
+        intervention_layer,
         draw_options={
             'polyline': False,
             'polygon': True,
@@ -236,25 +187,28 @@ with left:
             'color': CONTROL_COLOR
 
         },
-        edit_options={'edit': True},
     )
-    draw.add_to(m)
-    folium.LayerControl(collapsed=False).add_to(m)
-    folium.plugins.Fullscreen(
-        position="bottomleft",
-        title="Expand me",
-        title_cancel="Exit me",
-        force_separate_button=True,
-    ).add_to(m)
+    selection_layer = fc.build_overlay(
+        "Selected interventions",
+        [*ring_layers, (filtered_interventions_gdf, "selected"), (impacted_gdf, "impacted"), (district_gdf, "district")],
+    )
+
     # Display the map in the Streamlit app
-    output = st_folium(m, width=600, height=500)
+    output = st_folium(
+        m,
+        width=600,
+        height=500,
+        key="interventions_map",
+        feature_group_to_add=selection_layer,
+        layer_control=folium.LayerControl(collapsed=False),
+    )
 
     # Process and display the drawn geometries
     geometry_collection = None  # Define a default value
     if output and output["all_drawings"]:
-        drawn_geometries = [fc.transform_geometry(geo_json['geometry']) for geo_json in output["all_drawings"]]
+        drawn_geometries = [fc.transform_geometry(geo_json['geometry'], gdf_ine.crs) for geo_json in output["all_drawings"]]
         geometry_collection = fc.GeometryCollection(drawn_geometries)
-        st.write("Captured Geometries in UTM (EPSG:25831):")
+        st.write(f"Captured Geometries in {gdf_ine.crs}:")
         st.write(geometry_collection)
     else:
         st.write("No geometries drawn yet.")
@@ -282,12 +236,21 @@ with right:
             else:
                 chart = fc.plot_timeseries(
                     processed_df,
-                    interventions_gdf, 
+                    intervention_index,
                     impacted_gdf,
                     gdf_ine,
                     price_type=price_type.lower(),
                     district = True,
                     district_gdf = district_gdf,
+                    area_weighted = area_weighted,
+                    impacted_weights = impacted_weights,
+                    impacted_censustracts = series_censustracts,
+                    metric = metric,
+                    typologies = typologies,
+                    typology_breakdown = typology_breakdown,
+                    confidence_bands = confidence_bands,
+                    period_range = period_range,
+                    impact_rings = impact_rings,
                     SALE_COLOR = SALE_COLOR,
                     RENT_COLOR = RENT_COLOR,
                     CONTROL_SALE = CONTROL_SALE, 
@@ -303,12 +266,20 @@ with right:
             # Use the geometry drawn on the map
             chart = fc.plot_timeseries(
                 processed_df,
-                interventions_gdf, 
+                intervention_index,
                 impacted_gdf,
                 gdf_ine,
                 price_type=price_type.lower(),
                 district = True,
                 district_gdf = district_gdf,
+                area_weighted = area_weighted,
+                impacted_weights = impacted_weights,
+                impacted_censustracts = series_censustracts,
+                metric = metric,
+                typologies = typologies,
+                typology_breakdown = typology_breakdown,
+                confidence_bands = confidence_bands,
+                period_range = period_range,
                 SALE_COLOR = SALE_COLOR,
                 RENT_COLOR = RENT_COLOR,
                 CONTROL_SALE = CONTROL_SALE, 
@@ -322,4 +293,12 @@ with right:
 
     except Exception as e:
         # Silently pass or log the error if needed
-        st.error(f"An error occurred: {e}")
\ No newline at end of file
+        st.error(f"An error occurred: {e}")
+
+    if event_study:
+        # Aligned once per dataset version, metric and typologies for all the interventions
+        event_study_data = fc.get_cached_event_study(processed_df, intervention_index, metric, typologies)
+        st.plotly_chart(
+            fc.plot_event_study(event_study_data, geometry_selection, SALE_COLOR=SALE_COLOR, RENT_COLOR=RENT_COLOR),
+            use_container_width=True,
+        )
@@ -1,4 +1,5 @@
 from streamlit_idealista.config import   INPUT_DATA_PATH, PROJ_ROOT, INPUT_OPERATION_TYPES_PATH, INPUT_TYPOLOGY_TYPES_PATH, INPUT_OPERATION_TYPES_PATH, INPUT_SUPERILLES_INTERVENTIONS_GEOJSON, INPUT_DTYPES_COUPLED_JSON_PATH, INPUT_INE_CENSUSTRACT_GEOJSON, SALE_COLOR, RENT_COLOR, CONTROL_COLOR, INTERVENTION_COLOR, INTERSECT_COLOR, CONTROL_SALE
+from streamlit_idealista.cities import get_city, get_city_resource, select_city
 from upath import UPath
 
 import functions as fc
@@ -62,75 +63,20 @@ st.markdown(
 
 
 # load data
-# load data
-@st.cache_data
-def load_dtypes(_dtypes_path: UPath) -> dict:
-    with _dtypes_path.open("rb") as f:
-        return json.load(f)
-dtypes_coupled_dict = load_dtypes(INPUT_DTYPES_COUPLED_JSON_PATH)
-
-@st.cache_data
-def load_main_data(_main_data_path: UPath) -> pd.DataFrame:
-    with _main_data_path.open("rb") as f:
-        df = pd.read_csv(f, sep = ';', dtype=dtypes_coupled_dict, encoding="unicode_escape")
-    return df
-df = load_main_data(INPUT_DATA_PATH)
-
-@st.cache_data
-def load_censustract_geojson(_censustract_geojson_path: UPath) -> gpd.GeoDataFrame:
-    with _censustract_geojson_path.open("rb") as f:
-        gdf_ine = gpd.read_file(f)
-    gdf_ine['CENSUSTRACT'] = gdf_ine['CENSUSTRACT'].astype(int).astype(str)
-    return gdf_ine
-gdf_ine = load_censustract_geojson(INPUT_INE_CENSUSTRACT_GEOJSON)
-
-@st.cache_data
-def load_operation_types(_operation_types_path: UPath) -> pd.DataFrame:
-    with _operation_types_path.open("rb") as f:
-        return pd.read_csv(f, sep=";", dtype=dtypes_coupled_dict, encoding="unicode_escape")
-operation_types_df = load_operation_types(INPUT_OPERATION_TYPES_PATH)
-
-@st.cache_data
-def load_typology_types(_typology_types_path: UPath) -> pd.DataFrame:
-    with _typology_types_path.open("rb") as f:
-        return pd.read_csv(f, sep=";", dtype=dtypes_coupled_dict)
-typology_types_df = load_typology_types(INPUT_TYPOLOGY_TYPES_PATH)
-
-@st.cache_data
-def load_interventions(_interventions_path: UPath) -> gpd.GeoDataFrame:
-    with _interventions_path.open("rb") as f:
-        return gpd.read_file(f)
-interventions_gdf =  load_interventions(INPUT_SUPERILLES_INTERVENTIONS_GEOJSON)
-
-
-@st.cache_data
-def process_df(df: pd.DataFrame) -> pd.DataFrame:
-    copy_df = df.copy(deep=True)
-    return (
-        copy_df
-        .astype({'ADOPERATIONID': 'int',
-                'ADTYPOLOGYID': 'int'
-                })
-        .join(operation_types_df.set_index('ID'), on='ADOPERATIONID', how="left", validate="m:1")
-        .rename(columns={
-            'SHORTNAME': 'ADOPERATION',
-                        }
-                )
-        .astype({'ADOPERATION': 'category',
-                'ADOPERATIONID': 'category'
-                })
-        .drop(columns=("DESCRIPTION"))
-        .join(typology_types_df.set_index('ID'), on='ADTYPOLOGYID', how="left", validate="m:1")
-        .rename(columns={
-            'SHORTNAME': 'ADTYPOLOGY',
-                        }
-                )
-        .astype({'ADTYPOLOGY': 'category',
-                'ADTYPOLOGYID': 'category'
-                })
-        .drop(columns=("DESCRIPTION"))
-    )
-processed_df = process_df(df)
+city = select_city()
+city_data = get_city(city)
+city_config = city_data["config"]
+processed_df = city_data["processed_df"]
+gdf_ine = city_data["gdf_ine"]
+interventions_gdf = city_data["interventions_gdf"]
+if interventions_gdf is None:
+    st.info(f"There is no intervention layer for {city_config['name']}.")
+    st.stop()
+
+intervention_index = get_city_resource(city, "intervention_index")
+overlap_matrix, overlap_interventions, overlap_censustracts = get_city_resource(city, "intervention_overlap_matrix")
+# Census tract sets of every intervention, so selecting interventions needs no geometry work
+intervention_tract_bitmaps = get_city_resource(city, "intervention_tract_bitmaps")
 
 # Streamlit App Logic
 st.title("Select an Intervention and Draw on the Map to Have a Control Group.")
@@ -142,29 +88,97 @@ geometry_selection = st.multiselect(
     help="Select one or more geometries to filter data. Leave empty to use the drawn geometry."
 )
 
+area_weighted = st.toggle(
+    "Area-weighted averages",
+    help="Weight each census tract by the fraction of its area covered by the selection instead of counting any touching census tract in full."
+)
 
+metric_columns = fc.get_metric_columns(processed_df)
+metric = st.selectbox(
+    "Metric",
+    options=metric_columns,
+    index=metric_columns.index("UNITPRICE_ASKING") if "UNITPRICE_ASKING" in metric_columns else 0,
+    help="All metrics are aggregated together, so switching metric does not recompute the series."
+)
 
-left, right = st.columns([1,1])  # You can adjust these numbers to your preference
+typology_options = list(processed_df["ADTYPOLOGY"].cat.categories)
+typologies = st.multiselect(
+    "Typology",
+    options=typology_options,
+    help="Only include these typologies. Leave empty to include all of them."
+)
+typology_breakdown = st.toggle("Per-typology curves", help="Add one curve per typology for the selected census tracts.")
+confidence_bands = st.toggle(
+    "Confidence bands",
+    help="Shade the bootstrap confidence band of each average curve, resampling its census tracts."
+)
+
+period_index = get_city_resource(city, "period_index")
+period_range = st.select_slider(
+    "Period",
+    options=list(period_index),
+    value=(period_index[0], period_index[-1]),
+    format_func=str,
+    help="Only aggregate, fit and plot the quarters in this range."
+)
+# The full span is the default view, whose series and trends are shared with the other pages
+if period_range == (period_index[0], period_index[-1]):
+    period_range = None
+
+impacted_weights = None
+if area_weighted:
+    impacted_weights = fc.get_intervention_overlap_weights(
+        overlap_matrix, overlap_interventions, overlap_censustracts, geometry_selection
+    )
 
-interventions_gdf = interventions_gdf.to_crs('EPSG:4326')
-gdf_ine = gdf_ine.to_crs("EPSG:4326")
 
-# Initialize the toggle in session state
-if 'put_new_map_boolean' not in st.session_state:
-    st.session_state['put_new_map_boolean'] = False
 
-if "drawn_geometries" not in st.session_state:
-    st.session_state["drawn_geometries"] = []
+left, right = st.columns([1,1])  # You can adjust these numbers to your preference
 
-with left:
+# Reprojected once per city for the map
+interventions_gdf = get_city_resource(city, "interventions_gdf_4326")
+gdf_ine = get_city_resource(city, "gdf_ine_4326")
+intervention_layer = get_city_resource(city, "intervention_layer")
+
+# Control group state: impacted census tracts per drawn geometry
+if "control_drawings" not in st.session_state or st.session_state.get("control_city") != city:
+    st.session_state["control_drawings"] = {}
+    st.session_state["control_city"] = city
+
+def update_control_group():
+    """Diff the drawings on the map against the previous ones and only
+    intersect the new geometries with the census tracts."""
+    map_state = st.session_state.get("control_map") or {}
+    drawings = map_state.get("all_drawings")
+    if drawings is None:
+        return
+    st.session_state["control_drawings"] = fc.diff_drawings(
+        st.session_state["control_drawings"], drawings, gdf_ine
+    )
 
-    st.subheader("Map")
+control_censustracts = sorted(
+    {ct for tracts in st.session_state["control_drawings"].values() for ct in tracts}
+)
 
-    # Create the base map
-    m = folium.Map(location=[41.40463, 2.17924], zoom_start=13, tiles="cartodbpositron")
+with left:
 
+    st.subheader("Map")
 
-    draw = Draw(
+    # Filter interventions based on selection
+    filtered_interventions_gdf = interventions_gdf[interventions_gdf["TITOL_WO"].isin(geometry_selection)].copy()
+    
+    # Impacted and district areas (gdf_ine has the rows of the bitsets)
+    selected_tracts = fc.select_intervention_tracts(intervention_tract_bitmaps, geometry_selection)
+    impacted_gdf = gdf_ine[selected_tracts["impacted"]]
+    district_gdf = gdf_ine[selected_tracts["control"]]
+    series_censustracts = gdf_ine["CENSUSTRACT"][selected_tracts["series"]].tolist()
+
+    # The base map (tiles and all the interventions) is the same on every rerun.
+    # The selection and the control tracts are pushed as overlays, so updating
+    # them does not re-render the map and discard the drawings
+    m = fc.build_base_map(
+        city_config,
+        intervention_layer,
         draw_options={
             'polyline': False,
             'polygon': True,
@@ -173,139 +187,29 @@ with left:
             'marker': True,
             'color': CONTROL_COLOR
         },
-        edit_options={'edit': True},
     )
-    draw.add_to(m)
-    
-    geojson_layer = folium.FeatureGroup(name="Show Urban Interventions")
-    
-    # Filter interventions based on selection
-    filtered_interventions_gdf = interventions_gdf[interventions_gdf["TITOL_WO"].isin(geometry_selection)].copy()
-    
-    # Compute impacted and district areas
-    impacted_gdf = fc.get_impacted_gdf(filtered_interventions_gdf, gdf_ine)
-    filtered_interventions_gdf['md'] = filtered_interventions_gdf['CENSUSTRACT'].astype(str).str[0:7].astype(int)
-    gdf_ine['md'] = gdf_ine['CENSUSTRACT'].astype(str).str[0:6].astype(int)
-    district_gdf = gdf_ine[gdf_ine['md'].isin(filtered_interventions_gdf['md']) & 
-                           ~gdf_ine['CENSUSTRACT'].astype(int).isin(filtered_interventions_gdf['CENSUSTRACT'].astype(str).astype(int))]
-    
-    if st.session_state["drawn_geometries"]:
-
-        for geom in st.session_state["drawn_geometries"]:
-            folium.GeoJson(
-                geom,
-                style_function=lambda x: {
-                    "fillColor": CONTROL_COLOR,
-                    "color": CONTROL_COLOR,
-                    "weight": 1,
-                    "fillOpacity": 0.3,
-                },
-            ).add_to(m)
-        
-
-    geometry_collection = fc.GeometryCollection(st.session_state["drawn_geometries"])
-
-    # Convert drawn geometries to GeoDataFrame with the correct CRS
-    geometry_gdf = gpd.GeoDataFrame(
-        {'geometry': [geometry_collection]},
-        crs="EPSG:25830"  # Adjust if needed
+    selection_layer = fc.build_overlay(
+        "Selected interventions", [(filtered_interventions_gdf, "selected"), (impacted_gdf, "impacted")]
+    )
+    control_layer = fc.build_overlay(
+        "Control group", [(gdf_ine[gdf_ine['CENSUSTRACT'].isin(control_censustracts)], "control")]
     )
-    geometry_gdf = geometry_gdf.to_crs(gdf_ine.crs)
-
-    # Get impacted census tracts
-    my_censustracts = fc.get_impacted_gdf(geometry_gdf, gdf_ine)
-
-    for _, row in my_censustracts.iterrows():
-        folium.GeoJson(
-            row["geometry"],
-            style_function=lambda x: {
-                "fillColor": CONTROL_COLOR,
-                "color": CONTROL_COLOR,
-                "weight": 1,
-                "fillOpacity": 0.3,
-            },
-        ).add_to(geojson_layer)    
-
-    # Add geometries to the map
-    for _, row in interventions_gdf.iterrows():
-        folium.GeoJson(
-            row["geometry"],
-            name=row["TITOL_WO"],
-            tooltip=row["TITOL_WO"],
-            style_function=lambda x: {
-                "fillColor": "grey",
-                "color": "grey",
-                "weight": 1,
-                "fillOpacity": 0.3,
-            },
-        ).add_to(geojson_layer)
-
-    for _, row in filtered_interventions_gdf.iterrows():
-        folium.GeoJson(
-            row["geometry"],
-            name=row["TITOL_WO"],
-            tooltip=row["TITOL_WO"],
-            style_function=lambda x: {
-                "fillColor": INTERVENTION_COLOR,
-                "color": INTERVENTION_COLOR,
-                "weight": 2,
-                "fillOpacity": 0.6,
-            },
-        ).add_to(geojson_layer)
-
-    for _, row in impacted_gdf.iterrows():
-        folium.GeoJson(
-            row["geometry"],
-            style_function=lambda x: {
-                "fillColor": INTERSECT_COLOR,
-                "color": INTERSECT_COLOR,
-                "weight": 1,
-                "fillOpacity": 0.4,
-            },
-        ).add_to(geojson_layer)
-
-    geojson_layer.add_to(m)
-    folium.LayerControl(collapsed=False).add_to(m)
-    folium.plugins.Fullscreen(
-        position="bottomleft",
-        title="Expand me",
-        title_cancel="Exit me",
-        force_separate_button=True,
-    ).add_to(m)
-
-    # Display the appropriate map based on session state
-    if st.session_state['put_new_map_boolean']:
-        output = st_folium(m, width=600, height=500, key='new_map')
-    else:
-        output = st_folium(m, width=600, height=500, key='old_map')
-
-    # Process and display the drawn geometries
-    geometry_collection = None  # Define a default value
-    if output and output["all_drawings"]:
-        drawn_geometries = [fc.transform_geometry(geo_json['geometry']) for geo_json in output["all_drawings"]]
-        geometry_collection = fc.GeometryCollection(drawn_geometries)
-
-        st.write("Captured Geometries in UTM (EPSG:25831):")
-        st.write(geometry_collection)
-
-        # Convert drawn geometries to GeoDataFrame with the correct CRS
-        geometry_gdf = gpd.GeoDataFrame(
-            {'geometry': [geometry_collection]},
-            crs="EPSG:25830"  # Adjust if needed
-        )
-        geometry_gdf = geometry_gdf.to_crs(gdf_ine.crs)
-
-        # Get impacted census tracts
-        my_censustracts = fc.get_impacted_gdf(geometry_gdf, gdf_ine)
-
-        st.session_state["drawn_geometries"] = drawn_geometries
-        
-        st.session_state['put_new_map_boolean'] = not st.session_state['put_new_map_boolean']  # Toggle the map state
-        st.rerun()  # Force rerun to refresh with the new map
-
-    else:
+
+    # Only drawings are returned, so panning or zooming does not rerun the script.
+    # New drawings are handled by the callback before the rerun starts.
+    st_folium(
+        m,
+        width=600,
+        height=500,
+        key="control_map",
+        feature_group_to_add=[selection_layer, control_layer],
+        layer_control=folium.LayerControl(collapsed=False),
+        returned_objects=["all_drawings"],
+        on_change=update_control_group,
+    )
+
+    if not control_censustracts:
         st.warning("No geometry has been drawn, so no census tracts can be impacted.")
-        my_censustracts = []
     
 with right:
 
@@ -315,39 +219,27 @@ with right:
     price_type = 'Both'
 
     try:
-        if st.session_state["drawn_geometries"]:
-
-            geometry_collection = fc.GeometryCollection(st.session_state["drawn_geometries"])
-            geometry_gdf = gpd.GeoDataFrame(
-                {'geometry': [geometry_collection]},
-                crs="EPSG:25830"  # Assuming gdf_ine has the correct CRS (EPSG:4326)
-            )
-
-            geometry_gdf = geometry_gdf.to_crs(gdf_ine.crs)
-            my_censustracts = fc.get_impacted_gdf(geometry_gdf, gdf_ine)
-
-
-            processed_df['CENSUSTRACT'] = processed_df['CENSUSTRACT'].astype(str)
-            my_censustracts['CENSUSTRACT'] = my_censustracts['CENSUSTRACT'].astype(str)
-
-            # Apply zfill and filtering
-            control_gdf = processed_df[
-                processed_df['CENSUSTRACT'].str.zfill(10).isin(
-                    my_censustracts['CENSUSTRACT'].str.zfill(10)
-                )
-            ]
+        if control_censustracts:
 
             # Use the geometry drawn on the map
             chart = fc.plot_timeseries(
                 processed_df,
-                interventions_gdf, 
+                intervention_index,
                 impacted_gdf,
                 gdf_ine,
                 price_type=price_type.lower(),
                 district = False,
                 district_gdf = district_gdf,
+                area_weighted = area_weighted,
+                impacted_weights = impacted_weights,
+                impacted_censustracts = series_censustracts,
+                metric = metric,
+                typologies = typologies,
+                typology_breakdown = typology_breakdown,
+                confidence_bands = confidence_bands,
+                period_range = period_range,
                 control_polygon = True,
-                control_gdf =  control_gdf,
+                control_censustracts = control_censustracts,
                 SALE_COLOR = SALE_COLOR,
                 RENT_COLOR = RENT_COLOR,
                 CONTROL_SALE = CONTROL_SALE, 
@@ -364,12 +256,20 @@ with right:
             # Use the geometry drawn on the map
             chart = fc.plot_timeseries(
                 processed_df,
-                interventions_gdf, 
+                intervention_index,
                 impacted_gdf,
                 gdf_ine,
                 price_type=price_type.lower(),
                 district = False,
                 district_gdf = district_gdf,
+                area_weighted = area_weighted,
+                impacted_weights = impacted_weights,
+                impacted_censustracts = series_censustracts,
+                metric = metric,
+                typologies = typologies,
+                typology_breakdown = typology_breakdown,
+                confidence_bands = confidence_bands,
+                period_range = period_range,
                 SALE_COLOR = SALE_COLOR,
                 RENT_COLOR = RENT_COLOR, 
                 CONTROL_SALE = CONTROL_SALE,
@@ -0,0 +1,68 @@
+from streamlit_idealista.config import PROJ_ROOT
+from streamlit_idealista.cache import CACHE_REGISTRY
+import streamlit_idealista.cities  # registers the city cache
+import functions as fc  # registers the figure, aggregate, trend and cube caches
+
+import pandas as pd
+import streamlit as st
+from PIL import Image
+
+favicon = PROJ_ROOT / "streamlit_idealista/assets/favicon.png"
+im = Image.open(favicon)
+
+st.set_page_config(
+    page_title="Cache Inspector",
+    page_icon= im,
+    layout="wide",
+    initial_sidebar_state="expanded",
+    menu_items={
+        'Get Help': 'https://vCity.tech',
+        'Report a bug': "https://vCity.tech",
+        'About': "# This is a header. This is an *extremely* cool app!"
+    }
+)
+
+st.title("Cache Inspector")
+st.markdown("""
+In-process caches shared by every session of this server, with their policies
+(`CACHE_POLICIES` in `config.py`). Entries are listed least recently used first.
+""")
+
+def to_mib(nbytes) -> float:
+    return nbytes / 2**20
+
+summary = pd.DataFrame([
+    {
+        "Cache": name,
+        "Entries": len(cache),
+        "Max entries": cache.max_entries,
+        "MiB": to_mib(cache.nbytes),
+        "Budget MiB": None if cache.max_bytes is None else to_mib(cache.max_bytes),
+        "TTL (s)": cache.ttl,
+        "Hits": cache.hits,
+        "Misses": cache.misses,
+        "Hit rate": cache.hit_rate,
+        "Evictions": cache.evictions,
+    }
+    for name, cache in CACHE_REGISTRY.items()
+])
+st.dataframe(summary, hide_index=True, use_container_width=True)
+
+for name, cache in CACHE_REGISTRY.items():
+    with st.expander(f"{name}: {len(cache)} entries, {to_mib(cache.nbytes):.1f} MiB"):
+        entries = cache.entries()
+        st.dataframe(
+            entries.assign(MiB=to_mib(entries["NBYTES"])).drop(columns="NBYTES"),
+            hide_index=True,
+            use_container_width=True,
+        )
+
+        selected_keys = st.multiselect("Entries to evict", options=entries["KEY"], key=f"evict_{name}")
+        evict_column, clear_column = st.columns([1, 1])
+        if evict_column.button("Evict selected", key=f"evict_button_{name}", disabled=not selected_keys):
+            for key in selected_keys:
+                cache.pop(key)
+            st.rerun()
+        if clear_column.button("Clear cache", key=f"clear_button_{name}", disabled=len(cache) == 0):
+            cache.clear()
+            st.rerun()
@@ -0,0 +1,113 @@
+from streamlit_idealista.config import PROJ_ROOT
+from streamlit_idealista.cities import get_city, get_city_resource, select_city
+import functions as fc
+
+import pandas as pd
+import streamlit as st
+from streamlit_folium import st_folium
+from PIL import Image
+
+favicon = PROJ_ROOT / "streamlit_idealista/assets/favicon.png"
+im = Image.open(favicon)
+
+st.set_page_config(
+    page_title="Citywide Map",
+    page_icon= im,
+    layout="wide",
+    initial_sidebar_state="expanded",
+    menu_items={
+        'Get Help': 'https://vCity.tech',
+        'Report a bug': "https://vCity.tech",
+        'About': "# This is a header. This is an *extremely* cool app!"
+    }
+)
+
+st.markdown(
+    """
+    <link href="https://fonts.googleapis.com/css2?family=DM+Sans:wght@400&display=swap" rel="stylesheet">
+    <style>
+    body {
+        font-family: 'DM Sans', sans-serif !important;
+    }
+    </style>
+    """,
+    unsafe_allow_html=True
+)
+
+# load data
+city = select_city()
+city_data = get_city(city)
+city_config = city_data["config"]
+processed_df = city_data["processed_df"]
+
+intervention_index = get_city_resource(city, "intervention_index")
+# Encoded once per city; the map only loads the census tracts once per session
+tract_layer = get_city_resource(city, "tract_layer")
+
+st.title("Citywide Map")
+
+metric_columns = fc.get_metric_columns(processed_df)
+metric = st.selectbox(
+    "Metric",
+    options=metric_columns,
+    index=metric_columns.index("UNITPRICE_ASKING") if "UNITPRICE_ASKING" in metric_columns else 0,
+)
+
+# Every measure of every census tract and period, computed once per metric
+choropleth = fc.get_cached_choropleth_arrays(processed_df, intervention_index, metric)
+
+measure_column, operation_column = st.columns([2, 1])
+measure = measure_column.radio(
+    "Colour by",
+    options=list(fc.CHOROPLETH_MEASURES),
+    format_func=fc.CHOROPLETH_MEASURES.get,
+    horizontal=True,
+    help="The change since before the interventions compares each intervened census tract with its mean before its first intervention started, once its last intervention ended."
+)
+operations = list(choropleth["operations"])
+operation = operation_column.radio(
+    "Price type",
+    options=operations,
+    format_func=lambda operation: fc.PRICE_TYPE_LABELS.get(operation, operation),
+    horizontal=True,
+)
+
+periods = list(choropleth["periods"])
+period = st.select_slider(
+    "Period",
+    options=periods,
+    value=periods[-1],
+    format_func=lambda period: str(pd.Period(period, freq="M")),
+)
+
+colors, legend = fc.get_choropleth_colors(choropleth, measure, period, operation)
+
+# The census tracts are only sent with the base map; a new period, measure or
+# metric only sends the colours
+st_folium(
+    fc.build_choropleth_map(city_config, tract_layer),
+    height=600,
+    use_container_width=True,
+    key="choropleth_map",
+    feature_group_to_add=fc.build_choropleth_overlay(colors),
+    returned_objects=[],
+)
+
+gradient = ", ".join(color for _, color in legend)
+if measure == "value":
+    stop_labels = [f"{value:,.0f}" for value, _ in legend]
+else:
+    stop_labels = [f"{value:+.0%}" for value, _ in legend]
+stop_spans = "".join(f"<span>{label}</span>" for label in stop_labels)
+st.markdown(
+    f"""
+    <div style="height: 12px; background: linear-gradient(to right, {gradient});"></div>
+    <div style="display: flex; justify-content: space-between;">
+    {stop_spans}
+    </div>
+    """,
+    unsafe_allow_html=True
+)
+st.caption(
+    f"{len(colors)} of {len(choropleth['censustracts'])} census tracts have a value in {pd.Period(period, freq='Q')}."
+)
@@ -0,0 +1,102 @@
+from streamlit_idealista.config import PROJ_ROOT, SQL_MAX_ROWS, SQL_PAGE_ROWS, SQL_QUERY_TIMEOUT
+from streamlit_idealista.cities import get_city, get_city_resource, select_city
+from streamlit_idealista import sql_console
+import functions as fc
+
+import duckdb
+import streamlit as st
+from PIL import Image
+
+favicon = PROJ_ROOT / "streamlit_idealista/assets/favicon.png"
+im = Image.open(favicon)
+
+st.set_page_config(
+    page_title="SQL Console",
+    page_icon= im,
+    layout="wide",
+    initial_sidebar_state="expanded",
+    menu_items={
+        'Get Help': 'https://vCity.tech',
+        'Report a bug': "https://vCity.tech",
+        'About': "# This is a header. This is an *extremely* cool app!"
+    }
+)
+
+st.markdown(
+    """
+    <link href="https://fonts.googleapis.com/css2?family=DM+Sans:wght@400&display=swap" rel="stylesheet">
+    <style>
+    body {
+        font-family: 'DM Sans', sans-serif !important;
+    }
+    </style>
+    """,
+    unsafe_allow_html=True
+)
+
+# load data
+city = select_city()
+city_data = get_city(city)
+city_config = city_data["config"]
+
+intervention_index = get_city_resource(city, "intervention_index")
+# Arrow copies of the datasets, converted once per city and shared by every query
+sql_tables = get_city_resource(city, "sql_tables")
+
+st.title("SQL Console")
+st.caption(
+    f"Queries run with DuckDB in a worker thread over the datasets of {city_config['name']}. "
+    f"They are interrupted after {SQL_QUERY_TIMEOUT:.0f}s and return at most {SQL_MAX_ROWS:,} rows. "
+    "Files on the server can't be read or written."
+)
+
+with st.expander("Tables"):
+    st.dataframe(sql_console.describe_sql_tables(sql_tables), hide_index=True, use_container_width=True)
+
+sql = st.text_area("Query", value=sql_console.SQL_EXAMPLE_QUERY, height=200)
+
+run_column, cancel_column = st.columns([1, 1])
+if run_column.button("Run", type="primary", disabled=not sql.strip()):
+    if st.session_state.get("sql_query") is not None:
+        st.session_state["sql_query"].cancel()
+    st.session_state["sql_query"] = sql_console.SQLQuery(sql_tables, sql)
+    st.session_state["sql_city"] = city
+    st.session_state["sql_page"] = 1
+
+@st.fragment(run_every=1)
+def wait_for_query(query):
+    if query.future.done():
+        st.rerun()
+    if query.started is None:
+        st.caption("Waiting for a free SQL worker...")
+    else:
+        st.caption(f"Running for {query.elapsed:.0f}s, {query.rows_fetched:,} rows fetched...")
+
+query = st.session_state.get("sql_query") if st.session_state.get("sql_city") == city else None
+if query is not None:
+    if cancel_column.button("Cancel", disabled=query.future.done()):
+        query.cancel()
+
+    if not query.future.done():
+        wait_for_query(query)
+    elif query.cancelled:
+        st.info("Query cancelled.")
+    else:
+        try:
+            result = query.future.result()
+        except (duckdb.Error, TimeoutError) as e:
+            st.error(str(e))
+        else:
+            # Only the rows of the shown page are sent to the browser
+            table = result["table"]
+            n_pages = max(-(-table.num_rows // SQL_PAGE_ROWS), 1)
+            if st.session_state.get("sql_page", 1) > n_pages:
+                st.session_state["sql_page"] = 1
+            page = st.number_input("Page", min_value=1, max_value=n_pages, key="sql_page")
+            st.dataframe(
+                table.slice((page - 1) * SQL_PAGE_ROWS, SQL_PAGE_ROWS).to_pandas(),
+                hide_index=True,
+                use_container_width=True,
+            )
+            truncated = f", truncated to the first {SQL_MAX_ROWS:,}" if result["truncated"] else ""
+            st.caption(f"{table.num_rows:,} rows{truncated} in {result['seconds']:.2f}s, page {page} of {n_pages}.")
@@ -0,0 +1,226 @@
+import codecs
+import io
+from typing import BinaryIO, List, Optional
+
+import numpy as np
+import pandas as pd
+import polars as pl
+
+# Polars expressions of the aggregation statistics (see functions.AGGREGATION_STATISTICS),
+# with the pandas semantics: nulls are skipped, std has one degree of freedom
+POLARS_STATISTICS = {
+    "mean": lambda column: pl.col(column).mean(),
+    "median": lambda column: pl.col(column).median(),
+    "min": lambda column: pl.col(column).min(),
+    "max": lambda column: pl.col(column).max(),
+    "std": lambda column: pl.col(column).std(ddof=1),
+    "sum": lambda column: pl.col(column).sum(),
+    "count": lambda column: pl.col(column).count(),
+}
+
+# Polars types of the pandas dtypes of the listings (see dataset.load_dtypes);
+# other dtypes are read as strings and converted by pandas
+POLARS_DTYPES = {
+    "str": pl.String,
+    "object": pl.String,
+    "string": pl.String,
+    "int": pl.Int64,
+    "int64": pl.Int64,
+    "int32": pl.Int32,
+    "float": pl.Float64,
+    "float64": pl.Float64,
+    "float32": pl.Float32,
+    "bool": pl.Boolean,
+}
+
+# Bytes of the CSV transcoded at a time
+TRANSCODE_CHUNK_BYTES = 16 * 2**20
+# Rows the types of the columns without a declared dtype are inferred from;
+# the whole column is only scanned when a later value does not parse
+INFER_SCHEMA_ROWS = 10_000
+
+
+def transcode_unicode_escape(f: BinaryIO, chunk_bytes: int = TRANSCODE_CHUNK_BYTES) -> io.BytesIO:
+    """
+    Transcode a file read by pandas as unicode_escape to UTF-8 for Polars,
+    chunk by chunk, so only the UTF-8 copy is held in full.
+
+    ASCII chunks without backslashes are the same in both encodings and are
+    copied as they are; the others go through an incremental decoder, which
+    keeps escape sequences split between chunks.
+    """
+    decoder = codecs.getincrementaldecoder("unicode_escape")()
+    sink = io.BytesIO()
+    while chunk := f.read(chunk_bytes):
+        if chunk.isascii() and b"\\" not in chunk and decoder.getstate()[0] == b"":
+            sink.write(chunk)
+        else:
+            sink.write(decoder.decode(chunk).encode("utf-8"))
+    sink.write(decoder.decode(b"", final=True).encode("utf-8"))
+    sink.seek(0)
+    return sink
+
+
+def read_listings_csv(f: BinaryIO, dtypes: dict) -> pd.DataFrame:
+    """
+    Read the listings CSV with the multi-threaded Polars reader, with the same
+    columns and dtypes as dataset.load_main_data reading it with pandas.
+
+    The file is decoded as unicode_escape, as pandas does, in chunks (see
+    transcode_unicode_escape). Every column with a declared dtype is read with
+    its type. The others are inferred from the first INFER_SCHEMA_ROWS rows;
+    if a later value does not parse with the inferred type (e.g. a float in a
+    column of integers), they are inferred again from the whole column, as
+    pandas does. Floats may differ from the pandas parser in the last bit.
+
+    Args:
+      f (BinaryIO): The listings CSV.
+      dtypes (dict): The pandas dtypes of the columns (see dataset.load_dtypes).
+
+    Returns:
+      pd.DataFrame: The listings.
+    """
+    csv = transcode_unicode_escape(f)
+    schema_overrides = {column: POLARS_DTYPES.get(str(dtype), pl.String) for column, dtype in dtypes.items()}
+    try:
+        df = pl.read_csv(csv, separator=";", schema_overrides=schema_overrides, infer_schema_length=INFER_SCHEMA_ROWS)
+    except pl.exceptions.ComputeError:
+        csv.seek(0)
+        df = pl.read_csv(csv, separator=";", schema_overrides=schema_overrides, infer_schema_length=None)
+    df = df.to_pandas()
+
+    # Polars strings come out as objects; pandas infers its own string dtype when enabled
+    if pd.get_option("future.infer_string"):
+        for column in df.columns[df.dtypes == object]:
+            df[column] = df[column].astype("str")
+
+    other_dtypes = {
+        column: dtype for column, dtype in dtypes.items()
+        if column in df.columns and POLARS_DTYPES.get(str(dtype)) is not pl.String
+    }
+    return df.astype(other_dtypes) if other_dtypes else df
+
+
+def to_polars_listings(df: pd.DataFrame, metrics: List[str]) -> dict:
+    """
+    Convert the processed listings to a Polars frame for get_multi_metric_timeseries.
+
+    PERIOD and ADOPERATION are stored as integer codes, so grouping compares
+    integers, and are decoded back when building the pandas output.
+
+    Args:
+      df (pd.DataFrame): The processed listings.
+      metrics (List[str]): The metric columns to convert.
+
+    Returns:
+      dict: The "frame" (CENSUSTRACT, QUARTER, PERIOD_CODE, OPERATION_CODE and
+        the metrics), and the sorted "periods" and the "operations" categories
+        the codes refer to.
+    """
+    period_codes, periods = pd.factorize(df["PERIOD"], sort=True)
+    frame = pl.DataFrame({
+        "CENSUSTRACT": pl.Series(df["CENSUSTRACT"].astype(str).to_numpy(), dtype=pl.String),
+        "QUARTER": df["QUARTER"].to_numpy(),
+        "PERIOD_CODE": period_codes,
+        "OPERATION_CODE": df["ADOPERATION"].cat.codes.to_numpy().astype(np.int32),
+        **{metric: pl.from_pandas(df[metric], nan_to_null=True) for metric in metrics},
+    })
+    return {
+        "frame": frame,
+        "periods": pd.Index(periods, name="PERIOD"),
+        "operations": df["ADOPERATION"].cat.categories,
+    }
+
+
+def filter_listings(listings: dict, censustract_list: List[str], quarter_bounds: Optional[tuple] = None) -> pl.LazyFrame:
+    """Lazily select the listings of the given census tracts and quarters."""
+    query = listings["frame"].lazy().filter(pl.col("CENSUSTRACT").is_in([str(ct) for ct in censustract_list]))
+    if quarter_bounds is not None:
+        query = query.filter(pl.col("QUARTER").is_between(*quarter_bounds))
+    return query
+
+
+def select_listings(listings: dict,
+                    censustract_list: List[str],
+                    metrics: List[str],
+                    quarter_bounds: Optional[tuple] = None
+                    ) -> pd.DataFrame:
+    """
+    Select the listings of the given census tracts and quarters in Polars and
+    return them in their original order as pandas, with the CENSUSTRACT,
+    PERIOD and ADOPERATION columns of the processed listings and the metrics.
+    """
+    selected = filter_listings(listings, censustract_list, quarter_bounds).collect()
+    return pd.DataFrame({
+        "CENSUSTRACT": selected["CENSUSTRACT"].to_pandas(),
+        "PERIOD": listings["periods"].take(selected["PERIOD_CODE"].to_numpy(), allow_fill=True, fill_value=np.nan),
+        "ADOPERATION": pd.Categorical.from_codes(selected["OPERATION_CODE"].to_numpy(), categories=listings["operations"]),
+        **{metric: selected[metric].to_pandas() for metric in metrics},
+    })
+
+
+def get_multi_metric_timeseries(listings: dict,
+                                censustract_list: List[str],
+                                metrics: List[str],
+                                statistics: List[str],
+                                quarter_bounds: Optional[tuple] = None
+                                ) -> pd.DataFrame:
+    """
+    Polars version of functions.get_multi_metric_timeseries without weights:
+    filter and aggregate the listings in one lazy, multi-threaded query, then
+    shape the result as the pandas groupby does (every operation of every
+    period, in (metric, statistic, ADOPERATION) columns).
+
+    Args:
+      listings (dict): As built by to_polars_listings.
+      censustract_list (List[str]): The census tracts to aggregate.
+      metrics (List[str]): The metric columns.
+      statistics (List[str]): The statistics (see POLARS_STATISTICS).
+      quarter_bounds (Optional[tuple]): The first and last QUARTER to keep; all if None.
+
+    Returns:
+      pd.DataFrame: The timeseries indexed by PERIOD, with (metric, statistic,
+        ADOPERATION) MultiIndex columns.
+    """
+    aggregations = [
+        POLARS_STATISTICS[statistic](metric).alias(f"{metric}\t{statistic}")
+        for metric in metrics for statistic in statistics
+    ]
+    grouped = (
+        filter_listings(listings, censustract_list, quarter_bounds)
+        .filter((pl.col("PERIOD_CODE") >= 0) & (pl.col("OPERATION_CODE") >= 0))
+        .group_by(["PERIOD_CODE", "OPERATION_CODE"])
+        .agg(aggregations)
+        .collect()
+        .to_pandas()
+    )
+
+    # Every operation of every period with listings, as the pandas groupby with observed=False
+    period_codes = np.sort(grouped["PERIOD_CODE"].unique())
+    full_index = pd.MultiIndex.from_product(
+        [period_codes, np.arange(len(listings["operations"]))], names=["PERIOD_CODE", "OPERATION_CODE"]
+    )
+    values = grouped.set_index(["PERIOD_CODE", "OPERATION_CODE"])
+    dtypes = values.dtypes
+    values = values.reindex(full_index)
+
+    # Empty groups have a zero sum and count, as in pandas, which counts in int64
+    for column in values.columns:
+        if column.endswith("\tsum"):
+            values[column] = values[column].fillna(0).astype(dtypes[column])
+        elif column.endswith("\tcount"):
+            values[column] = values[column].fillna(0).astype(np.int64)
+
+    values.index = pd.MultiIndex.from_arrays(
+        [
+            listings["periods"][values.index.get_level_values("PERIOD_CODE")],
+            pd.CategoricalIndex(
+                listings["operations"][values.index.get_level_values("OPERATION_CODE")],
+                categories=listings["operations"],
+            ),
+        ],
+        names=["PERIOD", "ADOPERATION"],
+    )
+    values.columns = pd.MultiIndex.from_tuples([tuple(column.split("\t")) for column in values.columns])
+    values = values[[(metric, statistic) for metric in metrics for statistic in statistics]]
+    return values.unstack("ADOPERATION")
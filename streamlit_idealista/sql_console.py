@@ -0,0 +1,217 @@
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+from typing import Dict, List, Optional
+
+import duckdb
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from streamlit_idealista.config import (
+    CENSUSTRACT_HIERARCHY,
+    INPUT_DTYPES_COUPLED_JSON_PATH,
+    INPUT_OPERATION_TYPES_PATH,
+    INPUT_TYPOLOGY_TYPES_PATH,
+    PROJECTED_CRS,
+    SQL_MAX_ROWS,
+    SQL_MEMORY_LIMIT,
+    SQL_PAGE_ROWS,
+    SQL_QUERY_TIMEOUT,
+    SQL_THREADS,
+    SQL_WORKERS,
+)
+from streamlit_idealista.dataset import load_dtypes, load_operation_types, load_typology_types
+
+# Queries run here, off the Streamlit script threads; more wait in the queue
+_SQL_EXECUTOR = ThreadPoolExecutor(max_workers=SQL_WORKERS, thread_name_prefix="sql")
+
+SQL_EXAMPLE_QUERY = """SELECT c.DISTRICT, l.QUARTER, avg(l.UNITPRICE_ASKING) AS UNITPRICE_ASKING, sum(l.ADS) AS ADS
+FROM listings AS l
+JOIN censustracts AS c USING (CENSUSTRACT)
+WHERE l.ADOPERATION = 'sale'
+GROUP BY ALL
+ORDER BY ALL"""
+
+
+def build_sql_tables(city_data: dict, intervention_index: pd.DataFrame) -> Dict[str, pa.Table]:
+    """
+    Convert the datasets of a city to the Arrow tables queried by the SQL console.
+
+    CENSUSTRACT is the 10 digit zero-padded code in every table, so they join.
+    In the listings, PERIOD is a date and QUARTER its quarter label (e.g. "2016Q3").
+
+    Args:
+      city_data (dict): The datasets of the city (see cities.load_city).
+      intervention_index (pd.DataFrame): As built by functions.build_intervention_index.
+
+    Returns:
+      Dict[str, pa.Table]: The "listings", the "censustracts" hierarchy
+        (CENSUSTRACT_HIERARCHY levels and AREA_KM2), the "interventions" of
+        each census tract and the "operation_types" and "typology_types"
+        dimension tables, by view name.
+    """
+    df = city_data["processed_df"]
+
+    # Parse the distinct periods and quarters only, then expand them to the listings
+    period_codes, periods = pd.factorize(df["PERIOD"])
+    period_dates = pd.DatetimeIndex(pd.to_datetime(periods, errors="coerce")).normalize()
+    quarter_codes, quarters = pd.factorize(df["QUARTER"], sort=True)
+    if len(quarters) and quarters[0] == np.iinfo(np.int16).min:
+        # Unparsed periods (see dataset.decode_periods) have no quarter
+        quarter_codes, quarters = quarter_codes - 1, quarters[1:]
+
+    listings = df.drop(columns=["QUARTER"]).assign(
+        CENSUSTRACT=df["CENSUSTRACT"].astype(str).str.zfill(10),
+        PERIOD=period_dates.take(period_codes, allow_fill=True, fill_value=pd.NaT),
+        QUARTER=pd.Categorical.from_codes(
+            quarter_codes, categories=pd.PeriodIndex.from_ordinals(quarters, freq="Q").astype(str)
+        ),
+    )
+
+    gdf_ine = city_data["gdf_ine"]
+    censustracts = pd.DataFrame({"CENSUSTRACT": gdf_ine["CENSUSTRACT"].astype(str).str.zfill(10).values})
+    for level, length in CENSUSTRACT_HIERARCHY.items():
+        censustracts[level] = censustracts["CENSUSTRACT"].str[:length]
+    censustracts["AREA_KM2"] = gdf_ine.geometry.to_crs(PROJECTED_CRS).area.values / 1e6
+
+    dtypes_coupled_dict = load_dtypes(INPUT_DTYPES_COUPLED_JSON_PATH)
+    tables = {
+        "listings": listings,
+        "censustracts": censustracts,
+        "interventions": intervention_index,
+        "operation_types": load_operation_types(INPUT_OPERATION_TYPES_PATH, dtypes_coupled_dict),
+        "typology_types": load_typology_types(INPUT_TYPOLOGY_TYPES_PATH, dtypes_coupled_dict),
+    }
+    tables = {name: pa.Table.from_pandas(table, preserve_index=False) for name, table in tables.items()}
+    period_column = tables["listings"].schema.get_field_index("PERIOD")
+    tables["listings"] = tables["listings"].set_column(
+        period_column, "PERIOD", tables["listings"]["PERIOD"].cast(pa.date32())
+    )
+    return tables
+
+
+def connect_sql_tables(tables: Dict[str, pa.Table]) -> duckdb.DuckDBPyConnection:
+    """
+    Open an in-memory DuckDB database with the tables as read-only views.
+
+    Each query gets its own database, so queries can't change what other
+    sessions see. File system access is disabled and the configuration is
+    locked, so queries can't read or write files on the server.
+    """
+    connection = duckdb.connect(config={
+        "threads": SQL_THREADS,
+        "memory_limit": SQL_MEMORY_LIMIT,
+        "enable_external_access": False,
+    })
+    for name, table in tables.items():
+        connection.register(name, table)
+    connection.execute("SET lock_configuration = true")
+    return connection
+
+
+def describe_sql_tables(tables: Dict[str, pa.Table]) -> pd.DataFrame:
+    """Get the TABLE, COLUMN and SQL TYPE of every column of the views."""
+    connection = connect_sql_tables(tables)
+    try:
+        return connection.execute(
+            'SELECT table_name AS "TABLE", column_name AS "COLUMN", data_type AS "TYPE" '
+            "FROM information_schema.columns ORDER BY table_name, ordinal_position"
+        ).df()
+    finally:
+        connection.close()
+
+
+class SQLQuery:
+    """
+    A query over the SQL console tables, running in the SQL worker pool.
+
+    The result is fetched from DuckDB in batches of SQL_PAGE_ROWS rows and
+    fetching stops past max_rows, so a large result is never computed nor
+    held in full. The query is interrupted once it has run for timeout
+    seconds, or when cancelled.
+
+    Args:
+      tables (Dict[str, pa.Table]): As built by build_sql_tables.
+      sql (str): The query; with several statements, the last one returns the result.
+      max_rows (int): Rows kept in the result.
+      timeout (float): Seconds the query may run.
+    """
+
+    def __init__(
+        self,
+        tables: Dict[str, pa.Table],
+        sql: str,
+        max_rows: int = SQL_MAX_ROWS,
+        timeout: float = SQL_QUERY_TIMEOUT,
+    ):
+        self.sql = sql
+        self.max_rows = max_rows
+        self.timeout = timeout
+        self.started: Optional[float] = None
+        self.batches: List[pa.RecordBatch] = []
+        self.timed_out = False
+        self.cancelled = False
+        self._connection = connect_sql_tables(tables)
+        self._connection_lock = threading.Lock()
+        self._closed = False
+        self._timer = threading.Timer(timeout, self._interrupt_on_timeout)
+        self.future = _SQL_EXECUTOR.submit(self._run)
+
+    @property
+    def rows_fetched(self) -> int:
+        return sum(batch.num_rows for batch in self.batches)
+
+    @property
+    def elapsed(self) -> float:
+        return 0.0 if self.started is None else time.perf_counter() - self.started
+
+    def _interrupt(self):
+        with self._connection_lock:
+            if not self._closed:
+                self._connection.interrupt()
+
+    def _interrupt_on_timeout(self):
+        self.timed_out = True
+        self._interrupt()
+
+    def cancel(self):
+        """Interrupt the query, or drop it if it is still queued."""
+        if self.future.done():
+            return
+        self.cancelled = True
+        if self.future.cancel():
+            self._close()
+        else:
+            self._interrupt()
+
+    def _close(self):
+        with self._connection_lock:
+            self._closed = True
+            self._connection.close()
+
+    def _run(self) -> dict:
+        self.started = time.perf_counter()
+        self._timer.start()
+        try:
+            if self.cancelled:
+                raise duckdb.InterruptException("Query cancelled")
+            reader = self._connection.execute(self.sql).to_arrow_reader(SQL_PAGE_ROWS)
+            for batch in reader:
+                self.batches.append(batch)
+                if self.rows_fetched > self.max_rows:
+                    break
+            table = pa.Table.from_batches(self.batches, schema=reader.schema)
+        except duckdb.InterruptException as e:
+            if self.timed_out:
+                raise TimeoutError(f"Query interrupted after {self.timeout:.0f}s") from e
+            raise
+        finally:
+            self._timer.cancel()
+            self._close()
+
+        return {
+            "table": table.slice(0, self.max_rows),
+            "truncated": table.num_rows > self.max_rows,
+            "seconds": self.elapsed,
+        }
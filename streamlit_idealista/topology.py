@@ -0,0 +1,222 @@
+import json
+from typing import Dict, List, Optional, Tuple
+
+import geopandas as gpd
+import numpy as np
+import shapely
+
+from streamlit_idealista.config import TOPOJSON_QUANTIZATION
+
+
+def get_quantization_transform(bounds: np.ndarray, quantization: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Get the translate and scale of the TopoJSON transform mapping the bounds
+    to the integer grid [0, quantization - 1] on both axes.
+    """
+    translate = bounds[:2]
+    extent = bounds[2:] - bounds[:2]
+    scale = np.where(extent > 0, extent / (quantization - 1), 1.0)
+    return translate, scale
+
+
+def quantize_line(coords: np.ndarray, translate: np.ndarray, scale: np.ndarray, closed: bool) -> Optional[np.ndarray]:
+    """
+    Quantize the coordinates of a line or ring, dropping the points that fall
+    on the same grid cell as the previous one (and the closing point of rings).
+
+    Returns:
+      Optional[np.ndarray]: The (points, 2) integer coordinates; None if the
+        line or ring collapses.
+    """
+    quantized = np.round((coords[:, :2] - translate) / scale).astype(np.int64)
+    keep = np.ones(len(quantized), dtype=bool)
+    keep[1:] = np.any(quantized[1:] != quantized[:-1], axis=1)
+    quantized = quantized[keep]
+
+    if closed:
+        if len(quantized) > 1 and np.array_equal(quantized[0], quantized[-1]):
+            quantized = quantized[:-1]
+        return quantized if len(quantized) >= 3 else None
+    return quantized if len(quantized) >= 2 else None
+
+
+def find_junctions(lines: List[np.ndarray], closed: List[bool], quantization: int) -> np.ndarray:
+    """
+    Find the points where lines meet or part ways: the points reached from
+    different neighbours in different lines, and the ends of open lines.
+
+    Returns:
+      np.ndarray: The sorted ids (x * quantization + y) of the junctions.
+    """
+    point_ids, neighbour_pairs, ends = [], [], []
+    for line, is_ring in zip(lines, closed):
+        ids = line[:, 0] * quantization + line[:, 1]
+        if is_ring:
+            previous, following = np.roll(ids, 1), np.roll(ids, -1)
+        else:
+            previous, following = np.r_[-1, ids[:-1]], np.r_[ids[1:], -1]
+            ends.append(ids[[0, -1]])
+        point_ids.append(ids)
+        neighbour_pairs.append(np.column_stack([np.minimum(previous, following), np.maximum(previous, following)]))
+
+    if not point_ids:
+        return np.array([], dtype=np.int64)
+
+    # A point is a junction if it is visited with more than one pair of neighbours
+    visits = np.unique(np.column_stack([np.concatenate(point_ids), np.concatenate(neighbour_pairs)]), axis=0)
+    visited_ids, visit_counts = np.unique(visits[:, 0], return_counts=True)
+    return np.union1d(visited_ids[visit_counts > 1], np.concatenate(ends) if ends else np.array([], dtype=np.int64))
+
+
+def cut_line(line: np.ndarray, ids: np.ndarray, junctions: np.ndarray, is_ring: bool) -> List[Tuple[np.ndarray, np.ndarray]]:
+    """
+    Cut a quantized line or ring at its junctions into arcs sharing their end points.
+
+    Rings without junctions are rotated to start at their smallest point, so
+    rings shared by several features are found identical.
+    """
+    positions = np.flatnonzero(np.isin(ids, junctions))
+    if is_ring:
+        start = positions[0] if len(positions) else int(np.argmin(ids))
+        line, ids = np.roll(line, -start, axis=0), np.roll(ids, -start)
+        line, ids = np.vstack([line, line[:1]]), np.r_[ids, ids[0]]
+        positions = np.r_[positions - start, len(ids) - 1] if len(positions) else np.array([0, len(ids) - 1])
+        positions = np.unique(np.r_[0, positions])
+
+    return [
+        (line[begin:end + 1], ids[begin:end + 1])
+        for begin, end in zip(positions[:-1], positions[1:])
+    ]
+
+
+def collect_lines(geometry, translate: np.ndarray, scale: np.ndarray, lines: List[np.ndarray], closed: List[bool]) -> dict:
+    """
+    Quantize the lines and rings of a geometry, appending them to lines, and
+    return the geometry with the positions of its lines in place of coordinates.
+    """
+    def add(coords, is_ring):
+        quantized = quantize_line(np.asarray(coords), translate, scale, is_ring)
+        if quantized is None:
+            return None
+        lines.append(quantized)
+        closed.append(is_ring)
+        return len(lines) - 1
+
+    def polygon_rings(polygon):
+        exterior = add(polygon.exterior.coords, True)
+        if exterior is None:
+            return None
+        interiors = [add(ring.coords, True) for ring in polygon.interiors]
+        return [exterior, *[ring for ring in interiors if ring is not None]]
+
+    if geometry is None or geometry.is_empty:
+        return {"type": None}
+
+    geometry_type = geometry.geom_type
+    if geometry_type in ["Polygon", "MultiPolygon"]:
+        polygons = [polygon_rings(polygon) for polygon in shapely.get_parts(geometry)]
+        polygons = [rings for rings in polygons if rings is not None]
+        return {"type": "MultiPolygon", "lines": polygons} if polygons else {"type": None}
+    if geometry_type in ["LineString", "MultiLineString"]:
+        parts = [add(line.coords, False) for line in shapely.get_parts(geometry)]
+        parts = [part for part in parts if part is not None]
+        return {"type": "MultiLineString", "lines": parts} if parts else {"type": None}
+    if geometry_type in ["Point", "MultiPoint"]:
+        points = shapely.get_coordinates(geometry)
+        return {"type": "MultiPoint", "coordinates": np.round((points - translate) / scale).astype(int).tolist()}
+    raise ValueError(f"Unsupported geometry type: {geometry_type}")
+
+
+def to_topology_geometry(geometry: dict, line_arcs: List[List[int]]) -> dict:
+    """Replace the line positions of a collected geometry by their arc references."""
+    if geometry["type"] == "MultiPolygon":
+        polygons = [[line_arcs[ring] for ring in rings] for rings in geometry["lines"]]
+        if len(polygons) == 1:
+            return {"type": "Polygon", "arcs": polygons[0]}
+        return {"type": "MultiPolygon", "arcs": polygons}
+    if geometry["type"] == "MultiLineString":
+        lines = [line_arcs[line] for line in geometry["lines"]]
+        if len(lines) == 1:
+            return {"type": "LineString", "arcs": lines[0]}
+        return {"type": "MultiLineString", "arcs": lines}
+    if geometry["type"] == "MultiPoint" and len(geometry["coordinates"]) == 1:
+        return {"type": "Point", "coordinates": geometry["coordinates"][0]}
+    return geometry
+
+
+def encode_topology(layers: Dict[str, gpd.GeoDataFrame],
+                    properties: Optional[Dict[str, List[str]]] = None,
+                    quantization: int = TOPOJSON_QUANTIZATION
+                    ) -> dict:
+    """
+    Encode GeoDataFrames as one quantized TopoJSON topology.
+
+    The coordinates are snapped to a quantization x quantization grid over the
+    bounds of all the layers, the lines and rings are cut at their junctions
+    into arcs, and every arc shared by several geometries (e.g. the border of
+    two census tracts) is stored once and delta-encoded.
+
+    Args:
+      layers (Dict[str, gpd.GeoDataFrame]): The geometries of each object of
+        the topology, in the CRS of the client (EPSG:4326 for leaflet).
+      properties (Optional[Dict[str, List[str]]]): The property columns of each
+        layer; none if not given.
+      quantization (int): Number of grid positions per axis.
+
+    Returns:
+      dict: The TopoJSON Topology. Polygons, lines and points are supported;
+        geometries that collapse on the grid are null.
+    """
+    properties = properties or {}
+    non_empty = [gdf.total_bounds for gdf in layers.values() if not gdf.empty]
+    bounds = np.array([
+        min(b[0] for b in non_empty), min(b[1] for b in non_empty),
+        max(b[2] for b in non_empty), max(b[3] for b in non_empty),
+    ]) if non_empty else np.array([0.0, 0.0, 1.0, 1.0])
+    translate, scale = get_quantization_transform(bounds, quantization)
+
+    # Quantize every line and ring, keeping the nesting of each geometry
+    lines, closed, geometries = [], [], {}
+    for name, gdf in layers.items():
+        geometries[name] = []
+        for geometry in gdf.geometry:
+            geometries[name].append(collect_lines(geometry, translate, scale, lines, closed))
+
+    junctions = find_junctions(lines, closed, quantization)
+
+    # Cut the lines into arcs, storing each arc (or its reverse) once
+    arcs, arc_index, line_arcs = [], {}, []
+    for line, is_ring in zip(lines, closed):
+        ids = line[:, 0] * quantization + line[:, 1]
+        refs = []
+        for arc, arc_ids in cut_line(line, ids, junctions, is_ring):
+            key, reverse_key = arc_ids.tobytes(), arc_ids[::-1].tobytes()
+            if key in arc_index:
+                refs.append(arc_index[key])
+            elif reverse_key in arc_index:
+                refs.append(~arc_index[reverse_key])
+            else:
+                arc_index[key] = len(arcs)
+                refs.append(len(arcs))
+                arcs.append(np.vstack([arc[:1], np.diff(arc, axis=0)]).tolist())
+        line_arcs.append(refs)
+
+    objects = {}
+    for name, gdf in layers.items():
+        columns = properties.get(name, [])
+        records = json.loads(gdf[columns].to_json(orient="records")) if columns else [{}] * len(gdf)
+        objects[name] = {
+            "type": "GeometryCollection",
+            "geometries": [
+                {**to_topology_geometry(geometry, line_arcs), "properties": record}
+                for geometry, record in zip(geometries[name], records)
+            ],
+        }
+
+    return {
+        "type": "Topology",
+        "bbox": bounds.tolist(),
+        "transform": {"scale": scale.tolist(), "translate": translate.tolist()},
+        "objects": objects,
+        "arcs": arcs,
+    }
@@ -0,0 +1,173 @@
+from concurrent.futures import ThreadPoolExecutor
+import sys
+import time
+from typing import Dict, List, Union
+
+import geopandas as gpd
+from loguru import logger
+import pandas as pd
+import pyarrow.dataset as ds
+import typer
+
+from streamlit_idealista import functions as fc
+from streamlit_idealista.cities import CITY_CACHE, INTERVENTION_RESOURCES, get_city, get_city_resource
+from streamlit_idealista.config import (
+    PROJ_ROOT,
+    WARM_UP_CITIES,
+    WARM_UP_METRIC,
+    WARM_UP_TRENDS,
+    WARM_UP_WORKERS,
+)
+from streamlit_idealista.modeling.train import get_trend_selections
+
+app = typer.Typer()
+
+DASHBOARD_SCRIPT = PROJ_ROOT / "streamlit_idealista/Idealista_Dataset.py"
+
+
+# The resources of cities.CITY_RESOURCES built for every warmed city; the SQL
+# console tables are left to the first session opening that page
+WARM_RESOURCES = [
+    "intervention_index",
+    "period_index",
+    "grid_index",
+    "gdf_ine_4326",
+    "gdf_ine_projected",
+    "tract_layer",
+]
+
+
+def get_default_selections(gdf_ine: gpd.GeoDataFrame,
+                           interventions_gdf: Union[gpd.GeoDataFrame, None]
+                           ) -> Dict[str, List[str]]:
+    """
+    Get the census tract sets of the default views: every district, and the
+    impacted and district control census tracts of every intervention (see
+    modeling.train.get_trend_selections).
+    """
+    if interventions_gdf is None:
+        interventions_gdf = gpd.GeoDataFrame(columns=["TITOL_WO", "CENSUSTRACT", "geometry"], crs=gdf_ine.crs)
+    return get_trend_selections(gdf_ine, interventions_gdf)
+
+
+def warm_up_series(df: Union[pd.DataFrame, ds.Dataset],
+                   selections: Dict[str, List[str]],
+                   metric: str = WARM_UP_METRIC,
+                   trends: bool = WARM_UP_TRENDS,
+                   workers: int = WARM_UP_WORKERS
+                   ) -> int:
+    """
+    Aggregate the series of the census tract sets into the aggregate cache and,
+    if trends, get their trends into the trend cache.
+
+    Trends precomputed with `modeling.train precompute-trends` are read from
+    the trend store; the others are fitted on workers threads, once per
+    distinct series.
+
+    Args:
+      df (Union[pd.DataFrame, ds.Dataset]): The processed listings.
+      selections (Dict[str, List[str]]): The census tract sets, by name.
+      metric (str): The metric of the series.
+      trends (bool): Whether to get the trends too.
+      workers (int): Threads fitting the trends.
+
+    Returns:
+      int: The number of series.
+    """
+    series_by_key = {}
+    n_series = 0
+    for censustracts in selections.values():
+        timeseries = fc.get_cached_timeseries(df, censustracts, metric=metric)
+        n_series += len(timeseries.columns)
+        for operation in timeseries.columns:
+            series_by_key[fc.get_trend_key(timeseries[operation])] = timeseries[operation]
+
+    if trends:
+        fc.load_trend_store()
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="warm-up") as executor:
+            list(executor.map(fc.get_cached_trend, series_by_key.values()))
+    return n_series
+
+
+def warm_up_city(city: str,
+                 metric: str = WARM_UP_METRIC,
+                 trends: bool = WARM_UP_TRENDS,
+                 workers: int = WARM_UP_WORKERS):
+    """
+    Prepare everything the first session of a city would otherwise wait for:
+    load its datasets, build the indexes and map layers of the pages, the
+    aggregate cube and choropleth of the metric, and the series and trends
+    of the default views.
+
+    Args:
+      city (str): Key of the city in CITIES.
+      metric (str): The metric of the aggregates.
+      trends (bool): Whether to get the trends of the default views.
+      workers (int): Threads fitting the trends.
+    """
+    start = time.perf_counter()
+    city_data = get_city(city)
+    logger.info(f"{city}: datasets loaded in {time.perf_counter() - start:.1f}s")
+
+    step = time.perf_counter()
+    resources = list(WARM_RESOURCES)
+    if city_data["interventions_gdf"] is not None:
+        resources += INTERVENTION_RESOURCES
+    for name in resources:
+        get_city_resource(city, name)
+    logger.info(f"{city}: {len(resources)} indexes and layers built in {time.perf_counter() - step:.1f}s")
+
+    step = time.perf_counter()
+    processed_df = city_data["processed_df"]
+    fc.get_cached_choropleth_arrays(processed_df, city_data["intervention_index"], metric)
+    selections = get_default_selections(city_data["gdf_ine"], city_data["interventions_gdf"])
+    n_series = warm_up_series(processed_df, selections, metric, trends, workers)
+    logger.info(
+        f"{city}: aggregate cube and {n_series} series of {len(selections)} default views "
+        f"{'and their trends ' if trends else ''}computed in {time.perf_counter() - step:.1f}s"
+    )
+    logger.success(f"{city}: warm in {time.perf_counter() - start:.1f}s")
+
+
+@app.command(context_settings={"allow_extra_args": True, "ignore_unknown_options": True})
+def main(
+    ctx: typer.Context,
+    city: List[str] = WARM_UP_CITIES,
+    metric: str = WARM_UP_METRIC,
+    trends: bool = WARM_UP_TRENDS,
+    workers: int = WARM_UP_WORKERS,
+    serve: bool = True,
+):
+    """
+    Warm up the caches of the given cities, then start the dashboard in this
+    process, so it only accepts connections (and its health check only
+    succeeds) once they are warm.
+
+    Other options are passed to `streamlit run` (e.g. --server.port 8501).
+    With --no-serve, only the warm-up runs, e.g. to time it.
+    """
+    for name in city:
+        warm_up_city(name, metric, trends, workers)
+    # Cities over the memory budget unload the ones warmed before them
+    unloaded = [name for name in city if name not in CITY_CACHE]
+    if unloaded:
+        logger.error(
+            f"{', '.join(unloaded)} unloaded while warming up: raise CITY_CACHE_MAX_BYTES "
+            f"({CITY_CACHE.max_bytes / 2**30:.1f} GiB) or warm up fewer cities"
+        )
+        raise typer.Exit(code=1)
+    if not serve:
+        return
+
+    # The pages import functions as a top-level module; sharing this one
+    # keeps its warm caches instead of importing a second, cold copy
+    sys.modules.setdefault("functions", fc)
+
+    from streamlit.web import cli as streamlit_cli
+
+    sys.argv = ["streamlit", "run", str(DASHBOARD_SCRIPT), *ctx.args]
+    sys.exit(streamlit_cli.main())
+
+
+if __name__ == "__main__":
+    app()
@@ -0,0 +1,46 @@
+import numpy as np
+import pandas as pd
+
+from streamlit_idealista import functions as fc
+from streamlit_idealista.cities import empty_intervention_index
+
+CENSUSTRACT = "801901000"
+
+
+def monthly_listings(n_months: int = 24) -> pd.DataFrame:
+    """One sale listing per month-end period from January 2020, priced 100 + month."""
+    periods = pd.date_range("2020-01-31", periods=n_months, freq="ME").strftime("%Y-%m-%d")
+    return pd.DataFrame({
+        "CENSUSTRACT": CENSUSTRACT,
+        "PERIOD": periods,
+        "ADOPERATION": pd.Categorical(["sale"] * n_months, categories=["sale", "rent"]),
+        "ADTYPOLOGY": pd.Categorical(["flat"] * n_months),
+        "UNITPRICE_ASKING": 100.0 + np.arange(n_months),
+    })
+
+
+def test_event_study_adds_up_the_months_of_a_quarter():
+    cube = fc.build_aggregate_cube(monthly_listings())
+    intervention_index = pd.DataFrame({
+        "CENSUSTRACT": [CENSUSTRACT.zfill(10)],
+        "START": [pd.Timestamp("2021-01-15")],
+        "END": [pd.Timestamp("2021-06-30")],
+        "TITOL_WO": ["Intervention"],
+        "SHORTNAME": ["Intervention"],
+    })
+
+    event_study = fc.build_event_study(cube, intervention_index, baseline_quarters=4)
+
+    # Quarter 0 is January to March 2021 (112, 113, 114), the baseline all of 2020
+    changes = event_study["changes"][0, :, event_study["operations"].get_loc("sale")]
+    assert np.isclose(changes[event_study["offsets"].get_loc(0)], 113 / 105.5 - 1)
+    assert np.isclose(changes[event_study["offsets"].get_loc(-1)], 110 / 105.5 - 1)
+
+
+def test_choropleth_yoy_compares_the_same_month():
+    choropleth = fc.build_choropleth_arrays(fc.build_aggregate_cube(monthly_listings()), empty_intervention_index())
+
+    yoy = choropleth["measures"]["yoy"][0, :, choropleth["operations"].get_loc("sale")]
+    # February 2021 (113) against February 2020 (101); 2020 has no previous year
+    assert np.isclose(yoy[choropleth["periods"].get_loc("2021-02-28")], 113 / 101 - 1)
+    assert np.isnan(yoy[:12]).all()